@@ -0,0 +1,436 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client for running hook tools in the unit agent without starting a process.
+
+Hook tools such as ``relation-get`` are small programs that send their arguments to the
+unit agent, over the socket given in ``JUJU_AGENT_SOCKET_ADDRESS``, and print its reply.
+They talk to it with Go's net/rpc package, which encodes messages with encoding/gob.
+This module implements the subset of gob needed to make the same calls from Python.
+"""
+
+import os
+import select
+import socket
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Type IDs that gob predefines.
+_BOOL = 1
+_INT = 2
+_UINT = 3
+_BYTES = 5
+_STRING = 6
+_WIRE_TYPE = 16
+
+# A gob type: ('struct', name, [(field name, field type ID), ...]) or ('slice', name, elem ID).
+_Type = Tuple[str, str, Any]
+
+# The types gob uses to describe other types.
+_WIRE_TYPES = {
+    _WIRE_TYPE: ('struct', 'wireType', [
+        ('ArrayT', 17), ('SliceT', 19), ('StructT', 20), ('MapT', 23)]),
+    17: ('struct', 'arrayType', [('CommonType', 18), ('Elem', _INT), ('Len', _INT)]),
+    18: ('struct', 'CommonType', [('Name', _STRING), ('Id', _INT)]),
+    19: ('struct', 'sliceType', [('CommonType', 18), ('Elem', _INT)]),
+    20: ('struct', 'structType', [('CommonType', 18), ('Field', 22)]),
+    21: ('struct', 'fieldType', [('Name', _STRING), ('Id', _INT)]),
+    22: ('slice', '[]*gob.fieldType', 21),
+    23: ('struct', 'mapType', [('CommonType', 18), ('Key', _INT), ('Elem', _INT)]),
+}  # type: Dict[int, _Type]
+
+_MAX_MESSAGE_SIZE = 1 << 30
+
+
+class ProtocolError(Exception):
+    """Raised when the connection to the agent fails or it sends something unexpected."""
+
+
+class SendError(ProtocolError):
+    """Raised when a call couldn't be sent to the agent, so it certainly wasn't run."""
+
+
+class CallError(Exception):
+    """Raised when the agent reports an error for a call, rather than running it."""
+
+
+def _encode_uint(n: int) -> bytes:
+    if n < 0x80:
+        return bytes([n])
+    data = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return bytes([256 - len(data)]) + data
+
+
+def _encode_int(i: int) -> bytes:
+    return _encode_uint((~i << 1) | 1 if i < 0 else i << 1)
+
+
+class _Buffer:
+    """Reads gob-encoded values from a message."""
+
+    def __init__(self, data: bytes):
+        self._data = data
+        self._pos = 0
+
+    def read(self, n: int) -> bytes:
+        if self._pos + n > len(self._data):
+            raise ProtocolError('gob message truncated')
+        data = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return data
+
+    def read_uint(self) -> int:
+        b = self.read(1)[0]
+        if b < 0x80:
+            return b
+        n = 256 - b
+        if n > 8:
+            raise ProtocolError('invalid gob integer')
+        return int.from_bytes(self.read(n), 'big')
+
+    def read_int(self) -> int:
+        u = self.read_uint()
+        return ~(u >> 1) if u & 1 else u >> 1
+
+    def read_bytes(self) -> bytes:
+        return self.read(self.read_uint())
+
+    def done(self) -> bool:
+        return self._pos == len(self._data)
+
+
+class _Codec:
+    """Encodes and decodes the gob values of one direction of a connection.
+
+    A gob stream describes each type the first time a value of it is sent, so both
+    encoder and decoder keep track of the types seen so far.
+    """
+
+    def __init__(self, types: Dict[int, _Type]):
+        self._types = dict(_WIRE_TYPES)
+        self._types.update(types)
+        self._sent = set()
+
+    def encode(self, type_id: int, value: Any) -> bytes:
+        """Return the messages sending value, preceded by definitions of any new types."""
+        messages = [self._message(-id, self._wire_type(id)) for id in self._unsent(type_id)]
+        messages.append(self._message(type_id, value))
+        return b''.join(messages)
+
+    def _unsent(self, type_id: int) -> List[int]:
+        if type_id < 64 or type_id in self._sent:
+            return []
+        self._sent.add(type_id)
+        kind, _, spec = self._types[type_id]
+        ids = [type_id]
+        for field_id in ([id for _, id in spec] if kind == 'struct' else [spec]):
+            ids.extend(self._unsent(field_id))
+        return ids
+
+    def _wire_type(self, type_id: int) -> Dict[str, Any]:
+        kind, name, spec = self._types[type_id]
+        common = {'Name': name, 'Id': type_id}
+        if kind == 'struct':
+            fields = [{'Name': field, 'Id': id} for field, id in spec]
+            return {'StructT': {'CommonType': common, 'Field': fields}}
+        return {'SliceT': {'CommonType': common, 'Elem': spec}}
+
+    def _message(self, type_id: int, value: Any) -> bytes:
+        parts = [_encode_int(type_id)]
+        if type_id < 0:
+            self._encode_value(_WIRE_TYPE, value, parts)
+        else:
+            if self._types[type_id][0] != 'struct':
+                # Values that aren't structs are sent as a struct's only field.
+                parts.append(_encode_uint(0))
+            self._encode_value(type_id, value, parts)
+        body = b''.join(parts)
+        return _encode_uint(len(body)) + body
+
+    def _encode_value(self, type_id: int, value: Any, parts: List[bytes]):
+        if type_id == _BOOL:
+            parts.append(_encode_uint(1 if value else 0))
+        elif type_id == _INT:
+            parts.append(_encode_int(value))
+        elif type_id == _UINT:
+            parts.append(_encode_uint(value))
+        elif type_id in (_BYTES, _STRING):
+            data = value.encode('utf-8') if isinstance(value, str) else bytes(value)
+            parts.append(_encode_uint(len(data)))
+            parts.append(data)
+        else:
+            kind, _, spec = self._types[type_id]
+            if kind == 'slice':
+                parts.append(_encode_uint(len(value)))
+                for item in value:
+                    self._encode_value(spec, item, parts)
+                return
+            # Fields are sent as the difference from the last field's index, and
+            # zero-valued fields are left out; the end is marked with a zero.
+            last = -1
+            for i, (name, field_id) in enumerate(spec):
+                field = value.get(name)
+                if field is None or (not field and not isinstance(field, dict)):
+                    continue
+                parts.append(_encode_uint(i - last))
+                self._encode_value(field_id, field, parts)
+                last = i
+            parts.append(_encode_uint(0))
+
+    def decode(self, data: bytes) -> Optional[Tuple[int, Any]]:
+        """Decode a message, returning its type ID and value, or None if it defines a type."""
+        buf = _Buffer(data)
+        type_id = buf.read_int()
+        if type_id < 0:
+            wire = self._decode_value(_WIRE_TYPE, buf)
+            if 'StructT' in wire:
+                struct = wire['StructT']
+                fields = [(f.get('Name', ''), f.get('Id', 0)) for f in struct.get('Field', [])]
+                self._types[-type_id] = ('struct', struct['CommonType'].get('Name', ''), fields)
+            elif 'SliceT' in wire:
+                slice_ = wire['SliceT']
+                self._types[-type_id] = ('slice', slice_['CommonType'].get('Name', ''),
+                                         slice_.get('Elem', 0))
+            else:
+                # Types that this module can't decode are an error only if they're used.
+                self._types[-type_id] = ('unsupported', '', None)
+            return None
+        if type_id not in self._types or self._types[type_id][0] != 'struct':
+            if buf.read_uint() != 0:
+                raise ProtocolError('invalid gob message')
+        value = self._decode_value(type_id, buf)
+        if not buf.done():
+            raise ProtocolError('extra data in gob message')
+        return type_id, value
+
+    def _decode_value(self, type_id: int, buf: _Buffer) -> Any:
+        if type_id == _BOOL:
+            return buf.read_uint() != 0
+        elif type_id == _INT:
+            return buf.read_int()
+        elif type_id == _UINT:
+            return buf.read_uint()
+        elif type_id == _BYTES:
+            return buf.read_bytes()
+        elif type_id == _STRING:
+            return buf.read_bytes().decode('utf-8')
+        elif type_id not in self._types:
+            raise ProtocolError('unsupported gob type {}'.format(type_id))
+        kind, _, spec = self._types[type_id]
+        if kind == 'slice':
+            return [self._decode_value(spec, buf) for _ in range(buf.read_uint())]
+        elif kind != 'struct':
+            raise ProtocolError('unsupported gob type {}'.format(type_id))
+        value = {}  # type: Dict[str, Any]
+        index = -1
+        while True:
+            delta = buf.read_uint()
+            if delta == 0:
+                return value
+            index += delta
+            if index >= len(spec):
+                raise ProtocolError('invalid gob field index {}'.format(index))
+            name, field_id = spec[index]
+            value[name] = self._decode_value(field_id, buf)
+
+
+# The types the client sends: net/rpc's request header, and jujuc's request.
+_CLIENT_TYPES = {
+    65: ('struct', 'Request', [('ServiceMethod', _STRING), ('Seq', _UINT)]),
+    66: ('struct', 'Request', [
+        ('ContextId', _STRING),
+        ('Dir', _STRING),
+        ('CommandName', _STRING),
+        ('Args', 67),
+        ('StdinSet', _BOOL),
+        ('Stdin', _BYTES),
+    ]),
+    67: ('slice', '[]string', _STRING),
+}  # type: Dict[int, _Type]
+_RPC_REQUEST = 65
+_JUJUC_REQUEST = 66
+
+
+class _Connection:
+    """A connection to the agent, over which calls are made one at a time."""
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._file = sock.makefile('rb')
+        self._encoder = _Codec(_CLIENT_TYPES)
+        self._decoder = _Codec({})
+        self._seq = 0
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def is_dropped(self) -> bool:
+        """Report whether the agent has closed the connection, or sent something unasked."""
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def send(self, method: str, body_type: int, body: Dict[str, Any]) -> int:
+        """Send a call, returning its sequence number.
+
+        Raises OSError if sending fails, in which case the agent didn't get the whole call.
+        """
+        seq = self._seq
+        self._seq += 1
+        header = self._encoder.encode(_RPC_REQUEST, {'ServiceMethod': method, 'Seq': seq})
+        self._sock.sendall(header + self._encoder.encode(body_type, body))
+        return seq
+
+    def reply(self, seq: int) -> Dict[str, Any]:
+        """Return the body of the reply to the call with the given sequence number."""
+        header = self._receive()
+        if header.get('Seq', 0) != seq:
+            raise ProtocolError('unexpected reply to call {}'.format(header.get('Seq', 0)))
+        # A reply always has a body, even if it reports an error.
+        reply = self._receive()
+        if header.get('Error'):
+            raise CallError(header['Error'])
+        return reply
+
+    def _receive(self) -> Dict[str, Any]:
+        while True:
+            size = self._read_uint()
+            if size > _MAX_MESSAGE_SIZE:
+                raise ProtocolError('gob message too large')
+            data = self._file.read(size)
+            if len(data) < size:
+                raise ProtocolError('connection closed by agent')
+            message = self._decoder.decode(data)
+            if message is not None:
+                return message[1]
+
+    def _read_uint(self) -> int:
+        first = self._file.read(1)
+        if not first:
+            raise ProtocolError('connection closed by agent')
+        if first[0] < 0x80:
+            return first[0]
+        return _Buffer(first + self._file.read(256 - first[0])).read_uint()
+
+
+class Client:
+    """Runs hook tools by calling the unit agent directly.
+
+    Connections are kept open for reuse, and each is used by one call at a time, so the
+    client can be used from several threads.
+    """
+
+    def __init__(self, address: str, context_id: str):
+        # A leading "@" marks a Linux abstract socket, whose name starts with a NUL.
+        if address.startswith('@'):
+            address = '\0' + address[1:]
+        self._address = address
+        self._context_id = context_id
+        self._idle = []  # type: List[_Connection]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environ(cls) -> Optional['Client']:
+        """Return a client for the agent running this hook, or None if it's not usable.
+
+        Only Unix sockets are supported: on Kubernetes, the agent may instead listen
+        on TCP with TLS, which hook tools are then left to handle.
+        """
+        address = os.environ.get('JUJU_AGENT_SOCKET_ADDRESS')
+        context_id = os.environ.get('JUJU_CONTEXT_ID')
+        network = os.environ.get('JUJU_AGENT_SOCKET_NETWORK', 'unix')
+        if not address or not context_id or network != 'unix':
+            return None
+        if not hasattr(socket, 'AF_UNIX'):
+            return None
+        return cls(address, context_id)
+
+    def run(self, command: str, args: Tuple[str, ...]) -> Tuple[int, bytes, bytes]:
+        """Run a hook tool, returning its exit code, stdout and stderr.
+
+        Raises:
+            CallError: if the agent didn't run the tool, for example if it doesn't know it.
+            SendError: if the call couldn't be sent, so the tool wasn't run.
+            ProtocolError: if the connection failed after the call was sent, so the
+                tool may or may not have been run.
+        """
+        request = {
+            'ContextId': self._context_id,
+            'Dir': os.getcwd(),
+            'CommandName': command,
+            'Args': list(args),
+        }
+        conn, seq = self._send('Jujuc.Main', _JUJUC_REQUEST, request)
+        try:
+            response = conn.reply(seq)
+        except CallError:
+            self._release(conn)
+            raise
+        except (OSError, ValueError, ProtocolError) as e:
+            conn.close()
+            if isinstance(e, ProtocolError):
+                raise
+            raise ProtocolError(str(e)) from e
+        self._release(conn)
+        return (response.get('Code', 0), response.get('Stdout', b''),
+                response.get('Stderr', b''))
+
+    def close(self):
+        """Close the connections kept open for reuse."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _send(self, method: str, body_type: int, body: Dict[str, Any]
+              ) -> Tuple[_Connection, int]:
+        conn = self._reuse()
+        if conn is not None:
+            try:
+                return conn, conn.send(method, body_type, body)
+            except OSError:
+                # The agent closed the idle connection; the call goes on a new one instead.
+                conn.close()
+        conn = self._connect()
+        try:
+            return conn, conn.send(method, body_type, body)
+        except OSError as e:
+            conn.close()
+            raise SendError('cannot send call to agent: {}'.format(e)) from e
+
+    def _reuse(self) -> Optional[_Connection]:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn = self._idle.pop()
+            if not conn.is_dropped():
+                return conn
+            conn.close()
+
+    def _connect(self) -> _Connection:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._address)
+        except OSError as e:
+            sock.close()
+            raise SendError('cannot connect to agent: {}'.format(e)) from e
+        return _Connection(sock)
+
+    def _release(self, conn: _Connection):
+        with self._lock:
+            self._idle.append(conn)
@@ -16,10 +16,11 @@
 
 import collections
 import collections.abc
+import heapq
 import inspect
+import itertools
 import keyword
 import logging
-import marshal
 import os
 import pathlib
 import pdb
@@ -57,10 +58,13 @@ if typing.TYPE_CHECKING:
     _ParentHandle = typing.Union["Handle", _ObjectType]
 
     # used to type Framework Attributes
-    _ObserverPath = typing.List[typing.Tuple['_Path', str, '_Path', str]]
+    _ObserverKey = typing.Tuple['_Path', typing.Optional['_Kind']]
+    _ObserverPath = typing.Dict[_ObserverKey, typing.List[typing.Tuple[int, '_Path', str]]]
     _ObjectPath = typing.Tuple[typing.Optional['_Path'], '_Kind']
     _PathToObserverMapping = typing.Dict[str, '_ObserverCallback']
     _PathToObjectMapping = typing.Dict[str, 'Object']
+    _DeferredKey = typing.Tuple['Handle', '_Kind', '_Path', str]
+    _DeferredIndex = typing.Dict[_DeferredKey, typing.List['_Path']]
 
 
 logger = logging.getLogger(__name__)
@@ -164,6 +168,11 @@ class EventBase:
     # TODO this is hard to debug, this should be refactored
     framework = None  # type: Framework
 
+    # Whether deferring the event supersedes the instances of it deferred before. See defer().
+    coalesce_deferred = False  # type: bool
+    # Set by defer() to override coalesce_deferred for a single deferral.
+    _coalesce = None  # type: typing.Optional[bool]
+
     def __init__(self, handle: Handle):
         self.handle = handle
         self.deferred = False  # type: bool
@@ -171,7 +180,7 @@ class EventBase:
     def __repr__(self):
         return "<%s via %s>" % (self.__class__.__name__, self.handle)
 
-    def defer(self):
+    def defer(self, coalesce: typing.Optional[bool] = None):
         """Defer the event to the future.
 
         Deferring an event from a handler puts that handler into a queue, to be
@@ -220,9 +229,22 @@ class EventBase:
         3. At some future time, event C happens, which also checks if A can
            proceed.
 
+        An event that is deferred over and over again while waiting for
+        something (say, ``update-status`` while the workload isn't up yet) can
+        pile up in the queue, and every pending instance is dispatched again
+        on each following invocation. When coalescing, deferring the event
+        drops the instances previously deferred for the same handler that have
+        the same kind and the same data, so that only the newest one stays in
+        the queue.
+
+        Args:
+            coalesce: whether to coalesce this deferral with the instances
+                deferred before; if not given, the event type's
+                ``coalesce_deferred`` class attribute is used.
         """
         logger.debug("Deferring %s.", self)
         self.deferred = True
+        self._coalesce = coalesce
 
     def snapshot(self) -> dict:
         """Return the snapshot data that should be persisted.
@@ -548,8 +570,10 @@ class Framework(Object):
         self.charm_dir = charm_dir
         self.meta = meta
         self.model = model
-        # [(observer_path, method_name, parent_path, event_key)]
-        self._observers = []  # type: _ObserverPath
+        # {(parent_path, event_kind): [(sequence, observer_path, method_name)]}
+        # Observers registered without an event kind live under (parent_path, None).
+        self._observers = {}  # type: _ObserverPath
+        self._observer_sequence = itertools.count()
         # {observer_path: observer}
         self._observer = weakref.WeakValueDictionary()  # type: _PathToObserverMapping
         # {object_path: object}
@@ -559,6 +583,10 @@ class Framework(Object):
         # plus a 'kind' string that is the name of this object.
         self._type_registry = {}  # type: typing.Dict[_ObjectPath, 'Type']
         self._type_known = set()  # type: typing.Set['Type']
+        # {(emitter_handle, event_kind, observer_path, method_name): [event_path]}
+        # The event paths with a stored notice for each observer, built from storage the
+        # first time a deferral coalesces, and kept up to date by _reemit after that.
+        self._deferred_index = None  # type: typing.Optional[_DeferredIndex]
 
         if isinstance(storage, (str, pathlib.Path)):
             logger.warning(
@@ -629,6 +657,11 @@ class Framework(Object):
         # Make sure snapshots are saved by instances of StoredStateData. Any possible state
         # modifications in on_commit handlers of instances of other classes will not be persisted.
         self.on.commit.emit()
+        # Write relation data buffered during the hook, including by commit handlers. This
+        # comes before the storage is committed, so that if a write fails, and Juju discards
+        # the hook's relation changes, the commit is aborted as well.
+        if self.model is not None:
+            self.model.flush()
         # Save our event count after all events have been emitted.
         self.save_snapshot(self._stored)
         self._storage.commit()
@@ -653,18 +686,32 @@ class Framework(Object):
                 'cannot save {} values before registering that type'.format(type(value).__name__))
         data = value.snapshot()
 
-        # Use marshal as a validator, enforcing the use of simple types, as we later the
-        # information is really pickled, which is too error-prone for future evolution of the
-        # stored data (e.g. if the developer stores a custom object and later changes its
-        # class name; when unpickling the original class will not be there and event
-        # data loading will fail).
+        # The storage codecs only accept simple types, and validate the data as they encode
+        # it. Arbitrary objects would be too error-prone for future evolution of the stored
+        # data (e.g. if the developer stores a custom object and later changes its class
+        # name; when loading, the original class will not be there and event data loading
+        # will fail).
+        try:
+            self._storage.save_snapshot(value.handle.path, data)
+        except ValueError:
+            raise self._not_simple_error(value, data)
+
+    def _update_snapshot(self, value: "StoredStateData", keys: typing.Iterable[str]):
+        """Save only the given top-level keys of a snapshot saved before."""
+        if not hasattr(self._storage, 'update_snapshot'):
+            # Storage written for older versions of ops can only save snapshots in full.
+            self.save_snapshot(value)
+            return
+        data = value.snapshot()
+        changes = {key: data[key] for key in keys}
         try:
-            marshal.dumps(data)
+            self._storage.update_snapshot(value.handle.path, changes)
         except ValueError:
-            msg = "unable to save the data for {}, it must contain only simple types: {!r}"
-            raise ValueError(msg.format(value.__class__.__name__, data))
+            raise self._not_simple_error(value, changes)
 
-        self._storage.save_snapshot(value.handle.path, data)
+    def _not_simple_error(self, value, data) -> ValueError:
+        msg = "unable to save the data for {}, it must contain only simple types: {!r}"
+        return ValueError(msg.format(value.__class__.__name__, data))
 
     def load_snapshot(self, handle: Handle) -> '_ObjectType':
         """Load a persistent snapshot."""
@@ -751,7 +798,23 @@ class Framework(Object):
         # TODO Prevent the exact same parameters from being registered more than once.
 
         self._observer[observer.handle.path] = observer
-        self._observers.append((observer.handle.path, method_name, emitter_path, event_kind))
+        key = (emitter_path, event_kind or None)
+        self._observers.setdefault(key, []).append(
+            (next(self._observer_sequence), observer.handle.path, method_name))
+
+    def _observers_for(self, parent_path: "_Path", event_kind: "_Kind"):
+        """Return the (sequence, observer_path, method_name) entries for an event.
+
+        Entries are yielded in registration order, merging the observers of the
+        specific event kind with those registered for any kind of the emitter.
+        """
+        observers = self._observers.get((parent_path, event_kind), ())
+        wildcard = self._observers.get((parent_path, None), ())
+        if not wildcard:
+            return observers
+        if not observers:
+            return wildcard
+        return heapq.merge(observers, wildcard)
 
     def _next_event_key(self):
         """Return the next event key that should be used, incrementing the internal counter."""
@@ -766,13 +829,7 @@ class Framework(Object):
         event_path = event.handle.path
         event_kind = event.handle.kind
         parent_path = event.handle.parent.path
-        # TODO Track observers by (parent_path, event_kind) rather than as a list of
-        # all observers. Avoiding linear search through all observers for every event
-        for observer_path, method_name, _parent_path, _event_kind in self._observers:
-            if _parent_path != parent_path:
-                continue
-            if _event_kind and _event_kind != event_kind:
-                continue
+        for _, observer_path, method_name in self._observers_for(parent_path, event_kind):
             if not saved:
                 # Save the event for all known observers before the first notification
                 # takes place, so that either everyone interested sees it, or nobody does.
@@ -819,53 +876,120 @@ class Framework(Object):
                 if self._backend:
                     self._backend._hook_is_running = ''
 
-        last_event_path = None
-        deferred = True
-        for event_path, observer_path, method_name in self._storage.notices(single_event_path):
+        # The newest coalescing deferral for each emitter, kind and observer.
+        coalesced = {}  # type: typing.Dict[_DeferredKey, str]
+        # The notices of an event are saved together, so they come out of storage together,
+        # and the event is loaded only once for all of its observers.
+        notices = self._storage.notices(single_event_path)
+        for event_path, event_notices in itertools.groupby(notices, key=lambda n: n[0]):
             event_handle = Handle.from_path(event_path)
-
-            if last_event_path != event_path:
-                if not deferred and last_event_path is not None:
-                    self._storage.drop_snapshot(last_event_path)
-                last_event_path = event_path
-                deferred = False
-
             try:
                 event = self.load_snapshot(event_handle)
             except NoTypeError:
-                self._storage.drop_notice(event_path, observer_path, method_name)
+                for notice in list(event_notices):
+                    self._storage.drop_notice(*notice)
+                    self._unindex_notice(*notice)
+                self._storage.drop_snapshot(event_path)
                 continue
 
-            event.deferred = False
-            observer = self._observer.get(observer_path)
-            if observer:
-                if single_event_path is None:
-                    logger.debug("Re-emitting %s.", event)
-                custom_handler = getattr(observer, method_name, None)
-                if custom_handler:
-                    event_is_from_juju = isinstance(event, charm.HookEvent)
-                    event_is_action = isinstance(event, charm.ActionEvent)
-                    with EventContext(self, event_handle.kind):
-                        if (
-                            event_is_from_juju or event_is_action
-                        ) and self._juju_debug_at.intersection({'all', 'hook'}):
-                            # Present the welcome message and run under PDB.
-                            self._show_debug_code_message()
-                            pdb.runcall(custom_handler, event)
-                        else:
-                            # Regular call to the registered method.
-                            custom_handler(event)
-
-            if event.deferred:
-                deferred = True
-            else:
-                self._storage.drop_notice(event_path, observer_path, method_name)
+            deferred = False
+            for _, observer_path, method_name in event_notices:
+                event.deferred = False
+                event._coalesce = None
+                observer = self._observer.get(observer_path)
+                if observer:
+                    if single_event_path is None:
+                        logger.debug("Re-emitting %s.", event)
+                    custom_handler = getattr(observer, method_name, None)
+                    if custom_handler:
+                        event_is_from_juju = isinstance(event, charm.HookEvent)
+                        event_is_action = isinstance(event, charm.ActionEvent)
+                        with EventContext(self, event_handle.kind):
+                            if (
+                                event_is_from_juju or event_is_action
+                            ) and self._juju_debug_at.intersection({'all', 'hook'}):
+                                # Present the welcome message and run under PDB.
+                                self._show_debug_code_message()
+                                pdb.runcall(custom_handler, event)
+                            else:
+                                # Regular call to the registered method.
+                                custom_handler(event)
+
+                key = (event_handle.parent, event_handle.kind, observer_path, method_name)
+                if event.deferred:
+                    deferred = True
+                    coalesce = event._coalesce
+                    if coalesce is None:
+                        coalesce = event.coalesce_deferred
+                    if coalesce:
+                        coalesced[key] = event_path
+                    if self._deferred_index is not None:
+                        paths = self._deferred_index.setdefault(key, [])
+                        if event_path not in paths:
+                            paths.append(event_path)
+                else:
+                    self._storage.drop_notice(event_path, observer_path, method_name)
+                    self._unindex_notice(event_path, observer_path, method_name)
+
             # We intentionally consider this event to be dead and reload it from
-            # scratch in the next path.
+            # scratch the next time it is reemitted.
             self.framework._forget(event)
+            if not deferred:
+                self._storage.drop_snapshot(event_path)
+            # Send logging buffered while handling the event, so that it isn't lost if the
+            # hook is killed before it ends.
+            for handler in logging.getLogger().handlers:
+                handler.flush()
+
+        if coalesced:
+            self._drop_coalesced(coalesced)
+
+    def _drop_coalesced(self, coalesced):
+        """Drop the deferred notices superseded by a newer one with the same event data.
+
+        Args:
+            coalesced: the newest event path deferred for each (emitter handle, event kind,
+                observer path, method name) that coalesces.
+        """
+        if self._deferred_index is None:
+            self._deferred_index = {}
+            for notice in self._storage.notices():
+                handle = Handle.from_path(notice[0])
+                key = (handle.parent, handle.kind, notice[1], notice[2])
+                self._deferred_index.setdefault(key, []).append(notice[0])
+
+        snapshots = {}  # type: typing.Dict[str, typing.Any]
+
+        def load(event_path):
+            if event_path not in snapshots:
+                snapshots[event_path] = self._storage.load_snapshot(event_path)
+            return snapshots[event_path]
+
+        dropped = set()
+        for key, newest in coalesced.items():
+            _, _, observer_path, method_name = key
+            paths = self._deferred_index.get(key, [])
+            for event_path in list(paths):
+                if event_path == newest or load(event_path) != load(newest):
+                    continue
+                logger.debug("Dropping %s deferred to %s, superseded by %s.",
+                             event_path, observer_path, newest)
+                self._storage.drop_notice(event_path, observer_path, method_name)
+                paths.remove(event_path)
+                dropped.add(event_path)
 
-        if not deferred and last_event_path is not None:
-            self._storage.drop_snapshot(last_event_path)
+        for event_path in dropped:
+            if next(self._storage.notices(event_path), None) is None:
+                self._storage.drop_snapshot(event_path)
+
+    def _unindex_notice(self, event_path, observer_path, method_name):
+        """Remove a dropped notice from the deferred notice index, if it has been built."""
+        if self._deferred_index is None:
+            return
+        handle = Handle.from_path(event_path)
+        paths = self._deferred_index.get((handle.parent, handle.kind, observer_path, method_name))
+        if paths and event_path in paths:
+            paths.remove(event_path)
 
     def _show_debug_code_message(self):
         """Present the welcome message (only once!) when using debugger functionality."""
@@ -936,13 +1060,21 @@ class StoredStateData(Object):
         super().__init__(parent, attr_name)
         self._cache = {}
         self.dirty = False
+        # The top-level keys changed since the last save; None means any of them.
+        self._dirty_keys = set()
+        # Whether there is a snapshot in storage that the changes can be applied to.
+        self._saved = False
 
     def __getitem__(self, key):
         return self._cache.get(key)
 
     def __setitem__(self, key, value):
         self._cache[key] = value
+        self._mark_dirty(key)
+
+    def _mark_dirty(self, key):
         self.dirty = True
+        self._dirty_keys.add(key)
 
     def __contains__(self, key):
         return key in self._cache
@@ -955,31 +1087,59 @@ class StoredStateData(Object):
         """Restore current state to the given snapshot."""
         self._cache = snapshot
         self.dirty = False
+        self._dirty_keys = set()
+        self._saved = True
 
     def on_commit(self, event):
-        """Save changes to the storage backend."""
-        if self.dirty:
+        """Save changes to the storage backend.
+
+        Once the data has been saved in full, only the top-level keys that changed since
+        are saved again.
+        """
+        if not self.dirty:
+            return
+        if self._saved and self._dirty_keys and None not in self._dirty_keys:
+            self.framework._update_snapshot(self, self._dirty_keys)
+        else:
             self.framework.save_snapshot(self)
-            self.dirty = False
+            self._saved = True
+        self.dirty = False
+        self._dirty_keys = set()
 
 
 class BoundStoredState:
-    """Stored state data bound to a specific Object."""
+    """Stored state data bound to a specific Object.
+
+    The data is only loaded, and only saved on commit, once it is first read or written.
+    """
+
+    _lazy_data = None  # type: typing.Optional[StoredStateData]
 
     def __init__(self, parent, attr_name):
-        parent.framework.register_type(StoredStateData, parent)
+        # __dict__ is used to avoid infinite recursion. The parent holds on to this object,
+        # so only keep a weak reference back to it to avoid a reference cycle.
+        self.__dict__["_parent"] = weakref.proxy(parent)
+        self.__dict__["_attr_name"] = attr_name
+
+    @property
+    def _data(self) -> StoredStateData:
+        data = self._lazy_data
+        if data is None:
+            data = self.__dict__["_lazy_data"] = self._load()
+        return data
+
+    def _load(self) -> StoredStateData:
+        parent, framework = self._parent, self._parent.framework
+        framework.register_type(StoredStateData, parent)
 
-        handle = Handle(parent, StoredStateData.handle_kind, attr_name)
+        handle = Handle(parent, StoredStateData.handle_kind, self._attr_name)
         try:
-            data = parent.framework.load_snapshot(handle)
+            data = framework.load_snapshot(handle)
         except NoSnapshotError:
-            data = StoredStateData(parent, attr_name)
+            data = StoredStateData(parent, self._attr_name)
 
-        # __dict__ is used to avoid infinite recursion.
-        self.__dict__["_data"] = data
-        self.__dict__["_attr_name"] = attr_name
-
-        parent.framework.observe(parent.framework.on.commit, self._data.on_commit)
+        framework.observe(framework.on.commit, data.on_commit)
+        return data
 
     def __getattr__(self, key):
         # "on" is the only reserved key that can't be used in the data map.
@@ -987,7 +1147,7 @@ class BoundStoredState:
             return self._data.on
         if key not in self._data:
             raise AttributeError("attribute '{}' is not stored".format(key))
-        return _wrap_stored(self._data, self._data[key])
+        return _wrap_stored(self._data, self._data[key], key)
 
     def __setattr__(self, key, value):
         if key == "on":
@@ -1084,14 +1244,15 @@ class StoredState:
                 self.__class__.__name__, parent_type.__name__))
 
 
-def _wrap_stored(parent_data, value):
+def _wrap_stored(parent_data, value, key=None):
+    # key is the top-level key in parent_data that value is, or is nested in.
     t = type(value)
     if t is dict:
-        return StoredDict(parent_data, value)
+        return StoredDict(parent_data, value, key)
     if t is list:
-        return StoredList(parent_data, value)
+        return StoredList(parent_data, value, key)
     if t is set:
-        return StoredSet(parent_data, value)
+        return StoredSet(parent_data, value, key)
     return value
 
 
@@ -1113,20 +1274,21 @@ def _wrapped_repr(obj):
 class StoredDict(collections.abc.MutableMapping):
     """A dict-like object that uses the StoredState as backend."""
 
-    def __init__(self, stored_data, under):
+    def __init__(self, stored_data, under, key=None):
         self._stored_data = stored_data
         self._under = under
+        self._key = key
 
     def __getitem__(self, key):
-        return _wrap_stored(self._stored_data, self._under[key])
+        return _wrap_stored(self._stored_data, self._under[key], self._key)
 
     def __setitem__(self, key, value):
         self._under[key] = _unwrap_stored(self._stored_data, value)
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def __delitem__(self, key):
         del self._under[key]
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def __iter__(self):
         return self._under.__iter__()
@@ -1148,20 +1310,21 @@ class StoredDict(collections.abc.MutableMapping):
 class StoredList(collections.abc.MutableSequence):
     """A list-like object that uses the StoredState as backend."""
 
-    def __init__(self, stored_data, under):
+    def __init__(self, stored_data, under, key=None):
         self._stored_data = stored_data
         self._under = under
+        self._key = key
 
     def __getitem__(self, index):
-        return _wrap_stored(self._stored_data, self._under[index])
+        return _wrap_stored(self._stored_data, self._under[index], self._key)
 
     def __setitem__(self, index, value):
         self._under[index] = _unwrap_stored(self._stored_data, value)
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def __delitem__(self, index):
         del self._under[index]
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def __len__(self):
         return len(self._under)
@@ -1169,12 +1332,12 @@ class StoredList(collections.abc.MutableSequence):
     def insert(self, index, value):
         """Insert value before index."""
         self._under.insert(index, value)
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def append(self, value):
         """Append value to the end of the list."""
         self._under.append(value)
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def __eq__(self, other):
         if isinstance(other, StoredList):
@@ -1222,9 +1385,10 @@ class StoredList(collections.abc.MutableSequence):
 class StoredSet(collections.abc.MutableSet):
     """A set-like object that uses the StoredState as backend."""
 
-    def __init__(self, stored_data, under):
+    def __init__(self, stored_data, under, key=None):
         self._stored_data = stored_data
         self._under = under
+        self._key = key
 
     def add(self, key):
         """Add a key to a set.
@@ -1232,7 +1396,7 @@ class StoredSet(collections.abc.MutableSet):
         This has no effect if the key is already present.
         """
         self._under.add(key)
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def discard(self, key):
         """Remove a key from a set if it is a member.
@@ -1240,7 +1404,7 @@ class StoredSet(collections.abc.MutableSet):
         If the key is not a member, do nothing.
         """
         self._under.discard(key)
-        self._stored_data.dirty = True
+        self._stored_data._mark_dirty(self._key)
 
     def __contains__(self, key):
         return key in self._under
@@ -20,7 +20,7 @@ import typing
 
 if typing.TYPE_CHECKING:
     from types import TracebackType
-    from typing import Type
+    from typing import Iterable, Iterator, Tuple, Type
 
     from ops.model import _ModelBackend  # pyright: reportPrivateUsage=false
 
@@ -41,6 +41,83 @@ class JujuLogHandler(logging.Handler):
         self.model_backend.juju_log(record.levelname, self.format(record))
 
 
+class BufferedJujuLogHandler(JujuLogHandler):
+    """A handler for sending logs to Juju via juju-log in batches.
+
+    Records are buffered rather than each being sent with its own juju-log call.
+    Consecutive buffered records of the same level are sent together, as one
+    multi-line message. Records below the handler's level are dropped before
+    they're buffered.
+
+    The buffer is flushed when it holds ``capacity`` records, when a record of
+    ``flush_level`` or above is logged, and when the handler is flushed or closed.
+    The framework flushes it after each event, and the model backend before running
+    any hook tool but juju-log and the read-only ones, so that the logging stays in
+    order with the tools' effects. If juju-log fails, the unsent messages are written
+    to stderr, which Juju also records in the unit's log.
+    """
+
+    def __init__(self, model_backend: "_ModelBackend", level: int = logging.DEBUG,
+                 capacity: int = 100, flush_level: int = logging.ERROR):
+        super().__init__(model_backend, level)
+        self.capacity = capacity
+        self.flush_level = flush_level
+        self._buffer = []  # type: typing.List[Tuple[str, str]]
+
+    def emit(self, record: logging.LogRecord):
+        """Buffer the specified logging record to be sent to the Juju backend.
+
+        This method is not used directly by the Operator Framework code, but by
+        :class:`logging.Handler` itself as part of the logging machinery.
+        """
+        try:
+            self._buffer.append((record.levelname, self.format(record)))
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self._buffer) >= self.capacity or record.levelno >= self.flush_level:
+            self.flush()
+
+    def flush(self):
+        """Send the buffered records to the Juju backend."""
+        with self.lock:  # type: ignore
+            buffer, self._buffer = self._buffer, []
+            messages = list(self._coalesce(buffer))
+            for i, (level, message) in enumerate(messages):
+                try:
+                    self.model_backend.juju_log(level, message)
+                except Exception:
+                    for level, message in messages[i:]:
+                        sys.stderr.write('{} {}\n'.format(level, message))
+                    sys.stderr.flush()
+                    return
+
+    def close(self):
+        """Flush the buffered records and close the handler."""
+        try:
+            self.flush()
+        finally:
+            super().close()
+
+    @staticmethod
+    def _coalesce(records: "Iterable[Tuple[str, str]]") -> "Iterator[Tuple[str, str]]":
+        """Join runs of messages at the same level, keeping each under MAX_LOG_LINE_LEN."""
+        from ops.model import MAX_LOG_LINE_LEN
+        level = None  # type: typing.Optional[str]
+        lines = []  # type: typing.List[str]
+        length = -1
+        for record_level, message in records:
+            if lines and (record_level != level
+                          or length + 1 + len(message) > MAX_LOG_LINE_LEN):
+                yield typing.cast(str, level), '\n'.join(lines)
+                lines, length = [], -1
+            level = record_level
+            lines.append(message)
+            length += 1 + len(message)
+        if lines:
+            yield typing.cast(str, level), '\n'.join(lines)
+
+
 def setup_root_logging(model_backend: "_ModelBackend", debug: bool = False):
     """Setup python logging to forward messages to juju-log.
 
@@ -55,7 +132,7 @@ def setup_root_logging(model_backend: "_ModelBackend", debug: bool = False):
     """
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(JujuLogHandler(model_backend))
+    logger.addHandler(BufferedJujuLogHandler(model_backend))
     if debug:
         handler = logging.StreamHandler()
         formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
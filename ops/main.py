@@ -266,6 +266,9 @@ class _Dispatcher:
         argv = sys.argv.copy()
         argv[0] = str(dispatch_path)
         logger.info("Running legacy %s.", self._dispatch_path)
+        # Send buffered logging to Juju first, so it comes before the legacy hook's own.
+        for handler in logging.getLogger().handlers:
+            handler.flush()
         try:
             subprocess.run(argv, check=True)
         except subprocess.CalledProcessError as e:
@@ -345,7 +348,8 @@ def _should_use_controller_storage(db_path: Path, meta: ops.charm.CharmMeta) ->
         return False
 
 
-def main(charm_class: typing.Type[ops.charm.CharmBase], use_juju_for_storage: bool = None):
+def main(charm_class: typing.Type[ops.charm.CharmBase], use_juju_for_storage: bool = None,
+         sqlite_wal: bool = False, juju_storage_prefetch: bool = False):
     """Setup the charm and dispatch the observed event.
 
     The event name is based on the way this executable was called (argv[0]).
@@ -356,6 +360,11 @@ def main(charm_class: typing.Type[ops.charm.CharmBase], use_juju_for_storage: bo
             then kubernetes charms that haven't previously used local storage and that
             are running on a new enough Juju default to controller-side storage,
             otherwise local storage is used.
+        sqlite_wal: whether local storage uses SQLite's write-ahead log, which makes
+            committing the charm's state cheaper. See :class:`ops.storage.SQLiteStorage`.
+        juju_storage_prefetch: whether controller-side storage fetches the whole state with
+            a single call, rather than each key when it's first read. See
+            :class:`ops.storage.JujuStorage`.
     """
     charm_dir = _get_charm_dir()
 
@@ -400,9 +409,9 @@ def main(charm_class: typing.Type[ops.charm.CharmBase], use_juju_for_storage: bo
                          dispatcher.event_name)
             # Note that we don't exit nonzero, because that would cause Juju to rerun the hook
             return
-        store = ops.storage.JujuStorage()
+        store = ops.storage.JujuStorage(prefetch=juju_storage_prefetch)
     else:
-        store = ops.storage.SQLiteStorage(charm_state_path)
+        store = ops.storage.SQLiteStorage(charm_state_path, wal=sqlite_wal)
     framework = ops.framework.Framework(store, charm_dir, meta, model)
     framework.set_breakpointhook()
     try:
@@ -13,7 +13,11 @@
 # limitations under the License.
 
 """Representations of Juju's model, application, unit, and other entities."""
+import concurrent.futures
+import copy
 import datetime
+import hashlib
+import io
 import ipaddress
 import json
 import logging
@@ -23,10 +27,12 @@ import re
 import shutil
 import stat
 import tempfile
+import threading
 import time
 import typing
 import weakref
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
 from subprocess import PIPE, CalledProcessError, run
 from typing import (
@@ -50,8 +56,9 @@ from typing import (
 )
 
 import ops
+import ops.log
 import ops.pebble as pebble
-from ops._private import yaml
+from ops._private import jujuc, yaml
 from ops.jujuversion import JujuVersion
 
 if typing.TYPE_CHECKING:
@@ -200,6 +207,17 @@ class Model:
         """
         return self._backend.model_uuid
 
+    @property
+    def tool_cache_stats(self) -> Dict[str, int]:
+        """Return the hit and miss counts of the cache of read-only hook tool output.
+
+        Read-only hook tools, such as ``config-get`` and ``relation-get``, are only run once
+        for each set of arguments during a hook. The returned dict has the number of runs
+        answered from the cache under ``'hits'``, and the number of runs that weren't under
+        ``'misses'``.
+        """
+        return self._backend.tool_cache_stats()
+
     def get_unit(self, unit_name: str) -> 'Unit':
         """Get an arbitrary unit by name.
 
@@ -250,6 +268,43 @@ class Model:
         """
         return self._bindings.get(binding_key)
 
+    def flush(self):
+        """Write buffered relation data changes to Juju.
+
+        Setting relation data is buffered, so that all the changes to a data bag made
+        during a hook are written with a single ``relation-set`` call. The framework
+        calls this on commit, at the end of the hook, before committing the charm's
+        stored state, so a failed write fails the hook and aborts the commit. Call it directly
+        to handle errors in a charm, or if the changes must be visible to Juju (or to
+        another process) earlier.
+
+        If writing a data bag fails, the other bags are still written, and the failed
+        bag's changes are kept to be written by the next flush.
+
+        Raises:
+            RelationNotFoundError: if a relation with buffered changes no longer exists.
+            ModelError: if writing the changes failed for another reason.
+        """
+        self._backend.relation_set_flush()
+
+    def prefetch_relations(self, *relation_names: str, max_workers: int = 8):
+        """Load the data of every unit and application in the given relations at once.
+
+        The data is fetched with up to max_workers concurrent ``relation-get`` calls,
+        instead of one call at a time as each data bag is first read. This is
+        worthwhile before reading the data of relations with many units.
+
+        Args:
+            relation_names: The names of the endpoints whose relations to load; if none
+                are given, every relation is loaded.
+            max_workers: The maximum number of ``relation-get`` calls to run at once.
+        """
+        contents = []  # type: List[RelationDataContent]
+        for relation_name in relation_names or self.relations:
+            for relation in self.relations[relation_name]:
+                contents.extend(relation.data.values())
+        _prefetch_relation_data(contents, max_workers)
+
 
 _T = TypeVar('_T', bound='UnitOrApplication')
 
@@ -840,6 +895,13 @@ class Relation:
 
         self.data = RelationData(self, our_unit, backend)
 
+    def prefetch(self, max_workers: int = 8):
+        """Load the data of every unit and application in the relation at once.
+
+        See :meth:`Model.prefetch_relations`.
+        """
+        _prefetch_relation_data(self.data.values(), max_workers)
+
     def __repr__(self):
         return '<{}.{} {}:{}>'.format(type(self).__module__,
                                       type(self).__name__,
@@ -896,7 +958,11 @@ class RelationData(Mapping['UnitOrApplication', 'RelationDataContent']):
 # We mix in MutableMapping here to get some convenience implementations, but whether it's actually
 # mutable or not is controlled by the flag.
 class RelationDataContent(LazyMapping, MutableMapping[str, str]):
-    """Data content of a unit or application in a relation."""
+    """Data content of a unit or application in a relation.
+
+    Changes are buffered and written to Juju together at the end of the hook, or when
+    :meth:`Model.flush` is called; reading the data sees them straight away.
+    """
 
     def __init__(self, relation: 'Relation', entity: 'UnitOrApplication',
                  backend: '_ModelBackend'):
@@ -930,6 +996,17 @@ class RelationDataContent(LazyMapping, MutableMapping[str, str]):
         return False
 
     def __setitem__(self, key: str, value: str):
+        """Set a key in the data bag; setting it to an empty string removes it.
+
+        The write is buffered, so errors from Juju, such as :class:`RelationNotFoundError`
+        if the relation is gone, aren't raised here. They're raised by :meth:`Model.flush`,
+        which the framework calls when it commits at the end of the hook, or which a charm
+        can call itself to handle them.
+
+        Raises:
+            RelationDataError: if the data bag can't be written by this unit, or the value
+                isn't a string.
+        """
         if not self._is_mutable():
             raise RelationDataError('cannot set relation data for {}'.format(self._entity.name))
         if not isinstance(value, str):
@@ -952,6 +1029,27 @@ class RelationDataContent(LazyMapping, MutableMapping[str, str]):
         self.__setitem__(key, '')
 
 
+def _prefetch_relation_data(contents: Iterable[RelationDataContent], max_workers: int):
+    """Load the data bags that aren't loaded yet, running up to max_workers loads at once.
+
+    A bag that fails to load is left unloaded, so that the error is raised when it's read.
+    """
+    pending = [content for content in contents if content._lazy_data is None]
+    if not pending:
+        return
+    with _ThreadPool(min(max_workers, len(pending))) as executor:
+        futures = [executor.submit(content._load) for content in pending]
+        for content, future in zip(pending, futures):
+            try:
+                data = future.result()
+            except (ModelError, RuntimeError) as e:
+                logger.debug('Unable to prefetch relation data for %s: %s',
+                             content._entity.name, e)
+                continue
+            if content._lazy_data is None:
+                content._lazy_data = data
+
+
 class ConfigData(LazyMapping):
     """Configuration data.
 
@@ -1240,6 +1338,71 @@ class MultiPushPullError(Exception):
         return 'MultiError({!r}, {} errors)'.format(self.message, len(self.errors))
 
 
+class _LazyFile:
+    """Readable binary file that is only opened when first used, and closed once read to the end.
+
+    It also provides what pebble.Client needs to send the file with sendfile().
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = None  # type: Optional[BinaryIO]
+        self._done = False
+
+    def _open(self) -> BinaryIO:
+        if self._done:
+            raise ValueError('I/O operation on closed file')
+        if self._file is None:
+            self._file = typing.cast(BinaryIO, open(self._path, 'rb'))
+        return self._file
+
+    def read(self, size: int = -1) -> bytes:
+        if self._done:
+            return b''
+        content = self._open().read(size)
+        if not content:
+            self.close()
+        return content
+
+    def fileno(self) -> int:
+        return self._open().fileno()
+
+    def tell(self) -> int:
+        return self._open().tell()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._open().seek(offset, whence)
+
+    def close(self):
+        self._done = True
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _HashSink(io.RawIOBase):
+    """Writable file that only keeps a hash of the content written to it."""
+
+    def __init__(self):
+        super().__init__()
+        self.hash = hashlib.sha256()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return len(data)
+
+
+class _ThreadPool(concurrent.futures.ThreadPoolExecutor):
+    """Thread pool on which the model runs concurrent requests to Pebble or Juju."""
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers)
+        self.max_workers = max_workers
+
+
 class Container:
     """Represents a named container in a unit.
 
@@ -1250,6 +1413,10 @@ class Container:
         name: The name of the container from metadata.yaml (eg, 'postgres').
     """
 
+    # Limits on the files copied in a single request by push_path and pull_path.
+    _batch_files = 500
+    _batch_bytes = 16 * 1024 * 1024
+
     def __init__(self, name: str, backend: '_ModelBackend',
                  pebble_client: Optional['pebble.Client'] = None):
         self.name = name
@@ -1258,6 +1425,10 @@ class Container:
             socket_path = '/charm/containers/{}/pebble.socket'.format(name)
             pebble_client = backend.get_pebble(socket_path)
         self._pebble = pebble_client  # type: 'pebble.Client'
+        # The plan last fetched, until a layer is added through this container.
+        self._plan = None  # type: Optional[pebble.Plan]
+        # False if every layer added since the last replan was skipped as unchanged.
+        self._plan_changed = None  # type: Optional[bool]
 
     @property
     def pebble(self) -> 'pebble.Client':
@@ -1310,8 +1481,16 @@ class Container:
         self._pebble.autostart_services()
 
     def replan(self):
-        """Replan all services: restart changed services and start startup-enabled services."""
+        """Replan all services: restart changed services and start startup-enabled services.
+
+        This is skipped if every layer added since the last replan was skipped with
+        ``add_layer(..., skip_if_unchanged=True)``, as the plan is then the same.
+        """
+        if self._plan_changed is False:
+            logger.debug('Skipping replan of container %r: plan unchanged', self.name)
+            return
         self._pebble.replan_services()
+        self._plan_changed = None
 
     def start(self, *service_names: str):
         """Start given service(s) by name."""
@@ -1349,7 +1528,8 @@ class Container:
         # fixme: remove on pebble.exec signature fix
         self._pebble.stop_services(service_names)  # type: ignore
 
-    def add_layer(self, label: str, layer: '_Layer', *, combine: bool = False):
+    def add_layer(self, label: str, layer: '_Layer', *, combine: bool = False,
+                  skip_if_unchanged: bool = False) -> bool:
         """Dynamically add a new layer onto the Pebble configuration layers.
 
         Args:
@@ -1362,13 +1542,59 @@ class Container:
                 combine is True and the label already exists, the two layers
                 are combined into a single one considering the layer override
                 rules; if the layer doesn't exist, it is added as usual.
+            skip_if_unchanged: If true, don't add the layer if the services and
+                checks it defines would be the same in the plan with it as
+                they are now; a following :meth:`replan` is then skipped too.
+                The plan compared against is the one last fetched through
+                this container, so changes to it made other than through the
+                container aren't seen.
+
+        Returns:
+            True if the layer was added, False if it was skipped as unchanged.
         """
+        if skip_if_unchanged:
+            layer_obj = layer if isinstance(layer, pebble.Layer) else pebble.Layer(layer)
+            plan = self._plan if self._plan is not None else self.get_plan()
+            if not self._layer_changes_plan(plan, layer_obj):
+                logger.debug('Skipping unchanged layer %r in container %r', label, self.name)
+                if self._plan_changed is None:
+                    self._plan_changed = False
+                return False
+            layer = layer_obj
+
+        self._plan = None
+        self._plan_changed = True
         # fixme: remove ignore once pebble.py is typed
         self._pebble.add_layer(label, layer, combine=combine)  # type: ignore
+        return True
+
+    @staticmethod
+    def _layer_changes_plan(plan: 'pebble.Plan', layer: 'pebble.Layer') -> bool:
+        """Report whether adding layer could change the plan's services or checks.
+
+        Each service and check in the layer is combined with the plan's one following the
+        layer override rules, and compared with it; the value of "override" itself is ignored.
+        """
+        for current_items, layer_items in [(plan.services, layer.services),
+                                           (plan.checks, layer.checks)]:
+            for name, item in layer_items.items():
+                current = current_items.get(name)
+                if current is None or item.override not in ('merge', 'replace'):
+                    return True
+                if item.override == 'replace':
+                    combined = copy.deepcopy(item)
+                else:
+                    combined = copy.deepcopy(current)
+                    combined._merge(item)
+                combined.override = current.override
+                if combined != current:
+                    return True
+        return False
 
     def get_plan(self) -> 'pebble.Plan':
         """Get the current effective pebble configuration."""
-        return self._pebble.get_plan()
+        self._plan = self._pebble.get_plan()
+        return self._plan
 
     def get_services(self, *service_names: str) -> '_ServiceInfoMapping':
         """Fetch and return a mapping of status information indexed by service name.
@@ -1422,20 +1648,38 @@ class Container:
         return checks[check_name]
 
     def pull(self, path: StrOrPath, *,
-             encoding: Optional[str] = 'utf-8') -> Union[BinaryIO, TextIO]:
+             encoding: Optional[str] = 'utf-8',
+             stream: bool = False) -> Union[BinaryIO, TextIO]:
         """Read a file's content from the remote system.
 
         Args:
             path: Path of the file to read from the remote system.
             encoding: Encoding to use for decoding the file's bytes to str,
                 or None to specify no decoding.
+            stream: If True, read the content straight from the response as
+                it is read from the returned file, rather than first saving it
+                to a temporary file. The file should then be read to the end or
+                closed promptly, as it holds on to the connection to Pebble.
 
         Returns:
             A readable file-like object, whose read() method will return str
             objects decoded according to the specified encoding, or bytes if
             encoding is None.
         """
-        return self._pebble.pull(str(path), encoding=encoding)
+        return self._pebble.pull(str(path), encoding=encoding, stream=stream)
+
+    def pull_to(self, path: StrOrPath, dest: StrOrPath):
+        """Read a file from the remote system, writing its content to a local file.
+
+        The content is written to dest as it arrives, without being buffered
+        in a temporary file first. The local file is only created (or
+        truncated) if the remote file can be read.
+
+        Args:
+            path: Path of the file to read from the remote system.
+            dest: Path of the local file to write to.
+        """
+        self._pebble.pull_to(str(path), str(dest))
 
     def push(self,
              path: StrOrPath,
@@ -1495,7 +1739,8 @@ class Container:
 
     def push_path(self,
                   source_path: Union[StrOrPath, Iterable[StrOrPath]],
-                  dest_dir: StrOrPath):
+                  dest_dir: StrOrPath, *,
+                  max_workers: int = 1):
         """Recursively push a local path or files to the remote system.
 
         Only regular files and directories are copied; symbolic links, device files, etc. are
@@ -1539,6 +1784,8 @@ class Container:
                 trailing "/*" it will have its *contents* placed inside the destination directory.
             dest_dir: Remote destination directory inside which the source dir/files will be
                 placed.  This must be an absolute path.
+            max_workers: Maximum number of requests to Pebble to run concurrently, each in its
+                own thread.  By default, files are pushed one batch at a time.
         """
         if os.name == 'nt':
             raise RuntimeError('Container.push_path is not supported on Windows-based systems')
@@ -1550,34 +1797,253 @@ class Container:
         source_paths = [Path(p) for p in source_paths]
         dest_dir = Path(dest_dir)
 
+        errors = []  # type: List[Tuple[str, Exception]]
+        files = self._list_local(source_paths, dest_dir, errors)
+        with self._executor(max_workers) as executor:
+            self._push_files(files, errors, executor)
+        if errors:
+            raise MultiPushPullError('failed to push one or more files', errors)
+
+    def sync_path(self,
+                  source_path: Union[StrOrPath, Iterable[StrOrPath]],
+                  dest_dir: StrOrPath, *,
+                  checksum: bool = True,
+                  delete: bool = False,
+                  max_workers: int = 1):
+        """Recursively push a local path or files to the remote system, skipping unchanged files.
+
+        This copies files in the same way as :meth:`push_path`, but first lists the destination
+        on the remote system and only pushes the files that are new or have changed.  A remote
+        file is considered unchanged if it has the same size as the local file and it was last
+        modified no earlier than the local file, as pushing a file sets its modification time to
+        the time it was pushed.  A local file modified since then, but still of the same size,
+        is compared by content, so files regenerated in every hook with the same content, such
+        as rendered templates, aren't pushed again.
+
+        Errors are collected and raised in a single MultiPushPullError, as for :meth:`push_path`.
+
+        Args:
+            source_path: A single path or list of paths to push to the remote system, as for
+                :meth:`push_path`.
+            dest_dir: Remote destination directory inside which the source dir/files will be
+                placed.  This must be an absolute path.
+            checksum: If true (the default), a file that was modified locally since it was
+                pushed but still has the same size is compared by content, and only pushed if
+                that differs; the remote file is read to compare it.  If false, such files are
+                pushed without comparing them, which is cheaper when files are only modified
+                locally to change their content.
+            delete: If true, remove remote files under the destination of each source path that
+                don't exist locally.  Directories are left in place.
+            max_workers: Maximum number of requests to Pebble to run concurrently, as for
+                :meth:`push_path`.
+        """
+        if os.name == 'nt':
+            raise RuntimeError('Container.sync_path is not supported on Windows-based systems')
+
+        if hasattr(source_path, '__iter__') and not isinstance(source_path, str):
+            source_paths = typing.cast(Iterable[StrOrPath], source_path)
+        else:
+            source_paths = typing.cast(Iterable[StrOrPath], [source_path])
+        source_paths = [Path(p) for p in source_paths]
+        dest_dir = Path(dest_dir)
+
+        errors = []  # type: List[Tuple[str, Exception]]
+        files = self._list_local(source_paths, dest_dir, errors)
+        with self._executor(max_workers) as executor:
+            self._sync_files(files, source_paths, dest_dir, errors, executor,
+                             checksum=checksum, delete=delete)
+        if errors:
+            raise MultiPushPullError('failed to sync one or more files', errors)
+
+    def _sync_files(self, files: List[Tuple[str, 'pebble.FileInfo', Path]],
+                    source_paths: List[Path], dest_dir: Path,
+                    errors: List[Tuple[str, Exception]], executor: Optional['_ThreadPool'], *,
+                    checksum: bool, delete: bool):
+        """Push the files listed for sync_path that changed, and remove remote extras."""
+        remote = {}  # type: Dict[str, Tuple[str, pebble.FileInfo]]
+        for source_path in source_paths:
+            if str(source_path) in {source for source, _ in errors}:
+                continue
+            remote_root = self._build_destpath(source_path, source_path, dest_dir)
+            try:
+                for info in Container._list_recursive(self.list_files, remote_root, executor):
+                    remote[info.path] = (str(source_path), info)
+            except pebble.APIError as err:
+                if err.code != 404:
+                    errors.append((str(source_path), err))
+            except (OSError, pebble.Error) as err:
+                errors.append((str(source_path), err))
+
+        changed = []  # type: List[Tuple[str, pebble.FileInfo, Path]]
+        compare = []  # type: List[Tuple[str, pebble.FileInfo, Path]]
+        for file in files:
+            _, info, dstpath = file
+            _, remote_info = remote.pop(str(dstpath), (None, None))
+            if remote_info is None or remote_info.size != info.size:
+                changed.append(file)
+            elif remote_info.last_modified.timestamp() < info.last_modified.timestamp():
+                (compare if checksum else changed).append(file)
+
+        def compare_batch(batch: List[Tuple[str, pebble.FileInfo, Path]]
+                          ) -> Tuple[List[Tuple[str, pebble.FileInfo, Path]],
+                                     List[Tuple[str, Exception]]]:
+            """Return the files in the batch that changed, and the errors by source path."""
+            sinks = {str(dstpath): _HashSink() for _, _, dstpath in batch}
+            try:
+                path_errors = self._pebble.pull_many(list(sinks), lambda path: sinks[path])
+            except (OSError, pebble.Error):
+                # Files that can't be compared are pushed.
+                return batch, []
+            batch_changed = []  # type: List[Tuple[str, pebble.FileInfo, Path]]
+            batch_errors = []  # type: List[Tuple[str, Exception]]
+            for source_path, info, dstpath in batch:
+                if str(dstpath) not in path_errors:
+                    try:
+                        digest = self._hash_file(info.path)
+                    except OSError as err:
+                        batch_errors.append((source_path, err))
+                        continue
+                    if digest == sinks[str(dstpath)].hash.digest():
+                        continue
+                batch_changed.append((source_path, info, dstpath))
+            return batch_changed, batch_errors
+
+        for batch_changed, batch_errors in self._map(executor, compare_batch, compare):
+            changed.extend(batch_changed)
+            errors.extend(batch_errors)
+
+        self._push_files(changed, errors, executor)
+
+        if delete:
+            for path, (source_path, _) in sorted(remote.items()):
+                try:
+                    self._pebble.remove_path(path)
+                except pebble.Error as err:
+                    errors.append((source_path, err))
+
+    @staticmethod
+    def _hash_file(path: str) -> bytes:
+        """Return the SHA-256 digest of a local file's content."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    def _list_local(self, source_paths: List[Path], dest_dir: Path,
+                    errors: List[Tuple[str, Exception]]
+                    ) -> List[Tuple[str, 'pebble.FileInfo', Path]]:
+        """List the local files to push as (source path, file info, destination path)."""
         def local_list(source_path: Path) -> List[pebble.FileInfo]:
             paths = source_path.iterdir() if source_path.is_dir() else [source_path]
             files = [self._build_fileinfo(source_path / f) for f in paths]
             return files
 
-        errors = []  # type: List[Tuple[str, Exception]]
+        files = []  # type: List[Tuple[str, pebble.FileInfo, Path]]
         for source_path in source_paths:
             try:
                 for info in Container._list_recursive(local_list, source_path):
                     dstpath = self._build_destpath(info.path, source_path, dest_dir)
-                    with open(info.path) as src:
-                        self.push(
-                            dstpath,
-                            src,
-                            make_dirs=True,
-                            permissions=info.permissions,
-                            user_id=info.user_id,
-                            user=info.user,
-                            group_id=info.group_id,
-                            group=info.group)
+                    files.append((str(source_path), info, dstpath))
             except (OSError, pebble.Error) as err:
                 errors.append((str(source_path), err))
-        if errors:
-            raise MultiPushPullError('failed to push one or more files', errors)
+        return files
+
+    def _push_files(self, files: List[Tuple[str, 'pebble.FileInfo', Path]],
+                    errors: List[Tuple[str, Exception]], executor: Optional['_ThreadPool'] = None):
+        """Push the listed local files in batches, collecting errors by source path."""
+        def push_batch(batch: List[Tuple[str, pebble.FileInfo, Path]]
+                       ) -> List[Tuple[str, Exception]]:
+            batch_errors = []  # type: List[Tuple[str, Exception]]
+            readable = []  # type: List[Tuple[str, pebble.FileInfo, Path]]
+            for source_path, info, dstpath in batch:
+                # Check that each file can be opened, so that one that can't fails alone
+                # rather than the whole request.
+                try:
+                    with open(info.path, 'rb'):
+                        pass
+                except OSError as err:
+                    batch_errors.append((source_path, err))
+                else:
+                    readable.append((source_path, info, dstpath))
+            if not readable:
+                return batch_errors
+            batch = readable
+            # Files are only opened again when their content is sent.
+            sources = [_LazyFile(info.path) for _, info, _ in batch]
+            try:
+                path_errors = self._pebble.push_many([{
+                    'path': str(dstpath),
+                    'source': source,
+                    'make_dirs': True,
+                    'permissions': info.permissions,
+                    'user_id': info.user_id,
+                    'user': info.user,
+                    'group_id': info.group_id,
+                    'group': info.group,
+                } for (_, info, dstpath), source in zip(batch, sources)])
+            except (OSError, pebble.Error) as err:
+                # The whole request failed: report it once for each source path in it.
+                for source_path in sorted({source_path for source_path, _, _ in batch}):
+                    batch_errors.append((source_path, err))
+            else:
+                for source_path, _, dstpath in batch:
+                    if str(dstpath) in path_errors:
+                        batch_errors.append((source_path, path_errors[str(dstpath)]))
+            finally:
+                for source in sources:
+                    source.close()
+            return batch_errors
+
+        # Errors are collected in the order of the batches, however long each one takes.
+        for batch_errors in self._map(executor, push_batch, files):
+            errors.extend(batch_errors)
+
+    def _batches(self, files, workers=1):
+        """Split the files to push or pull into batches to copy in one request each.
+
+        A batch holds at most _batch_files files, and files of at most
+        _batch_bytes bytes in total, unless it's a single larger file.  With
+        several workers, the files are spread over at least as many batches.
+        """
+        max_files, max_bytes = self._batch_files, self._batch_bytes
+        if workers > 1:
+            total_bytes = sum(file[1].size or 0 for file in files)
+            max_files = min(max_files, max(1, math.ceil(len(files) / workers)))
+            max_bytes = min(max_bytes, max(1, math.ceil(total_bytes / workers)))
+        batch, batch_bytes = [], 0
+        for file in files:
+            size = file[1].size or 0
+            if batch and (len(batch) >= max_files or batch_bytes + size > max_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(file)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _map(self, executor: Optional['_ThreadPool'],
+             func: Callable[[List[Tuple[str, 'pebble.FileInfo', Path]]], Any],
+             files: List[Tuple[str, 'pebble.FileInfo', Path]]) -> Iterable[Any]:
+        """Call func with each batch of files, on the executor if any; results are in order."""
+        if executor is None:
+            return map(func, self._batches(files))
+        return executor.map(func, list(self._batches(files, executor.max_workers)))
+
+    @staticmethod
+    @contextmanager
+    def _executor(max_workers: int) -> Generator[Optional['_ThreadPool'], None, None]:
+        """Return a thread pool to run up to max_workers requests, or None to run them in turn."""
+        if max_workers == 1:
+            yield None
+            return
+        with _ThreadPool(max_workers) as executor:
+            yield executor
 
     def pull_path(self,
                   source_path: Union[StrOrPath, Iterable[StrOrPath]],
-                  dest_dir: StrOrPath):
+                  dest_dir: StrOrPath, *,
+                  max_workers: int = 1):
         """Recursively pull a remote path or files to the local system.
 
         Only regular files and directories are copied; symbolic links, device files, etc. are
@@ -1622,6 +2088,9 @@ class Container:
                 placed inside the destination directory.
             dest_dir: Local destination directory inside which the source dir/files will be
                 placed.
+            max_workers: Maximum number of requests to Pebble to run concurrently, each in its
+                own thread.  By default, directories are listed and files are pulled one at a
+                time.
         """
         if os.name == 'nt':
             raise RuntimeError('Container.pull_path is not supported on Windows-based systems')
@@ -1634,19 +2103,47 @@ class Container:
         dest_dir = Path(dest_dir)
 
         errors = []  # type: List[Tuple[str, Exception]]
-        for source_path in source_paths:
-            try:
-                for info in Container._list_recursive(self.list_files, source_path):
-                    dstpath = self._build_destpath(info.path, source_path, dest_dir)
-                    dstpath.parent.mkdir(parents=True, exist_ok=True)
-                    with self.pull(info.path, encoding=None) as src:
-                        with dstpath.open(mode='wb') as dst:
-                            shutil.copyfileobj(typing.cast(BinaryIO, src), dst)
-            except (OSError, pebble.Error) as err:
-                errors.append((str(source_path), err))
+        with self._executor(max_workers) as executor:
+            files = []  # type: List[Tuple[str, pebble.FileInfo, Path]]
+            for source_path in source_paths:
+                try:
+                    for info in Container._list_recursive(
+                            self.list_files, source_path, executor):
+                        dstpath = self._build_destpath(info.path, source_path, dest_dir)
+                        files.append((str(source_path), info, dstpath))
+                except (OSError, pebble.Error) as err:
+                    errors.append((str(source_path), err))
+
+            for batch_errors in self._map(executor, self._pull_batch, files):
+                errors.extend(batch_errors)
         if errors:
             raise MultiPushPullError('failed to pull one or more files', errors)
 
+    def _pull_batch(self, batch: List[Tuple[str, 'pebble.FileInfo', Path]]
+                    ) -> List[Tuple[str, Exception]]:
+        """Pull a batch of files in one request, returning the errors by source path."""
+        dstpaths = {info.path: dstpath for _, info, dstpath in batch}
+
+        def open_file(path: str) -> BinaryIO:
+            dstpath = dstpaths.get(path)
+            if dstpath is None:
+                raise pebble.ProtocolError('path not expected: {!r}'.format(path))
+            dstpath.parent.mkdir(parents=True, exist_ok=True)
+            return typing.cast(BinaryIO, dstpath.open(mode='wb'))
+
+        errors = []  # type: List[Tuple[str, Exception]]
+        try:
+            path_errors = self._pebble.pull_many(list(dstpaths), open_file)
+        except (OSError, pebble.Error) as err:
+            # The whole request failed: report it once for each source path in it.
+            for source_path in sorted({source_path for source_path, _, _ in batch}):
+                errors.append((source_path, err))
+        else:
+            for source_path, info, _ in batch:
+                if info.path in path_errors:
+                    errors.append((source_path, path_errors[info.path]))
+        return errors
+
     @staticmethod
     def _build_fileinfo(path: StrOrPath) -> 'pebble.FileInfo':
         """Constructs a FileInfo object by stat'ing a local path."""
@@ -1678,19 +2175,26 @@ class Container:
     @staticmethod
     def _list_recursive(list_func: Callable[[Path],
                         Iterable['pebble.FileInfo']],
-                        path: Path) -> Generator['pebble.FileInfo', None, None]:
+                        path: Path,
+                        executor: Optional['_ThreadPool'] = None,
+                        ) -> Generator['pebble.FileInfo', None, None]:
         """Recursively lists all files under path using the given list_func.
 
         Args:
             list_func: Function taking 1 Path argument that returns a list of FileInfo objects
                 representing files residing directly inside the given path.
             path: Filepath to recursively list.
+            executor: If given, directories are listed concurrently on it.  The files are
+                yielded in the same order either way.
         """
         if path.name == '*':
             # ignore trailing '/*' that we just use for determining how to build paths
             # at destination
             path = path.parent
 
+        if executor is not None:
+            list_func = Container._list_concurrently(list_func, path, executor)
+
         for info in list_func(path):
             if info.type is pebble.FileType.DIRECTORY:
                 yield from Container._list_recursive(list_func, Path(info.path))
@@ -1700,6 +2204,31 @@ class Container:
                 logger.debug(
                     'skipped unsupported file in Container.[push/pull]_path: %s', info.path)
 
+    @staticmethod
+    def _list_concurrently(list_func: Callable[[Path], Iterable['pebble.FileInfo']],
+                           path: Path, executor: '_ThreadPool'
+                           ) -> Callable[[Path], Iterable['pebble.FileInfo']]:
+        """List path and all directories below it on executor, a level of the tree at a time.
+
+        Returns a function that returns the listing of one of these directories, or raises
+        the error that listing it did.
+        """
+        listings = {}  # type: Dict[str, concurrent.futures.Future]
+        level = [path]
+        while level:
+            for dir_path in level:
+                listings[str(dir_path)] = executor.submit(list_func, dir_path)
+            next_level = []  # type: List[Path]
+            for dir_path in level:
+                try:
+                    infos = listings[str(dir_path)].result()
+                except Exception:
+                    continue  # raised again when the directory is walked
+                next_level.extend(Path(info.path) for info in infos
+                                  if info.type is pebble.FileType.DIRECTORY)
+            level = next_level
+        return lambda dir_path: listings[str(dir_path)].result()
+
     @staticmethod
     def _build_destpath(file_path: StrOrPath, source_path: StrOrPath, dest_dir: StrOrPath) -> Path:
         """Converts a source file and destination dir into a full destination filepath.
@@ -1993,6 +2522,74 @@ def _format_action_result_dict(input: Dict[str, 'JsonObject'],
     return output_
 
 
+class _HookToolCache:
+    """Caches the output of read-only hook tools for the duration of a dispatch.
+
+    Within a hook, Juju gives the charm a consistent snapshot of the model, so these tools
+    return the same output each time they're run with the same arguments, unless the charm
+    changes what they report itself; the backend invalidates entries when it does that.
+
+    The cache is used by the worker threads that prefetch relation data, so it's guarded
+    by a lock.
+
+    Attributes:
+        hits: The number of hook tool runs answered from the cache.
+        misses: The number of hook tool runs that weren't.
+    """
+
+    # is-leader isn't included: the backend caches it for the length of a lease instead.
+    # Neither is goal-state, which reports units as they come and go, even during a hook.
+    TOOLS = frozenset([
+        'config-get',
+        'network-get',
+        'relation-get',
+        'relation-ids',
+        'relation-list',
+        'resource-get',
+        'storage-get',
+        'storage-list',
+    ])
+
+    def __init__(self):
+        self._outputs = {}  # type: Dict[Tuple[str, ...], str]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, args: Tuple[str, ...]) -> Optional[str]:
+        """Return the cached output of running args, or None if there isn't any."""
+        with self._lock:
+            output = self._outputs.get(args)
+            if output is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return output
+
+    def put(self, args: Tuple[str, ...], output: str):
+        """Cache the output of running args, if args runs a cacheable tool."""
+        if args[0] in self.TOOLS:
+            with self._lock:
+                self._outputs[args] = output
+
+    def invalidate(self, *prefix: str):
+        """Forget the output of every run whose arguments start with prefix."""
+        n = len(prefix)
+        with self._lock:
+            for args in [args for args in self._outputs if args[:n] == prefix]:
+                del self._outputs[args]
+
+    def clear(self):
+        """Forget all cached output."""
+        with self._lock:
+            self._outputs.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Return the hit and miss counts, read together."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
 class _ModelBackend:
     """Represents the connection between the Model representation and talking to Juju.
 
@@ -2001,6 +2598,8 @@ class _ModelBackend:
     """
 
     LEASE_RENEWAL_PERIOD = datetime.timedelta(seconds=30)
+    # Linux limits a single argument to 128 KiB; stay well under it and the total limit.
+    _RELATION_SET_MAX_ARGS_LEN = 64 * 1024
     _STORAGE_KEY_RE = re.compile(
         r'.*^-s\s+\(=\s+(?P<storage_key>.*?)\)\s*?$',
         re.MULTILINE | re.DOTALL
@@ -2024,29 +2623,72 @@ class _ModelBackend:
         self._is_leader = None  # type: Optional[bool]
         self._leader_check_time = None
         self._hook_is_running = ''
+        self._tool_cache = _HookToolCache()
+        # Runs hook tools over the agent's socket, or None to start a process for each.
+        self._jujuc = jujuc.Client.from_environ()
+        # Relation data set but not yet written, by (relation ID, is_app).
+        self._relation_data_pending = {}  # type: Dict[Tuple[int, bool], Dict[str, str]]
 
     def _run(self, *args: str, return_output: bool = False, use_json: bool = False
              ) -> Union[str, 'JsonObject', None]:
+        if use_json:
+            args += ('--format=json',)
+        if args[0] != 'juju-log' and args[0] not in self._tool_cache.TOOLS:
+            # Other tools may change the unit, so first send buffered logging, to keep it
+            # in order with what they do.
+            self._flush_logs()
+        text = None
+        if return_output and args[0] in self._tool_cache.TOOLS:
+            text = self._tool_cache.get(args)
+        if text is None:
+            text = self._run_tool(args, return_output)
+            if return_output:
+                self._tool_cache.put(args, text)
+        if return_output:
+            # Output is cached undecoded, so every caller gets its own copy of JSON objects.
+            if use_json:
+                return json.loads(text)
+            return text
+
+    def _flush_logs(self):
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, ops.log.BufferedJujuLogHandler) and \
+                    handler.model_backend is self:
+                handler.flush()
+
+    def _run_tool(self, args: Tuple[str, ...], return_output: bool) -> str:
+        client = self._jujuc
+        if client is not None:
+            try:
+                code, stdout, stderr = client.run(args[0], args[1:])
+            except jujuc.CallError:
+                # Let the tool itself report why the agent refused to run it.
+                pass
+            except jujuc.SendError as e:
+                # The agent didn't get the call, so it's safe to run the tool instead. Disable
+                # the client before logging, as logging runs juju-log.
+                self._jujuc = None
+                client.close()
+                logger.debug('Cannot run hook tools through the agent socket: %s', e)
+            except jujuc.ProtocolError as e:
+                # The agent may have run the tool already, so it mustn't be run again.
+                raise ModelError('connection to the unit agent failed running {}: {}'.format(
+                    args[0], e)) from e
+            else:
+                if code != 0:
+                    raise ModelError(stderr)
+                return stdout.decode('utf8') if return_output else ''
         kwargs = dict(stdout=PIPE, stderr=PIPE, check=True)
         which_cmd = shutil.which(args[0])
         if which_cmd is None:
             raise RuntimeError('command not found: {}'.format(args[0]))
-        args = (which_cmd,) + args[1:]
-        if use_json:
-            args += ('--format=json',)
         try:
-            result = run(args, **kwargs)
+            result = run((which_cmd,) + args[1:], **kwargs)
         except CalledProcessError as e:
             raise ModelError(e.stderr)
-        if return_output:
-            if result.stdout is None:
-                return ''
-            else:
-                text = result.stdout.decode('utf8')
-                if use_json:
-                    return json.loads(text)
-                else:
-                    return text
+        if not return_output or result.stdout is None:
+            return ''
+        return result.stdout.decode('utf8')
 
     @staticmethod
     def _is_relation_not_found(model_error: Exception) -> bool:
@@ -2117,11 +2759,21 @@ class _ModelBackend:
 
         try:
             raw_data_content = self._run(*args, return_output=True, use_json=True)
-            return typing.cast('_RelationDataContent_Raw', raw_data_content)
         except ModelError as e:
             if self._is_relation_not_found(e):
                 raise RelationNotFoundError() from e
             raise
+        raw_data_content = typing.cast(Dict[str, str], raw_data_content)
+
+        # Changes made by this unit that haven't been written yet.
+        our_name = self.app_name if is_app else self.unit_name
+        if member_name == our_name:
+            for key, value in self._relation_data_pending.get((relation_id, is_app), {}).items():
+                if value == '':
+                    raw_data_content.pop(key, None)
+                else:
+                    raw_data_content[key] = value
+        return typing.cast('_RelationDataContent_Raw', raw_data_content)
 
     def relation_set(self, relation_id: int, key: str, value: str, is_app: bool):
         if not isinstance(is_app, bool):
@@ -2133,16 +2785,50 @@ class _ModelBackend:
                 raise RuntimeError(
                     'setting application data is not supported on Juju version {}'.format(version))
 
-        args = ['relation-set', '-r', str(relation_id), '{}={}'.format(key, value)]
-        if is_app:
-            args.append('--app')
+        # Written by relation_set_flush, with the rest of the bag's changes.
+        self._relation_data_pending.setdefault((relation_id, is_app), {})[key] = value
 
+    def relation_set_flush(self):
+        """Write the relation data set since the last flush, with one relation-set per bag.
+
+        Every bag is written even if writing another fails. The changes to bags that
+        couldn't be written are kept, and the first error is raised once all bags
+        have been tried.
+        """
+        error = None  # type: Optional[ModelError]
+        for bag in list(self._relation_data_pending):
+            relation_id, is_app = bag
+            member_name = self.app_name if is_app else self.unit_name
+            self._tool_cache.invalidate('relation-get', '-r', str(relation_id), '-', member_name)
+            try:
+                self._relation_set_many(relation_id, self._relation_data_pending[bag], is_app)
+            except ModelError as e:
+                if error is None:
+                    error = e
+                continue
+            del self._relation_data_pending[bag]
+        if error is not None:
+            if self._is_relation_not_found(error):
+                raise RelationNotFoundError() from error
+            raise error
+
+    def _relation_set_many(self, relation_id: int, data: Dict[str, str], is_app: bool):
+        args = ['relation-set', '-r', str(relation_id)]
+        app_args = ['--app'] if is_app else []
+        settings = ['{}={}'.format(key, value) for key, value in data.items()]
+        if sum(len(setting) for setting in settings) <= self._RELATION_SET_MAX_ARGS_LEN:
+            self._run(*args, *settings, *app_args)
+            return
+
+        # Too much to pass safely as arguments, so pass a file of settings instead.
+        tmpdir = Path(tempfile.mkdtemp('-relation-set'))
         try:
-            return self._run(*args)
-        except ModelError as e:
-            if self._is_relation_not_found(e):
-                raise RelationNotFoundError() from e
-            raise
+            settings_path = tmpdir / 'settings.yaml'
+            with settings_path.open("wt", encoding="utf8") as f:
+                yaml.safe_dump(data, stream=f)  # type: ignore
+            self._run(*args, '--file', str(settings_path), *app_args)
+        finally:
+            shutil.rmtree(str(tmpdir))
 
     def config_get(self):
         return self._run('config-get', return_output=True, use_json=True)
@@ -2263,6 +2949,7 @@ class _ModelBackend:
         if not isinstance(count, int) or isinstance(count, bool):
             raise TypeError('storage count must be integer, got: {} ({})'.format(count,
                                                                                  type(count)))
+        self._tool_cache.invalidate('storage-list', name)
         self._run('storage-add', '{}={}'.format(name, count))
 
     def action_get(self):
@@ -2357,6 +3044,10 @@ class _ModelBackend:
         # Planned units can be zero. We don't need to do error checking here.
         return len(app_state.get('units', []))
 
+    def tool_cache_stats(self) -> Dict[str, int]:
+        """Return how many hook tool runs were answered from the cache, and how many weren't."""
+        return self._tool_cache.stats()
+
 
 class _ModelBackendValidator:
     """Provides facilities for validating inputs and formatting them for model backends."""
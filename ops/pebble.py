@@ -25,6 +25,7 @@ import email.parser
 import enum
 import http.client
 import io
+import itertools
 import json
 import logging
 import os
@@ -33,6 +34,7 @@ import select
 import shutil
 import signal
 import socket
+import stat
 import sys
 import tempfile
 import threading
@@ -52,9 +54,44 @@ logger = logging.getLogger(__name__)
 _not_provided = object()
 
 
+class _PooledResponse(http.client.HTTPResponse):
+    """HTTPResponse that hands its connection back for reuse once the body has been read."""
+
+    _release = None  # type: typing.Optional[typing.Callable[[bool], None]]
+    _closed_early = False
+
+    def close(self):
+        """Close the response, discarding the connection if the body hasn't been read."""
+        self._closed_early = self.fp is not None
+        super().close()
+
+    def _close_conn(self):
+        # Called by HTTPResponse once the whole body has been read, or on close().
+        super()._close_conn()
+        release, self._release = self._release, None
+        if release is not None:
+            release(not self._closed_early and not self.will_close)
+
+
+class _FileRegion:
+    """Region of a regular file to send as part of a request body with sendfile()."""
+
+    def __init__(self, file: typing.BinaryIO, offset: int, count: int):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
 class _UnixSocketConnection(http.client.HTTPConnection):
     """Implementation of HTTPConnection that connects to a named Unix socket."""
 
+    response_class = _PooledResponse
+    # Whether any of the current request has been sent; the handler resets it for each one.
+    request_sent = False
+
     def __init__(self, host, timeout=_not_provided, socket_path=None):
         if timeout is _not_provided:
             super().__init__(host)
@@ -71,17 +108,98 @@ class _UnixSocketConnection(http.client.HTTPConnection):
         if self.timeout is not _not_provided:
             self.sock.settimeout(self.timeout)
 
+    def send(self, data):
+        """Override send to copy a _FileRegion straight from its file to the socket."""
+        if not isinstance(data, _FileRegion):
+            super().send(data)
+            self.request_sent = True
+            return
+        sent = self.sock.sendfile(data.file, data.offset, data.count)
+        if sent:
+            self.request_sent = True
+        if sent != data.count:
+            # The request body was framed for the full size, so it can't be completed.
+            raise OSError('file truncated while sending: sent {} of {} bytes'.format(
+                sent, data.count))
+
 
 class _UnixSocketHandler(urllib.request.AbstractHTTPHandler):
-    """Implementation of HTTPHandler that uses a named Unix socket."""
+    """Implementation of HTTPHandler that uses a named Unix socket.
 
-    def __init__(self, socket_path):
+    Connections are kept alive and reused by later requests, keeping up to max_idle of them
+    open between requests. The handler can be used from several threads at once.
+    """
+
+    # Errors sending a request on a connection that the server has closed in the meantime.
+    _stale_errors = (BrokenPipeError, ConnectionAbortedError, ConnectionResetError)
+    # Methods that can be sent again even if the server may have acted on them already.
+    _idempotent_methods = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+    def __init__(self, socket_path, max_idle=4):
         super().__init__()
         self.socket_path = socket_path
+        self.max_idle = max_idle
+        self._idle = []  # type: typing.List[_UnixSocketConnection]
+        self._lock = threading.Lock()
 
     def http_open(self, req):
-        """Override http_open to use a Unix socket connection (instead of TCP)."""
-        return self.do_open(_UnixSocketConnection, req, socket_path=self.socket_path)
+        """Override http_open to use a pooled Unix socket connection (instead of TCP)."""
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers = {name.title(): val for name, val in headers.items()}
+        # A generator body is consumed when sent, so the request can't be retried.
+        retryable = req.data is None or isinstance(req.data, bytes)
+        idempotent = req.get_method() in self._idempotent_methods
+        while True:
+            conn, reused = self._acquire(req.host, req.timeout)
+            conn.request_sent = False
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers)
+                response = conn.getresponse()
+            except OSError as e:
+                conn.close()
+                # Other requests are only sent again if none of them reached the server,
+                # which may otherwise have acted on them (starting a service twice, say).
+                if (reused and retryable and isinstance(e, self._stale_errors)
+                        and (idempotent or not conn.request_sent)):
+                    continue
+                raise urllib.error.URLError(e)
+            break
+
+        response._release = lambda reusable: self._release(conn, reusable)
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+    def _acquire(self, host, timeout):
+        """Return an idle connection, or a new one, and whether it was used before."""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = _UnixSocketConnection(host, timeout=timeout, socket_path=self.socket_path)
+            return conn, False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            if select.select([conn.sock], [], [], 0)[0]:
+                # An idle connection has nothing to read unless the server has closed it.
+                conn.close()
+            else:
+                conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release(self, conn, reusable):
+        with self._lock:
+            if reusable and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close the connections kept open for reuse."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
 
 
 # Matches yyyy-mm-ddTHH:MM:SS(.sss)ZZZ
@@ -792,6 +910,20 @@ class Check:
         ]
         return {name: value for name, value in fields if value}
 
+    def _merge(self, other: 'Check'):
+        """Merges this check object with another check definition.
+
+        For attributes present in both objects, the passed in check
+        attributes take precedence.
+        """
+        for name, value in other.__dict__.items():
+            if not value or name == 'name' or value is CheckLevel.UNSET:
+                continue
+            if name in ['http', 'tcp', 'exec'] and getattr(self, name) is not None:
+                getattr(self, name).update(copy.deepcopy(value))
+            else:
+                setattr(self, name, copy.deepcopy(value))
+
     def __repr__(self) -> str:
         return 'Check({!r})'.format(self.to_dict())
 
@@ -1251,13 +1383,24 @@ class _WebsocketReader(io.BufferedIOBase):
 class Client:
     """Pebble API client."""
 
-    _chunk_size = 8192
+    # Fixed size of the chunks file content is read in, or None to size them adaptively.
+    _chunk_size = None  # type: typing.Optional[int]
 
-    def __init__(self, socket_path=None, opener=None, base_url='http://localhost', timeout=5.0):
+    # Adaptive chunks start at the min size and double with each chunk up to the max size.
+    _min_chunk_size = 8192
+    _max_chunk_size = 256 * 1024
+
+    def __init__(self, socket_path=None, opener=None, base_url='http://localhost', timeout=5.0,
+                 chunk_size=None):
         """Initialize a client instance.
 
         Defaults to using a Unix socket at socket_path (which must be specified
         unless a custom opener is provided).
+
+        File content is pushed and pulled in chunks of chunk_size bytes. By
+        default, the chunks start small and grow as a transfer goes on, so
+        that large files take few iterations without small files using large
+        buffers.
         """
         if opener is None:
             if socket_path is None:
@@ -1267,6 +1410,27 @@ class Client:
         self.opener = opener
         self.base_url = base_url
         self.timeout = timeout
+        self._chunk_size = self._check_chunk_size(chunk_size)
+
+    @staticmethod
+    def _check_chunk_size(chunk_size: typing.Optional[int]) -> typing.Optional[int]:
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError('chunk_size must be positive, got {!r}'.format(chunk_size))
+        return chunk_size
+
+    def _chunk_sizes(self, chunk_size: typing.Optional[int] = None) -> typing.Iterator[int]:
+        """Return the sizes of the successive chunks to read in a transfer.
+
+        The chunk_size given for the call, or else the client's, is used for all chunks;
+        without either, the chunks double in size from _min_chunk_size to _max_chunk_size.
+        """
+        chunk_size = self._check_chunk_size(chunk_size) or self._chunk_size
+        if chunk_size is not None:
+            return itertools.repeat(chunk_size)
+        growing = itertools.takewhile(
+            lambda size: size < self._max_chunk_size,
+            (self._min_chunk_size << i for i in itertools.count()))
+        return itertools.chain(growing, itertools.repeat(self._max_chunk_size))
 
     @classmethod
     def _get_default_opener(cls, socket_path):
@@ -1278,6 +1442,15 @@ class Client:
         opener.add_handler(urllib.request.HTTPErrorProcessor())
         return opener
 
+    def close(self):
+        """Close the connections to the Pebble server that are kept open for reuse.
+
+        The client can still be used after this; it will open new connections as needed.
+        """
+        for handler in getattr(self.opener, 'handlers', []):
+            if isinstance(handler, _UnixSocketHandler):
+                handler.close()
+
     def _request(
         self, method: str, path: str, query: typing.Dict = None, body: typing.Dict = None,
     ) -> typing.Dict:
@@ -1630,14 +1803,21 @@ class Client:
     def pull(self,
              path: str,
              *,
-             encoding: typing.Optional[str] = 'utf-8') -> typing.Union[typing.BinaryIO,
-                                                                       typing.TextIO]:
+             encoding: typing.Optional[str] = 'utf-8',
+             stream: bool = False,
+             chunk_size: int = None) -> typing.Union[typing.BinaryIO, typing.TextIO]:
         """Read a file's content from the remote system.
 
         Args:
             path: Path of the file to read from the remote system.
             encoding: Encoding to use for decoding the file's bytes to str,
                 or None to specify no decoding.
+            stream: If True, read the content straight from the response as
+                it is read from the returned file, rather than first saving it
+                to a temporary file. The file should then be read to the end or
+                closed promptly, as it holds on to the connection to Pebble.
+            chunk_size: Size in bytes of the chunks to read the response in,
+                overriding the client's.
 
         Returns:
             A readable file-like object, whose read() method will return str
@@ -1656,10 +1836,18 @@ class Client:
         if not boundary:
             raise ProtocolError('invalid boundary {!r}'.format(boundary))
 
+        chunk_sizes = self._chunk_sizes(chunk_size)
+        if stream:
+            reader = io.BufferedReader(_FileStream(self, response, boundary, path, chunk_sizes))
+            if encoding is None:
+                return reader
+            # newline='' serves the line endings as-is, as for non-streamed pulls.
+            return io.TextIOWrapper(reader, encoding=encoding, newline='')
+
         parser = _FilesParser(boundary)
 
-        while True:
-            chunk = response.read(self._chunk_size)
+        for size in chunk_sizes:
+            chunk = response.read(size)
             if not chunk:
                 break
             parser.feed(chunk)
@@ -1691,6 +1879,95 @@ class Client:
         parser.remove_files()
         return f
 
+    def pull_to(self, path: str, dest: typing.Union[str, 'os.PathLike'], *,
+                chunk_size: int = None):
+        """Read a file from the remote system, writing its content to a local file.
+
+        The content is written to dest as it arrives, without being buffered
+        in a temporary file first. The local file is only created (or
+        truncated) if the remote file can be read.
+
+        Args:
+            path: Path of the file to read from the remote system.
+            dest: Path of the local file to write to.
+            chunk_size: Size in bytes of the chunks to read the response in,
+                overriding the client's.
+        """
+        errors = self.pull_many([path], lambda _: open(str(dest), 'wb'), chunk_size=chunk_size)
+        if path in errors:
+            raise errors[path]
+
+    def pull_many(
+            self, paths: typing.Iterable[str],
+            open_file: typing.Callable[[str], typing.BinaryIO], *,
+            chunk_size: int = None) -> typing.Dict[str, PathError]:
+        """Read several files from the remote system in a single request.
+
+        The content of each file is written out as it arrives, without
+        buffering the files locally.
+
+        Args:
+            paths: Paths of the files to read from the remote system.
+            open_file: Called with the path of each file read, just before its
+                content arrives. It must return a writable binary file-like
+                object to write the content to, which is closed once all of it
+                has been written.
+            chunk_size: Size in bytes of the chunks to read the response in,
+                overriding the client's.
+
+        Returns:
+            A dict mapping the path of each file that couldn't be read to the
+            :class:`PathError` for it; empty if all files were read.
+        """
+        paths = list(paths)
+        if not paths:
+            return {}
+        query = {
+            'action': 'read',
+            'path': paths,
+        }
+        headers = {'Accept': 'multipart/form-data'}
+        expected = set(paths)
+
+        def open_expected(filename: str) -> typing.BinaryIO:
+            # Check the name before creating anything for it.
+            if filename not in expected:
+                raise ProtocolError('path not expected: {!r}'.format(filename))
+            return open_file(filename)
+
+        response = self._request_raw('GET', '/v1/files', query, headers)
+        parser = None
+        try:
+            options = self._ensure_content_type(response.headers, 'multipart/form-data')
+            boundary = options.get('boundary', '')
+            if not boundary:
+                raise ProtocolError('invalid boundary {!r}'.format(boundary))
+
+            parser = _FilesParser(boundary, open_file=open_expected)
+
+            for size in self._chunk_sizes(chunk_size):
+                chunk = response.read(size)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+        finally:
+            # If the body ended early or was invalid, a file may still be open.
+            if parser is not None:
+                parser.close_files()
+            response.close()
+
+        resp = parser.get_response()
+        if resp is None:
+            raise ProtocolError('no "response" field in multipart body')
+
+        errors = {}
+        for path in paths:
+            try:
+                self._raise_on_path_error(resp, path)
+            except PathError as e:
+                errors[path] = e
+        return errors
+
     @staticmethod
     def _raise_on_path_error(resp, path):
         result = resp['result'] or []  # in case it's null instead of []
@@ -1704,7 +1981,8 @@ class Client:
     def push(
             self, path: str, source: typing.Union[bytes, str, typing.BinaryIO, typing.TextIO], *,
             encoding: str = 'utf-8', make_dirs: bool = False, permissions: int = None,
-            user_id: int = None, user: str = None, group_id: int = None, group: str = None):
+            user_id: int = None, user: str = None, group_id: int = None, group: str = None,
+            chunk_size: int = None):
         """Write content to a given file path on the remote system.
 
         Args:
@@ -1723,26 +2001,81 @@ class Client:
             group_id: Group ID (GID) for file.
             group: Group name for file. Group's GID must match group_id if
                 both are specified.
+            chunk_size: Size of the chunks to read a file-like source in,
+                overriding the client's.
         """
         info = self._make_auth_dict(permissions, user_id, user, group_id, group)
         info['path'] = path
         if make_dirs:
             info['make-dirs'] = True
+        resp = self._push_files([info], [source], encoding, chunk_size)
+        self._raise_on_path_error(resp, path)
+
+    def push_many(
+            self, files: typing.Iterable[typing.Dict[str, typing.Any]], *,
+            encoding: str = 'utf-8', chunk_size: int = None) -> typing.Dict[str, PathError]:
+        """Write several files on the remote system in a single request.
+
+        The content of each file is streamed in turn, so file-like sources are
+        only read once the request gets to them.
+
+        Args:
+            files: The files to write. Each is a dict with the ``path`` and
+                ``source`` arguments of :meth:`push`, and optionally any of its
+                ``make_dirs``, ``permissions``, ``user_id``, ``user``,
+                ``group_id`` and ``group`` arguments.
+            encoding: Encoding to use for encoding str sources to bytes, as in
+                :meth:`push`.
+            chunk_size: Size of the chunks to read file-like sources in, as in
+                :meth:`push`.
+
+        Returns:
+            A dict mapping the path of each file that couldn't be written to
+            the :class:`PathError` for it; empty if all files were written.
+        """
+        infos, sources = [], []
+        for file in files:
+            info = self._make_auth_dict(
+                file.get('permissions'), file.get('user_id'), file.get('user'),
+                file.get('group_id'), file.get('group'))
+            info['path'] = file['path']
+            if file.get('make_dirs'):
+                info['make-dirs'] = True
+            infos.append(info)
+            sources.append(file['source'])
+        if not infos:
+            return {}
+
+        resp = self._push_files(infos, sources, encoding, chunk_size)
+        errors = {}
+        for info in infos:
+            try:
+                self._raise_on_path_error(resp, info['path'])
+            except PathError as e:
+                errors[info['path']] = e
+        return errors
+
+    def _push_files(self, infos, sources, encoding, chunk_size=None) -> typing.Dict:
+        """Send a write request for the given file infos and sources; return the response."""
         metadata = {
             'action': 'write',
-            'files': [info],
+            'files': infos,
         }
-
-        data, content_type = self._encode_multipart(metadata, path, source, encoding)
+        paths = [info['path'] for info in infos]
+        sendfile = self._can_sendfile()
+        data, content_type = self._encode_multipart(
+            metadata, paths, sources, encoding, sendfile=sendfile, chunk_size=chunk_size)
 
         headers = {
             'Accept': 'application/json',
             'Content-Type': content_type,
         }
+        if sendfile:
+            # The body is framed by _encode_multipart rather than by http.client.
+            headers['Transfer-Encoding'] = 'chunked'
         response = self._request_raw('POST', '/v1/files', None, headers, data)
         self._ensure_content_type(response.headers, 'application/json')
-        resp = _json_loads(response.read())
-        self._raise_on_path_error(resp, path)
+        return _json_loads(response.read())
 
     @staticmethod
     def _make_auth_dict(permissions, user_id, user, group_id, group) -> typing.Dict:
@@ -1759,46 +2092,90 @@ class Client:
             d['group'] = group
         return d
 
-    def _encode_multipart(self, metadata, path, source, encoding):
+    def _can_sendfile(self) -> bool:
+        """Report whether request bodies can include _FileRegions to send with sendfile()."""
+        # Python 3.5 urllib joins generator bodies into bytes (see _request_raw).
+        if sys.version_info[:2] < (3, 6):
+            return False
+        handlers = getattr(getattr(self, 'opener', None), 'handlers', [])
+        return any(isinstance(handler, _UnixSocketHandler) for handler in handlers)
+
+    @staticmethod
+    def _file_region(source) -> typing.Optional[_FileRegion]:
+        """Return the rest of a binary file source as a _FileRegion, or None if not possible.
+
+        Only regular files have a size known up front and can be sent with sendfile().
+        """
+        if isinstance(source, (str, bytes, io.TextIOBase)):
+            return None
+        try:
+            fd = source.fileno()
+            offset = source.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return _FileRegion(source, offset, max(0, st.st_size - offset))
+
+    def _encode_multipart(self, metadata, paths, sources, encoding, sendfile=False,
+                          chunk_size=None):
+        """Return a generator of the multipart body writing the files, and its content type.
+
+        With sendfile, the content of regular binary files is yielded as a _FileRegion, and the
+        body is encoded in HTTP chunks here, as http.client can't frame a _FileRegion itself.
+        """
         # Python's stdlib mime/multipart handling is screwy and doesn't handle
         # binary properly, so roll our own.
 
-        if isinstance(source, str):
-            source = io.StringIO(source)
-        elif isinstance(source, bytes):
-            source = io.BytesIO(source)
-
         boundary = binascii.hexlify(os.urandom(16))
-        path_escaped = path.replace('"', '\\"').encode('utf-8')  # NOQA: test_quote_backslashes
         content_type = 'multipart/form-data; boundary="' + boundary.decode('utf-8') + '"'
 
         def generator():
-            yield b''.join([
+            header = [
                 b'--', boundary, b'\r\n',
                 b'Content-Type: application/json\r\n',
                 b'Content-Disposition: form-data; name="request"\r\n',
                 b'\r\n',
                 json.dumps(metadata).encode('utf-8'), b'\r\n',
-                b'--', boundary, b'\r\n',
-                b'Content-Type: application/octet-stream\r\n',
-                b'Content-Disposition: form-data; name="files"; filename="',
-                path_escaped, b'"\r\n',
-                b'\r\n',
-            ])
-
-            content = source.read(self._chunk_size)
-            while content:
-                if isinstance(content, str):
-                    content = content.encode(encoding)
-                yield content
-                content = source.read(self._chunk_size)
-
-            yield b''.join([
-                b'\r\n',
+            ]
+            for path, source in zip(paths, sources):
+                if isinstance(source, str):
+                    source = io.StringIO(source)
+                elif isinstance(source, bytes):
+                    source = io.BytesIO(source)
+                path_escaped = path.replace('"', '\\"').encode('utf-8')  # NOQA: test_quote_backslashes
+                yield b''.join(header + [
+                    b'--', boundary, b'\r\n',
+                    b'Content-Type: application/octet-stream\r\n',
+                    b'Content-Disposition: form-data; name="files"; filename="',
+                    path_escaped, b'"\r\n',
+                    b'\r\n',
+                ])
+                header = [b'\r\n']
+
+                region = self._file_region(source) if sendfile else None
+                if region is not None:
+                    # sendfile() leaves the source at the end of the region, so reading on
+                    # sends whatever was appended since, and reaching the end lets sources
+                    # that close themselves once read to the end do so straight away.
+                    yield region
+                # Read sources that aren't regular binary files in chunks.
+                for size in self._chunk_sizes(chunk_size):
+                    content = source.read(size)
+                    if not content:
+                        break
+                    if isinstance(content, str):
+                        content = content.encode(encoding)
+                    yield content
+
+            yield b''.join(header + [
                 b'--', boundary, b'--\r\n',
             ])
 
-        return generator(), content_type
+        if not sendfile:
+            return generator(), content_type
+        return _encode_chunked(generator()), content_type
 
     def list_files(self, path: str, *, pattern: str = None,
                    itself: bool = False) -> typing.List[FileInfo]:
@@ -2181,12 +2558,88 @@ class Client:
         return [CheckInfo.from_dict(info) for info in resp['result']]
 
 
+class _FileStream(io.RawIOBase):
+    """Raw binary stream of the content of a single file pulled, parsed as it's read."""
+
+    class _Sink:
+        """Writable file that the parser writes the file's content to."""
+
+        def __init__(self, buffer: bytearray):
+            self.write = buffer.extend
+
+        def close(self):
+            pass
+
+    def __init__(self, client: Client, response: http.client.HTTPResponse,
+                 boundary: typing.Union[bytes, str], path: str,
+                 chunk_sizes: typing.Iterator[int]):
+        super().__init__()
+        self._client = client
+        self._response = response
+        self._chunk_sizes = chunk_sizes
+        self._path = path
+        self._buffer = bytearray()
+        self._opened = False
+        self._eof = False
+        self._parser = _FilesParser(boundary, open_file=self._open_file)
+        # Read up to the start of the file's content, so that errors are raised right away.
+        while not self._opened and not self._eof:
+            self._read_chunk()
+
+    def _open_file(self, filename: str) -> '_FileStream._Sink':
+        if filename != self._path:
+            raise ProtocolError('path not expected: {!r}'.format(filename))
+        if self._opened:
+            raise ProtocolError('single file request resulted in a multi-file response')
+        self._opened = True
+        return self._Sink(self._buffer)
+
+    def _read_chunk(self):
+        chunk = self._response.read(next(self._chunk_sizes))
+        if chunk:
+            self._parser.feed(chunk)
+            return
+
+        self._eof = True
+        resp = self._parser.get_response()
+        if resp is None:
+            raise ProtocolError('no "response" field in multipart body')
+        self._client._raise_on_path_error(resp, self._path)
+        if not self._opened:
+            raise ProtocolError('no file content in multipart response')
+
+    def readable(self) -> bool:
+        """Report that the stream can be read, which it can."""
+        return True
+
+    def readinto(self, b) -> int:
+        """Read the next bytes of the file's content into b; return how many were read."""
+        while not self._buffer and not self._eof:
+            self._read_chunk()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        del self._buffer[:n]
+        return n
+
+    def close(self):
+        """Close the stream, and the response it reads from."""
+        if not self.closed:
+            self._response.close()
+        super().close()
+
+
 class _FilesParser:
-    """A limited purpose multi-part parser backed by files for memory efficiency."""
+    """A limited purpose multi-part parser backed by files for memory efficiency.
 
-    def __init__(self, boundary: typing.Union[bytes, str]):
+    The files are written to temporary files, unless open_file is given; then it's called
+    with the path of each file to get the writable binary file object to write it to.
+    """
+
+    def __init__(self, boundary: typing.Union[bytes, str],
+                 open_file: typing.Callable[[str], typing.BinaryIO] = None):
         self._response = None
         self._files = {}
+        self._open_file = open_file
 
         # Prepare the MIME multipart boundary line patterns.
         if isinstance(boundary, str):
@@ -2252,6 +2705,12 @@ class _FilesParser:
                 outfile = self._get_open_tempfile()
                 outfile.write(data)
 
+    def close_files(self):
+        """Close any file whose content didn't arrive in full."""
+        for file in self._files.values():
+            if not file.closed:
+                file.close()
+
     def remove_files(self):
         """Remove all temporary files on disk."""
         for file in self._files.values():
@@ -2263,7 +2722,10 @@ class _FilesParser:
         self._parser.feed(data)
 
     def _prepare_tempfile(self, filename):
-        tf = tempfile.NamedTemporaryFile(delete=False)
+        if self._open_file is not None:
+            tf = self._open_file(filename)
+        else:
+            tf = tempfile.NamedTemporaryFile(delete=False)
         self._files[filename] = tf
         self.current_filename = filename
 
@@ -2287,6 +2749,21 @@ class _FilesParser:
         return open(self._files[path].name, mode, encoding=encoding, newline=newline)
 
 
+def _encode_chunked(parts):
+    """Encode a request body in HTTP/1.1 chunks, one for each part of it."""
+    for part in parts:
+        if not len(part):
+            continue
+        size = '{:X}\r\n'.format(len(part)).encode('ascii')
+        if isinstance(part, _FileRegion):
+            yield size
+            yield part
+            yield b'\r\n'
+        else:
+            yield b''.join([size, part, b'\r\n'])
+    yield b'0\r\n\r\n'
+
+
 class _MultipartParser:
     def __init__(
             self,
@@ -2320,6 +2797,7 @@ class _MultipartParser:
 
         self._buf = bytearray()
         self._pos = 0  # current position in buf
+        self._in_body = False  # whether pos is within a part body (as opposed to before a header)
         self._done = False  # whether we have found the terminal boundary and are done parsing
         self._header_terminator = b'\r\n\r\n'
 
@@ -2340,47 +2818,70 @@ class _MultipartParser:
         if self._done:
             return
         self._buf.extend(data)
+        try:
+            self._parse()
+        finally:
+            self._compact()
 
+    def _parse(self):
+        buf = self._buf
         while True:
-            # seek to a boundary if we aren't already on one
-            i, n, self._done = _next_part_boundary(self._buf, self._marker)
-            if i == -1 or self._done:
-                return  # waiting for more data or terminal boundary reached
-
-            if self._pos == 0:
-                # parse the part header
-                if self._max_lookahead and len(self._buf) - self._pos > self._max_lookahead:
-                    raise ProtocolError('header terminator not found')
-                term_index = self._buf.find(self._header_terminator)
+            if not self._in_body:
+                # seek to a boundary if we aren't already on one
+                i, n, self._done = _next_part_boundary(buf, self._marker, start=self._pos)
+                if i == -1:
+                    # Skip leading garbage, but keep what may be the start of a boundary.
+                    self._pos = max(self._pos, len(buf) - self._max_boundary_length)
+                    return  # waiting for more data
+                self._pos = i
+                if self._done:
+                    return  # terminal boundary reached
+
+                # parse the part header; the boundary's CRLF may also start an empty header's
+                # terminator.
+                term_index = buf.find(self._header_terminator, i + n - 2)
                 if term_index == -1:
+                    if self._max_lookahead and len(buf) - i > self._max_lookahead:
+                        raise ProtocolError('header terminator not found')
                     return  # waiting for more data
 
                 start = i + n
                 # data includes the double CRLF at the end of the header.
                 end = term_index + len(self._header_terminator)
 
-                self._handle_header(self._buf[start:end])
+                self._handle_header(bytes(buf[start:end]))
                 self._pos = end
+                self._in_body = True
             else:
                 # parse the part body
-                ii, nn, self._done = _next_part_boundary(self._buf, self._marker, start=self._pos)
-                safe_bound = max(0, len(self._buf) - self._max_boundary_length)
+                ii, _, self._done = _next_part_boundary(buf, self._marker, start=self._pos)
                 if ii != -1:
                     # part body is finished
-                    self._handle_body(self._buf[self._pos:ii], done=True)
-                    self._buf = self._buf[ii:]
-                    self._pos = 0
+                    self._emit_body(self._pos, ii, done=True)
+                    self._pos = ii
+                    self._in_body = False
                     if self._done:
                         return  # terminal boundary reached
-                elif safe_bound > self._pos:
-                    # write partial body data
-                    data = self._buf[self._pos:safe_bound]
-                    self._pos = safe_bound
-                    self._handle_body(data)
-                    return  # waiting for more data
                 else:
+                    # write partial body data, holding back what may be the start of a boundary
+                    safe_bound = len(buf) - self._max_boundary_length
+                    if safe_bound > self._pos:
+                        self._emit_body(self._pos, safe_bound)
+                        self._pos = safe_bound
                     return  # waiting for more data
 
+    def _emit_body(self, start: int, end: int, done: bool = False):
+        # Hand out a view rather than a copy; it's released before the buffer is resized.
+        with memoryview(self._buf) as view, view[start:end] as data:
+            self._handle_body(data, done=done)
+
+    def _compact(self):
+        # Consumed data is dropped once it makes up at least half of the buffer, so the cost
+        # of moving the remaining bytes is amortized over the data consumed.
+        if self._pos and self._pos >= len(self._buf) // 2:
+            del self._buf[:self._pos]
+            self._pos = 0
+
 
 def _next_part_boundary(buf, marker, start=0):
     """Returns the index of the next boundary marker in buf beginning at start.
@@ -2392,25 +2893,26 @@ def _next_part_boundary(buf, marker, start=0):
     suffix = b'\r\n'
     terminal_midfix = b'--'
 
-    i = buf.find(prefix, start)
-    if i == -1:
-        return -1, -1, False
-
-    pos = i + len(prefix)
-    is_terminal = False
-    if buf[pos:].startswith(terminal_midfix):
-        is_terminal = True
-        pos += len(terminal_midfix)
-
-    # Note: RFC 2046 notes optional "linear whitespace" (e.g. [ \t]) after the boundary pattern
-    # and the optional "--" suffix.
-    tail = buf[pos:]
-    for c in tail:
-        if c not in b' \t':
-            break
-        pos += 1
-
-    if buf[pos:].startswith(suffix):
-        pos += len(suffix)
-        return i, pos - i, is_terminal
-    return -1, -1, False
+    while True:
+        i = buf.find(prefix, start)
+        if i == -1:
+            return -1, -1, False
+
+        pos = i + len(prefix)
+        is_terminal = False
+        if buf.startswith(terminal_midfix, pos):
+            is_terminal = True
+            pos += len(terminal_midfix)
+
+        # Note: RFC 2046 notes optional "linear whitespace" (e.g. [ \t]) after the boundary
+        # pattern and the optional "--" suffix.
+        while pos < len(buf) and buf[pos] in b' \t':
+            pos += 1
+
+        if buf.startswith(suffix, pos):
+            pos += len(suffix)
+            return i, pos - i, is_terminal
+        if pos >= len(buf) - 1:
+            # The boundary may yet be completed by data not received so far.
+            return -1, -1, False
+        start = i + 1
@@ -14,13 +14,16 @@
 
 """Structures to offer storage to the charm (through Juju or locally)."""
 
+import base64
+import json
+import marshal
 import pickle
 import shutil
 import sqlite3
 import subprocess
 import typing
 from datetime import timedelta
-from typing import Any, Callable, Generator, List, Optional, Tuple, Type, Union
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Type, Union
 
 import yaml
 
@@ -30,6 +33,8 @@ if typing.TYPE_CHECKING:
     # _Notice = Tuple[event_path, observer_path, method_name]
     _Notice = Tuple[str, str, str]
     _Notices = List[_Notice]
+    # _NoticeChunks = List[Tuple[chunk_id, notices]]
+    _NoticeChunks = List[Tuple[int, _Notices]]
 
     # This is a function that takes a Tuple and returns a yaml node.
     # it replaces a method, so the first argument passed to the function
@@ -45,17 +50,200 @@ def _run(args: List[str], **kw: Any):
     return subprocess.run([cmd, *args[1:]], **kw)
 
 
+class SnapshotCodec:
+    """Base class for the ways snapshot data can be encoded in storage.
+
+    Encoding must also validate the data, raising ValueError if it contains anything but
+    simple types. Each codec has a unique name, which is recorded with the data it encodes
+    so that it can be decoded later even if the storage has switched to another codec.
+    """
+
+    name = ''  # type: str
+
+    # Whether the encoded data may be arbitrary bytes rather than ASCII text.
+    binary = True
+
+    def encode(self, data: Any) -> bytes:
+        """Return the encoded data.
+
+        Raises:
+            ValueError: if data contains values of a type that can't be stored.
+        """
+        raise NotImplementedError()
+
+    def decode(self, raw: bytes) -> Any:
+        """Return the data from its encoded form."""
+        raise NotImplementedError()
+
+
+class PickleCodec(SnapshotCodec):
+    """Binary codec, using :mod:`pickle` with a fixed protocol.
+
+    This is the default for :class:`SQLiteStorage`. The data is first passed through
+    :mod:`marshal`, which accepts exactly the types that the framework allows in snapshots,
+    to validate it. Pickle's protocols are documented and stay readable by later versions
+    of Python, so the data outlives interpreter upgrades, such as series upgrades.
+    """
+
+    name = 'pickle'
+
+    # Fixed, rather than pickle.DEFAULT_PROTOCOL, so that it can be read by any supported
+    # Python.
+    PROTOCOL = 4
+
+    def encode(self, data: Any) -> bytes:
+        """Return the encoded data."""
+        marshal.dumps(data)
+        return pickle.dumps(data, protocol=self.PROTOCOL)
+
+    def decode(self, raw: bytes) -> Any:
+        """Return the data from its encoded form."""
+        return pickle.loads(raw)
+
+
+class MarshalCodec(SnapshotCodec):
+    """Compact binary codec, using :mod:`marshal`.
+
+    It accepts exactly the types that the framework allows in snapshots, so validation
+    is free, and it's faster than :class:`PickleCodec`. However, marshal's format isn't
+    documented and may change between Python versions, so the data may not be readable
+    once the charm runs on another Python, for example after a series upgrade. Only use
+    it for storage that doesn't need to outlive the interpreter.
+    """
+
+    name = 'marshal'
+
+    # Fixed, rather than marshal.version, so that it can be read by any supported Python.
+    VERSION = 4
+
+    def encode(self, data: Any) -> bytes:
+        """Return the encoded data."""
+        return marshal.dumps(data, self.VERSION)
+
+    def decode(self, raw: bytes) -> Any:
+        """Return the data from its encoded form."""
+        return marshal.loads(raw)
+
+
+class JSONCodec(SnapshotCodec):
+    """Text codec, producing JSON that can be stored in Juju.
+
+    This is the default for :class:`JujuStorage`. Values JSON can't represent directly
+    (tuples, sets, bytes, and dicts whose keys aren't all strings) are wrapped in an
+    object with a single tag key, such as ``{"__set__": [1, 2]}``.
+    """
+
+    name = 'json'
+    binary = False
+
+    _TAGS = ('__tuple__', '__set__', '__bytes__', '__dict__')
+
+    def encode(self, data: Any) -> bytes:
+        """Return the encoded data."""
+        return json.dumps(self._tag(data), separators=(',', ':')).encode('ascii')
+
+    def decode(self, raw: bytes) -> Any:
+        """Return the data from its encoded form."""
+        return json.loads(raw.decode('ascii'), object_hook=self._untag)
+
+    def _tag(self, value: Any) -> Any:
+        # Like marshal, only accept the exact types and not subclasses.
+        t = type(value)
+        if value is None or t is bool or t is int or t is float or t is str:
+            return value
+        if t is list:
+            return [self._tag(v) for v in value]
+        if t is dict:
+            if (all(type(k) is str for k in value)
+                    and not (len(value) == 1 and next(iter(value)) in self._TAGS)):
+                return {k: self._tag(v) for k, v in value.items()}
+            return {'__dict__': [[self._tag(k), self._tag(v)] for k, v in value.items()]}
+        if t is tuple:
+            return {'__tuple__': [self._tag(v) for v in value]}
+        if t is set:
+            return {'__set__': [self._tag(v) for v in value]}
+        if t is bytes:
+            return {'__bytes__': base64.b64encode(value).decode('ascii')}
+        raise ValueError('unsupported type {}'.format(t.__name__))
+
+    def _untag(self, obj: Dict[str, Any]) -> Any:
+        if len(obj) != 1:
+            return obj
+        tag, value = next(iter(obj.items()))
+        if tag == '__tuple__':
+            return tuple(value)
+        if tag == '__set__':
+            return set(value)
+        if tag == '__bytes__':
+            return base64.b64decode(value)
+        if tag == '__dict__':
+            return {k: v for k, v in value}
+        return obj
+
+
+# Saved in place of the data of a snapshot whose top-level keys are stored separately;
+# see update_snapshot. It can't be mistaken for a codec header, as it has no name.
+_KEYED_SNAPSHOT = b'#\n'
+
+# Codecs that data may have been saved with, by name.
+_codecs = {codec.name: codec for codec in (PickleCodec(), MarshalCodec(), JSONCodec())}
+
+
+def _encode_snapshot(codec: SnapshotCodec, data: Any) -> bytes:
+    """Encode snapshot data, prefixed with a header that names the codec used."""
+    return '#{}\n'.format(codec.name).encode('ascii') + codec.encode(data)
+
+
+def _split_snapshot(codec: SnapshotCodec, raw: bytes) -> Tuple[SnapshotCodec, bytes]:
+    """Return the codec that raw was encoded with, and the encoded data after the header.
+
+    Raises:
+        ValueError: if raw has no header, or names a codec that isn't known.
+    """
+    if raw[:1] != b'#':
+        raise ValueError('snapshot data has no codec header')
+    header, _, payload = raw.partition(b'\n')
+    name = header[1:].decode('ascii')
+    if name != codec.name:
+        codec = _codecs.get(name)
+        if codec is None:
+            raise ValueError('snapshot data saved with unknown codec {!r}'.format(name))
+    return codec, payload
+
+
+def _decode_snapshot(codec: SnapshotCodec, raw: bytes) -> Any:
+    """Decode snapshot data encoded by _encode_snapshot, with codec or the one it names."""
+    codec, payload = _split_snapshot(codec, raw)
+    return codec.decode(payload)
+
+
 class SQLiteStorage:
-    """Storage using SQLite backend."""
+    """Storage using SQLite backend.
+
+    Args:
+        filename: path of the database file, or ':memory:'.
+        wal: if True, use SQLite's write-ahead log with ``synchronous=NORMAL`` instead of
+            the default rollback journal. This makes writes cheaper, at the cost of a
+            ``-wal`` file next to the database while it is open.
+        codec: how to encode snapshots; :class:`PickleCodec` by default. Snapshots saved
+            with other codecs, or pickled by older versions of ops, can still be loaded.
+    """
 
     DB_LOCK_TIMEOUT = timedelta(hours=1)
 
-    def __init__(self, filename: Union['Path', str]):
+    # Bump this and add a step to _migrate when the schema changes; existing
+    # databases are upgraded in place when they're opened.
+    SCHEMA_VERSION = 2
+
+    def __init__(self, filename: Union['Path', str], wal: bool = False,
+                 codec: Optional[SnapshotCodec] = None):
+        self._codec = codec or PickleCodec()  # type: SnapshotCodec
         # The isolation_level argument is set to None such that the implicit
         # transaction management behavior of the sqlite3 module is disabled.
         self._db = sqlite3.connect(str(filename),
                                    isolation_level=None,
                                    timeout=self.DB_LOCK_TIMEOUT.total_seconds())
+        self._wal = wal
         self._setup()
 
     def _setup(self):
@@ -63,6 +251,12 @@ class SQLiteStorage:
         # Make sure that the database is locked until the connection is closed,
         # not until the transaction ends.
         self._db.execute("PRAGMA locking_mode=EXCLUSIVE")
+        if self._wal:
+            # The journal mode can't be changed inside a transaction. With an
+            # exclusive lock the WAL doesn't need a shared-memory index, and
+            # NORMAL is durable in WAL mode except across a power loss.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
         c = self._db.execute("BEGIN")
         c.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='snapshot'")
         if c.fetchone()[0] == 0:
@@ -76,8 +270,39 @@ class SQLiteStorage:
                   observer_path TEXT,
                   method_name TEXT)
                 ''')
+            self._migrate(0)
+            self._db.commit()
+            return
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            self._migrate(version)
             self._db.commit()
 
+    def _migrate(self, version: int):
+        """Upgrade the schema from the given version to SCHEMA_VERSION.
+
+        This must be called inside a transaction, so that a failed upgrade leaves
+        the database as it was.
+        """
+        if version < 1:
+            # Both drop_notice and notices(event_path) look notices up by these columns.
+            self._db.execute('''
+                CREATE INDEX IF NOT EXISTS notice_path
+                    ON notice (event_path, observer_path, method_name)
+                ''')
+        if version < 2:
+            # The top-level keys of snapshots saved with update_snapshot.
+            self._db.execute('''
+                CREATE TABLE snapshot_key (
+                  handle TEXT,
+                  key TEXT,
+                  data BLOB,
+                  PRIMARY KEY (handle, key))
+                ''')
+        # PRAGMA doesn't accept bound parameters.
+        self._db.execute("PRAGMA user_version={:d}".format(self.SCHEMA_VERSION))
+
     def close(self):
         """Part of the Storage API, close the storage backend."""
         self._db.close()
@@ -99,10 +324,42 @@ class SQLiteStorage:
             handle_path: The string identifying the snapshot.
             snapshot_data: The data to be persisted. (as returned by Object.snapshot()). This
             might be a dict/tuple/int, but must only contain 'simple' python types.
+
+        Raises:
+            ValueError: if snapshot_data contains anything but simple types.
         """
-        # Use pickle for serialization, so the value remains portable.
-        raw_data = pickle.dumps(snapshot_data)
+        raw_data = _encode_snapshot(self._codec, snapshot_data)
         self._db.execute("REPLACE INTO snapshot VALUES (?, ?)", (handle_path, raw_data))
+        self._db.execute("DELETE FROM snapshot_key WHERE handle=?", (handle_path,))
+
+    def update_snapshot(self, handle_path: str, changes: Dict[str, Any]) -> None:
+        """Part of the Storage API, persist changes to some top-level keys of a snapshot.
+
+        The snapshot must be a dict. Each of its keys is stored separately from then on,
+        so that only the ones that changed need to be written. If there is no snapshot
+        for the given handle_path, one is created with just the changed keys.
+
+        Args:
+            handle_path: The string identifying the snapshot.
+            changes: The keys to persist, with their new values.
+
+        Raises:
+            ValueError: if the changes contain anything but simple types.
+        """
+        c = self._db.execute("SELECT data FROM snapshot WHERE handle=?", (handle_path,))
+        row = c.fetchone()
+        keyed = row is not None and row[0] == _KEYED_SNAPSHOT
+        if not keyed:
+            snapshot_data = self._decode(row[0]) if row is not None else {}
+            snapshot_data.update(changes)
+            changes = snapshot_data
+        # Encode everything first, so nothing is written if a value is invalid.
+        rows = [(handle_path, key, _encode_snapshot(self._codec, value))
+                for key, value in changes.items()]
+        if not keyed:
+            self._db.execute("REPLACE INTO snapshot VALUES (?, ?)",
+                             (handle_path, _KEYED_SNAPSHOT))
+        self._db.executemany("REPLACE INTO snapshot_key VALUES (?, ?, ?)", rows)
 
     def load_snapshot(self, handle_path: str) -> Any:
         """Part of the Storage API, retrieve a snapshot that was previously saved.
@@ -116,9 +373,18 @@ class SQLiteStorage:
         c = self._db.cursor()
         c.execute("SELECT data FROM snapshot WHERE handle=?", (handle_path,))
         row = c.fetchone()
-        if row:
-            return pickle.loads(row[0])
-        raise NoSnapshotError(handle_path)
+        if not row:
+            raise NoSnapshotError(handle_path)
+        if row[0] == _KEYED_SNAPSHOT:
+            c.execute("SELECT key, data FROM snapshot_key WHERE handle=?", (handle_path,))
+            return {key: self._decode(raw_data) for key, raw_data in c.fetchall()}
+        return self._decode(row[0])
+
+    def _decode(self, raw_data: bytes) -> Any:
+        if raw_data[:1] != b'#':
+            # Older versions of ops pickled snapshots; pickle data never starts with '#'.
+            return pickle.loads(raw_data)
+        return _decode_snapshot(self._codec, raw_data)
 
     def drop_snapshot(self, handle_path: str):
         """Part of the Storage API, remove a snapshot that was previously saved.
@@ -126,6 +392,7 @@ class SQLiteStorage:
         Dropping a snapshot that doesn't exist is treated as a no-op.
         """
         self._db.execute("DELETE FROM snapshot WHERE handle=?", (handle_path,))
+        self._db.execute("DELETE FROM snapshot_key WHERE handle=?", (handle_path,))
 
     def list_snapshots(self) -> Generator[str, None, None]:
         """Return the name of all snapshots that are currently saved."""
@@ -188,24 +455,73 @@ class JujuStorage:
 
     This uses :class:`_JujuStorageBackend` to interact with state-get/state-set
     as the way to store state for the framework and for components.
+
+    Writes and deletes are buffered in memory, and sent to Juju in a single
+    state-set call when the storage is committed. Reads see the buffered changes.
+
+    Args:
+        backend: the backend used to talk to Juju.
+        prefetch: if True, the whole state is fetched with a single state-get call the first
+            time something is read, and every later read is served from memory. Otherwise,
+            each key is fetched with its own state-get call when it's first needed, until a
+            snapshot saved with :meth:`update_snapshot` is loaded: its keys, and everything
+            else, are then fetched with a single state-get call.
+        codec: how to encode values; :class:`JSONCodec` by default. Binary codecs are
+            base64-encoded. Values saved with other codecs, or as YAML by older versions
+            of ops, can still be loaded.
     """
 
+    # Notices are saved in chunks of up to NOTICE_CHUNK_SIZE, under NOTICE_KEY followed by
+    # the chunk id, so saving or dropping one doesn't rewrite all the others. The ids of
+    # the chunks, in order, are saved under NOTICE_INDEX_KEY. Older versions of ops saved
+    # every notice in a single list under NOTICE_KEY itself.
     NOTICE_KEY = "#notices#"
+    NOTICE_INDEX_KEY = "#notices-index#"
+    NOTICE_CHUNK_SIZE = 100
+
+    # Prefix of the value saved in place of a snapshot whose top-level keys are stored
+    # separately by update_snapshot; it is followed by the list of keys, in JSON.
+    _KEYED_PREFIX = _KEYED_SNAPSHOT.decode('ascii')
 
-    def __init__(self, backend: Optional['_JujuStorageBackend'] = None):
+    def __init__(self, backend: Optional['_JujuStorageBackend'] = None, prefetch: bool = False,
+                 codec: Optional[SnapshotCodec] = None):
         self._backend = backend or _JujuStorageBackend()  # type: _JujuStorageBackend
+        self._codec = codec or JSONCodec()  # type: SnapshotCodec
+        # {key: encoded value} changed since the last commit. Deleted keys map to ''.
+        self._pending = {}  # type: Dict[str, str]
+        self._prefetch = prefetch
+        # {key: encoded value} of everything committed, once fetched: on the first read if
+        # prefetch is enabled, or else when a snapshot saved key by key is first loaded.
+        self._state = None  # type: Optional[Dict[str, str]]
+        # {key: encoded value} of the committed keys fetched one by one before that. Keys
+        # that aren't set map to ''.
+        self._fetched = {}  # type: Dict[str, str]
+        self._notice_chunks = None  # type: Optional[_NoticeChunks]
 
     def close(self):
         """Part of the Storage API, close the storage backend.
 
-        Nothing to be done for Juju backend, as it's transactional.
+        Changes that haven't been committed are discarded.
         """
+        self._pending = {}
+        self._notice_chunks = None
 
     def commit(self):
         """Part of the Storage API, commit latest changes in the storage backend.
 
-        Nothing to be done for Juju backend, as it's transactional.
+        All the changes made since the last commit are sent to Juju in one go.
         """
+        if self._pending:
+            self._backend.set_encoded(self._pending)
+            if self._state is not None:
+                for key, encoded in self._pending.items():
+                    if encoded:
+                        self._state[key] = encoded
+                    else:
+                        self._state.pop(key, None)
+            for key in self._fetched.keys() & self._pending.keys():
+                self._fetched[key] = self._pending[key]
+            self._pending = {}
 
     def save_snapshot(self, handle_path: str, snapshot_data: Any) -> None:
         """Part of the Storage API, persist a snapshot data under the given handle.
@@ -214,8 +530,46 @@ class JujuStorage:
             handle_path: The string identifying the snapshot.
             snapshot_data: The data to be persisted. (as returned by Object.snapshot()). This
                 might be a dict/tuple/int, but must only contain 'simple' python types.
+
+        Raises:
+            ValueError: if snapshot_data contains anything but simple types.
         """
-        self._backend.set(handle_path, snapshot_data)
+        encoded = self._encode(snapshot_data)
+        self._delete_snapshot_keys(handle_path)
+        self._pending[handle_path] = encoded
+
+    def update_snapshot(self, handle_path: str, changes: Dict[str, Any]) -> None:
+        """Part of the Storage API, persist changes to some top-level keys of a snapshot.
+
+        The snapshot must be a dict. Each of its keys is stored under its own Juju key from
+        then on, so that only the ones that changed need to be sent. If there is no snapshot
+        for the given handle_path, one is created with just the changed keys.
+
+        Args:
+            handle_path: The string identifying the snapshot.
+            changes: The keys to persist, with their new values.
+
+        Raises:
+            ValueError: if the changes contain anything but simple types.
+        """
+        try:
+            encoded = self._get_encoded(handle_path)
+        except KeyError:
+            encoded = None
+        if encoded is not None and encoded.startswith(self._KEYED_PREFIX):
+            keys = json.loads(encoded[len(self._KEYED_PREFIX):])
+        else:
+            snapshot_data = self._decode(encoded) if encoded is not None else {}
+            snapshot_data.update(changes)
+            changes = snapshot_data
+            keys = []
+        # Encode everything first, so nothing is written if a value is invalid.
+        encoded_changes = {self._snapshot_key(handle_path, key): self._encode(value)
+                           for key, value in changes.items()}
+        self._pending.update(encoded_changes)
+        new_keys = [key for key in changes if key not in keys]
+        if new_keys or encoded is None:
+            self._pending[handle_path] = self._KEYED_PREFIX + json.dumps(keys + new_keys)
 
     def load_snapshot(self, handle_path: str):
         """Part of the Storage API, retrieve a snapshot that was previously saved.
@@ -227,29 +581,58 @@ class JujuStorage:
             NoSnapshotError: if there is no snapshot for the given handle_path.
         """
         try:
-            content = self._backend.get(handle_path)
+            encoded = self._get_encoded(handle_path)
         except KeyError:
             raise NoSnapshotError(handle_path)
-        return content
+        if not encoded.startswith(self._KEYED_PREFIX):
+            return self._decode(encoded)
+        keys = json.loads(encoded[len(self._KEYED_PREFIX):])
+        # Rather than a state-get for each key, fetch everything in one go, once.
+        return {key: self._decode(self._get_encoded(self._snapshot_key(handle_path, key),
+                                                    fetch_all=True))
+                for key in keys}
 
     def drop_snapshot(self, handle_path: str):
         """Part of the Storage API, remove a snapshot that was previously saved.
 
         Dropping a snapshot that doesn't exist is treated as a no-op.
         """
-        self._backend.delete(handle_path)
+        self._delete_snapshot_keys(handle_path)
+        self._delete(handle_path)
+
+    def _snapshot_key(self, handle_path: str, key: str) -> str:
+        return '{}#{}'.format(handle_path, key)
+
+    def _delete_snapshot_keys(self, handle_path: str) -> None:
+        """Delete the keys stored separately by update_snapshot, if any."""
+        try:
+            encoded = self._get_encoded(handle_path)
+        except KeyError:
+            return
+        if encoded.startswith(self._KEYED_PREFIX):
+            for key in json.loads(encoded[len(self._KEYED_PREFIX):]):
+                self._delete(self._snapshot_key(handle_path, key))
 
     def save_notice(self, event_path: str, observer_path: str, method_name: str):
         """Part of the Storage API, record a notice (event and observer)."""
-        notice_list = self._load_notice_list()
-        notice_list.append((event_path, observer_path, method_name))
-        self._save_notice_list(notice_list)
+        chunks = self._load_notice_chunks()
+        if not chunks or len(chunks[-1][1]) >= self.NOTICE_CHUNK_SIZE:
+            chunk_id = chunks[-1][0] + 1 if chunks else 0
+            chunks.append((chunk_id, []))
+            self._save_notice_index()
+        chunks[-1][1].append((event_path, observer_path, method_name))
+        self._save_notice_chunk(len(chunks) - 1)
 
     def drop_notice(self, event_path: str, observer_path: str, method_name: str):
         """Part of the Storage API, remove a notice that was previously recorded."""
-        notice_list = self._load_notice_list()
-        notice_list.remove((event_path, observer_path, method_name))
-        self._save_notice_list(notice_list)
+        notice = (event_path, observer_path, method_name)
+        chunks = self._load_notice_chunks()
+        for i, (_, notice_list) in enumerate(chunks):
+            if notice in notice_list:
+                notice_list.remove(notice)
+                self._save_notice_chunk(i)
+                return
+        raise ValueError('{!r} is not a known notice'.format(notice))
 
     def notices(self, event_path: Optional[str] = None):
         """Part of the Storage API, return all notices that begin with event_path.
@@ -261,33 +644,119 @@ class JujuStorage:
         Returns:
             Iterable of (event_path, observer_path, method_name) tuples
         """
-        notice_list = self._load_notice_list()
-        for row in notice_list:
-            if event_path and row[0] != event_path:
-                continue
-            yield tuple(row)
+        # Notices may be saved and dropped while the caller iterates, so take a copy first.
+        rows = [row for _, notice_list in self._load_notice_chunks() for row in notice_list
+                if not event_path or row[0] == event_path]
+        yield from rows
 
-    def _load_notice_list(self) -> '_Notices':
-        """Load a notice list from current key.
+    def _notice_chunk_key(self, chunk_id: int) -> str:
+        return '{}{}'.format(self.NOTICE_KEY, chunk_id)
+
+    def _load_notice_chunks(self) -> '_NoticeChunks':
+        """Load the notices, split in chunks, the first time they are needed.
 
         Returns:
-            List of (event_path, observer_path, method_name) tuples; empty if no key or is None.
+            List of (chunk id, notices) tuples, in the order notices were saved; the list
+            is kept in memory, and changes to it must be saved with _save_notice_chunk.
         """
+        if self._notice_chunks is not None:
+            return self._notice_chunks
         try:
-            notice_list = self._backend.get(self.NOTICE_KEY)
+            chunk_ids = self._get(self.NOTICE_INDEX_KEY)
         except KeyError:
-            return []
-        if notice_list is None:
-            return []
-        return notice_list
+            self._notice_chunks = []
+            self._migrate_notice_list()
+        else:
+            self._notice_chunks = [
+                (chunk_id, self._get(self._notice_chunk_key(chunk_id)))
+                for chunk_id in chunk_ids]
+        return self._notice_chunks
 
-    def _save_notice_list(self, notices: '_Notices') -> None:
-        """Save a notice list under current key.
+    def _migrate_notice_list(self) -> None:
+        """Move notices saved by older versions of ops, in a single list, into chunks."""
+        try:
+            notice_list = self._get(self.NOTICE_KEY)
+        except KeyError:
+            return
+        for i in range(0, len(notice_list or ()), self.NOTICE_CHUNK_SIZE):
+            chunk = [tuple(row) for row in notice_list[i:i + self.NOTICE_CHUNK_SIZE]]
+            self._notice_chunks.append((len(self._notice_chunks), chunk))
+            self._save_notice_chunk(len(self._notice_chunks) - 1)
+        self._save_notice_index()
+        self._delete(self.NOTICE_KEY)
+
+    def _save_notice_chunk(self, index: int) -> None:
+        """Save the chunk at the given position in the list, dropping it if it's empty."""
+        chunk_id, notice_list = self._notice_chunks[index]
+        if notice_list:
+            self._set(self._notice_chunk_key(chunk_id), notice_list)
+        else:
+            self._delete(self._notice_chunk_key(chunk_id))
+            del self._notice_chunks[index]
+            self._save_notice_index()
+
+    def _save_notice_index(self) -> None:
+        if self._notice_chunks:
+            self._set(self.NOTICE_INDEX_KEY, [chunk_id for chunk_id, _ in self._notice_chunks])
+        else:
+            self._delete(self.NOTICE_INDEX_KEY)
+
+    def _get(self, key: str) -> Any:
+        """Get the value of a key, as of the changes made since the last commit.
+
+        Raises:
+            KeyError: if the key isn't set, or has been deleted since the last commit.
+        """
+        return self._decode(self._get_encoded(key))
+
+    def _get_encoded(self, key: str, fetch_all: bool = False) -> str:
+        """Like _get, but return the value without decoding it.
 
         Args:
-            notices: List of (event_path, observer_path, method_name) tuples.
+            key: the key to get.
+            fetch_all: if the committed state hasn't been fetched yet, fetch all of it
+                rather than just this key, even if prefetch isn't enabled.
         """
-        self._backend.set(self.NOTICE_KEY, notices)
+        encoded = self._pending.get(key)
+        if encoded is None:
+            if self._state is None and (self._prefetch or fetch_all):
+                self._state = self._backend.get_all()
+            if self._state is not None:
+                encoded = self._state.get(key)
+            else:
+                encoded = self._fetched.get(key)
+                if encoded is None:
+                    try:
+                        encoded = self._backend.get_encoded(key)
+                    except KeyError:
+                        encoded = ''
+                    self._fetched[key] = encoded
+        if not encoded:
+            raise KeyError(key)
+        return encoded
+
+    def _decode(self, encoded: str) -> Any:
+        if not encoded.startswith('#'):
+            # Older versions of ops saved values as YAML, which never starts with a comment.
+            return self._backend.decode(encoded)
+        codec, payload = _split_snapshot(self._codec, encoded.encode('ascii'))
+        if codec.binary:
+            payload = base64.b64decode(payload)
+        return codec.decode(payload)
+
+    def _set(self, key: str, value: Any) -> None:
+        # Encode now rather than at commit time, so later changes to value aren't saved.
+        self._pending[key] = self._encode(value)
+
+    def _encode(self, value: Any) -> str:
+        raw = _encode_snapshot(self._codec, value)
+        if self._codec.binary:
+            header, _, payload = raw.partition(b'\n')
+            raw = header + b'\n' + base64.b64encode(payload)
+        return raw.decode('ascii')
+
+    def _delete(self, key: str) -> None:
+        self._pending[key] = ''
 
 
 # we load yaml.CSafeX if available, falling back to slower yaml.SafeX.
@@ -344,20 +813,51 @@ class _JujuStorageBackend:
         Raises:
             CalledProcessError: if 'state-set' returns an error code.
         """
-        # default_flow_style=None means that it can use Block for
-        # complex types (types that have nested types) but use flow
-        # for simple types (like an array). Not all versions of PyYAML
-        # have the same default style.
-        encoded_value = yaml.dump(value, Dumper=_SimpleDumper, default_flow_style=None)
+        self.set_encoded({key: self.encode(value)})
+
+    def set_encoded(self, values: Dict[str, str]) -> None:
+        """Set several keys at once, with a single call to 'state-set'.
+
+        Args:
+            values: A mapping of keys to values as returned by encode(). Keys mapped to the
+                empty string are deleted, as Juju removes keys set to an empty value.
+
+        Raises:
+            CalledProcessError: if 'state-set' returns an error code.
+        """
         content = yaml.dump(
-            {key: encoded_value}, encoding='utf8', default_style='|',
+            values, encoding='utf8', default_style='|',
             default_flow_style=False,
             Dumper=_SimpleDumper)
         _run(["state-set", "--file", "-"], input=content, check=True)
 
+    @staticmethod
+    def encode(value: Any) -> str:
+        """Encode a value the way it is stored in Juju."""
+        # default_flow_style=None means that it can use Block for
+        # complex types (types that have nested types) but use flow
+        # for simple types (like an array). Not all versions of PyYAML
+        # have the same default style.
+        return yaml.dump(value, Dumper=_SimpleDumper, default_flow_style=None)
+
+    @staticmethod
+    def decode(content: str) -> Any:
+        """Decode a value previously encoded with encode()."""
+        return yaml.load(content, Loader=_SimpleLoader)  # type: ignore
+
     def get(self, key: str) -> Any:
         """Get the bytes value associated with a given key.
 
+        Args:
+            key: The string key that will be used to find the value
+        Raises:
+            CalledProcessError: if 'state-get' returns an error code.
+        """
+        return self.decode(self.get_encoded(key))
+
+    def get_encoded(self, key: str) -> str:
+        """Get the value associated with a given key, without decoding it.
+
         Args:
             key: The string key that will be used to find the value
         Raises:
@@ -367,7 +867,20 @@ class _JujuStorageBackend:
         p = _run(["state-get", key], stdout=subprocess.PIPE, check=True, universal_newlines=True)
         if p.stdout == '' or p.stdout == '\n':
             raise KeyError(key)
-        return yaml.load(p.stdout, Loader=_SimpleLoader)  # type: ignore
+        return p.stdout
+
+    def get_all(self) -> Dict[str, str]:
+        """Get every key with a single call to 'state-get'.
+
+        Returns:
+            A mapping of keys to their values, still encoded; see decode().
+
+        Raises:
+            CalledProcessError: if 'state-get' returns an error code.
+        """
+        p = _run(["state-get"], stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        state = yaml.load(p.stdout, Loader=_SimpleLoader)  # type: ignore
+        return state or {}
 
     def delete(self, key: str) -> None:
         """Remove a key from being tracked.
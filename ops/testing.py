@@ -38,8 +38,10 @@ import inspect
 import os
 import pathlib
 import random
+import shutil
 import signal
 import tempfile
+import threading
 import typing
 import warnings
 from contextlib import contextmanager
@@ -1197,6 +1199,10 @@ class _TestingModelBackend:
         else:
             bucket[key] = value
 
+    def relation_set_flush(self):
+        # Relation data is written immediately, so there's nothing to flush.
+        pass
+
     def config_get(self):
         return self._config
 
@@ -1357,6 +1363,10 @@ class _TestingModelBackend:
         self._pebble_clients_can_connect[client] = not SIMULATE_CAN_CONNECT
         return client
 
+    def tool_cache_stats(self):
+        """Report no hook tool cache use, as the Harness doesn't run hook tools."""
+        return {'hits': 0, 'misses': 0}
+
     def planned_units(self):
         """Simulate fetching the number of planned application units from the model.
 
@@ -1396,12 +1406,17 @@ class _TestingPebbleClient:
         # Has a service been started/stopped?
         self._service_status = {}
         self._fs = _TestingFilesystem()
+        self._fs_lock = threading.Lock()
         self._backend = backend
 
     def _check_connection(self):
         if not self._backend._can_connect(self):
             raise pebble.ConnectionError('cannot connect to pebble')
 
+    def close(self):
+        # There are no connections to close.
+        pass
+
     def get_system_info(self) -> pebble.SystemInfo:
         self._check_connection()
         return pebble.SystemInfo(version='1.0.0')
@@ -1626,24 +1641,52 @@ ChangeError: cannot perform the following tasks:
             infos.append(info)
         return infos
 
-    def pull(self, path: str, *, encoding: str = 'utf-8') -> typing.Union[typing.BinaryIO,
-                                                                          typing.TextIO]:
+    def pull(self, path: str, *, encoding: str = 'utf-8', stream: bool = False,
+             chunk_size: int = None) -> typing.Union[typing.BinaryIO, typing.TextIO]:
+        # The files are in memory, so there is nothing to stream or read in chunks.
         self._check_connection()
         return self._fs.open(path, encoding=encoding)
 
+    def pull_to(self, path: str, dest: typing.Union[str, 'os.PathLike'], *,
+                chunk_size: int = None):
+        errors = self.pull_many([path], lambda _: open(str(dest), 'wb'))
+        if path in errors:
+            raise errors[path]
+
+    def pull_many(
+            self, paths: typing.Iterable[str],
+            open_file: typing.Callable[[str], typing.BinaryIO], *,
+            chunk_size: int = None,
+    ) -> typing.Dict[str, pebble.PathError]:
+        self._check_connection()
+        errors = {}
+        for path in paths:
+            try:
+                with self._fs.open(path, encoding=None) as src:
+                    with open_file(path) as dst:
+                        shutil.copyfileobj(src, dst)
+            except FileNotFoundError:
+                errors[path] = pebble.PathError(
+                    'not-found', 'stat {}: no such file or directory'.format(path))
+        return errors
+
     def push(
             self, path: str, source: typing.Union[bytes, str, typing.BinaryIO, typing.TextIO], *,
             encoding: str = 'utf-8', make_dirs: bool = False, permissions: int = None,
-            user_id: int = None, user: str = None, group_id: int = None, group: str = None):
+            user_id: int = None, user: str = None, group_id: int = None, group: str = None,
+            chunk_size: int = None):
         self._check_connection()
         if permissions is not None and not (0 <= permissions <= 0o777):
             raise pebble.PathError(
                 'generic-file-error',
                 'permissions not within 0o000 to 0o777: {:#o}'.format(permissions))
         try:
-            self._fs.create_file(
-                path, source, encoding=encoding, make_dirs=make_dirs, permissions=permissions,
-                user_id=user_id, user=user, group_id=group_id, group=group)
+            # Container.push_path may push from several threads.
+            with self._fs_lock:
+                self._fs.create_file(
+                    path, source, encoding=encoding, make_dirs=make_dirs,
+                    permissions=permissions, user_id=user_id, user=user, group_id=group_id,
+                    group=group)
         except FileNotFoundError as e:
             raise pebble.PathError(
                 'not-found', 'parent directory not found: {}'.format(e.args[0]))
@@ -1653,6 +1696,20 @@ ChangeError: cannot perform the following tasks:
                 'paths must be absolute, got {!r}'.format(e.args[0])
             )
 
+    def push_many(
+            self, files: typing.Iterable[typing.Dict[str, typing.Any]], *,
+            encoding: str = 'utf-8', chunk_size: int = None) -> typing.Dict[str, pebble.PathError]:
+        self._check_connection()
+        errors = {}
+        for file in files:
+            kwargs = dict(file)
+            path, source = kwargs.pop('path'), kwargs.pop('source')
+            try:
+                self.push(path, source, encoding=encoding, **kwargs)
+            except pebble.PathError as e:
+                errors[path] = e
+        return errors
+
     def list_files(self, path: str, *, pattern: str = None,
                    itself: bool = False) -> typing.List[pebble.FileInfo]:
         self._check_connection()
@@ -1702,9 +1759,10 @@ ChangeError: cannot perform the following tasks:
                 'generic-file-error',
                 'permissions not within 0o000 to 0o777: {:#o}'.format(permissions))
         try:
-            self._fs.create_dir(
-                path, make_parents=make_parents, permissions=permissions,
-                user_id=user_id, user=user, group_id=group_id, group=group)
+            with self._fs_lock:
+                self._fs.create_dir(
+                    path, make_parents=make_parents, permissions=permissions,
+                    user_id=user_id, user=user, group_id=group_id, group=group)
         except FileNotFoundError as e:
             # Parent directory doesn't exist and make_parents is False
             raise pebble.PathError(
@@ -0,0 +1,37 @@
+# Copyright 2019-2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks for the framework, run with ``tox -e benchmark``.
+
+These are skipped unless RUN_BENCHMARKS is set in the environment, as they are
+slow and their timings are only meaningful when compared against each other.
+"""
+
+import os
+import timeit
+import unittest
+
+
+def benchmark(func, number=1, repeat=5):
+    """Return the best time in seconds of calling func `number` times."""
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def report(name, seconds, unit='s'):
+    """Print a benchmark result so that it shows up with ``pytest -s``."""
+    print('{:<60} {:>12.6f} {}'.format(name, seconds, unit))
+
+
+skip_unless_benchmarks = unittest.skipUnless(
+    os.getenv('RUN_BENCHMARKS'), 'RUN_BENCHMARKS not set')
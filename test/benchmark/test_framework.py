@@ -0,0 +1,91 @@
+# Copyright 2019-2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test.benchmark import benchmark, report, skip_unless_benchmarks
+from test.test_helpers import BaseTestCase
+
+from ops.framework import EventBase, EventSource, Object, ObjectEvents
+
+
+class _Event(EventBase):
+    pass
+
+
+class _Events(ObjectEvents):
+    ping = EventSource(_Event)
+    pong = EventSource(_Event)
+
+
+class _Emitter(Object):
+    on = _Events()
+
+
+class _Observer(Object):
+    def _on_event(self, event):
+        pass
+
+    def _on_event_defer(self, event):
+        event.defer()
+
+
+@skip_unless_benchmarks
+class TestEmitBenchmark(BaseTestCase):
+
+    def _time_emit(self, total_observers):
+        framework = self.create_framework()
+        emitter = _Emitter(framework, 'target')
+        framework.observe(emitter.on.ping, _Observer(framework, 'target')._on_event)
+        # Every other observer watches some other emitter or event kind.
+        for i in range(total_observers - 1):
+            other = _Emitter(framework, str(i))
+            observer = _Observer(framework, str(i))
+            framework.observe(other.on.ping, observer._on_event)
+            framework.observe(emitter.on.pong, observer._on_event)
+        return benchmark(emitter.on.ping.emit, number=200) / 200
+
+    def test_emit_cost_independent_of_observer_count(self):
+        timings = {}
+        for total in (1, 100, 1000, 10000):
+            timings[total] = self._time_emit(total)
+            report('emit with {} registered observers'.format(total), timings[total])
+        # Generous bound: dispatch must not be linear in the registered observers.
+        self.assertLess(timings[10000], timings[1] * 3)
+
+
+@skip_unless_benchmarks
+class TestReemitBenchmark(BaseTestCase):
+
+    def _time_reemit(self, observers_per_event, total_events=20):
+        framework = self.create_framework()
+        emitter = _Emitter(framework, 'target')
+        # The framework only holds weak references to the observers.
+        observers = [_Observer(framework, str(i)) for i in range(observers_per_event)]
+        for observer in observers:
+            framework.observe(emitter.on.ping, observer._on_event_defer)
+        for _ in range(total_events):
+            emitter.on.ping.emit()
+        # Every observer defers again, so each reemit replays the same notices.
+        seconds = benchmark(framework.reemit, number=5) / 5
+        self.assertEqual(len(list(framework._storage.notices())),
+                         total_events * observers_per_event)
+        return seconds / (total_events * observers_per_event)
+
+    def test_reemit_many_observers_per_event(self):
+        timings = {}
+        for observers in (1, 10, 100):
+            timings[observers] = self._time_reemit(observers)
+            report('reemit per notice, {} observers per event'.format(observers),
+                   timings[observers] * 1e6, 'us')
+        # The event is loaded once for all its observers, so the cost per notice drops.
+        self.assertLess(timings[100], timings[1])
@@ -0,0 +1,109 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import socket
+import sys
+import unittest
+from test import fake_jujuc
+from test.benchmark import benchmark, report, skip_unless_benchmarks
+from test.test_helpers import fake_script
+
+import ops._private.jujuc
+import ops.charm
+import ops.model
+
+
+@skip_unless_benchmarks
+@unittest.skipIf(sys.platform == 'win32', "fake hook tools don't work on Windows")
+class TestRelationPrefetchBenchmark(unittest.TestCase):
+
+    units = 200
+
+    def setUp(self):
+        self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
+        os.environ['JUJU_VERSION'] = '2.8.0'
+        self.meta = ops.charm.CharmMeta.from_yaml('''
+            name: myapp
+            peers:
+              cluster:
+                interface: cluster
+        ''')
+        unit_names = ['myapp/{}'.format(i) for i in range(self.units)]
+        fake_script(self, 'relation-ids', """echo '["cluster:1"]'""")
+        fake_script(self, 'relation-list', "echo '{}'".format(json.dumps(unit_names)))
+        # A real relation-get spends most of its time waiting for the unit agent to
+        # answer, rather than running; sleep to stand in for that round trip.
+        fake_script(self, 'relation-get', """
+            sleep 0.01
+            echo '{"address": "10.0.0.1"}'
+        """)
+
+    def _read_all(self, prefetch_workers=None):
+        # A new backend each time, so that nothing is cached from the last run.
+        model = ops.model.Model(self.meta, ops.model._ModelBackend('myapp/0'))
+        relation = model.get_relation('cluster')
+        if prefetch_workers is not None:
+            relation.prefetch(max_workers=prefetch_workers)
+        for content in relation.data.values():
+            dict(content)
+
+    def test_relation_prefetch(self):
+        serial = benchmark(self._read_all, repeat=3)
+        report('read {}-unit relation, lazily'.format(self.units), serial * 1e3, 'ms')
+        timings = {}
+        for workers in [1, 4, 8, 16]:
+            timings[workers] = benchmark(lambda: self._read_all(workers), repeat=3)
+            report('read {}-unit relation, prefetch with {} workers'.format(
+                self.units, workers), timings[workers] * 1e3, 'ms')
+        self.assertLess(timings[8], serial)
+
+
+class _InstantHandler(fake_jujuc.Handler):
+    """Answers without starting a process, as the real agent runs tools itself."""
+
+    def run(self, request):
+        return {'Code': 0, 'Stdout': b'true\n', 'Stderr': b''}
+
+
+@skip_unless_benchmarks
+@unittest.skipIf(not hasattr(socket, 'AF_UNIX'), 'the agent socket is a Unix socket')
+class TestJujucBenchmark(unittest.TestCase):
+
+    calls = 100
+
+    def setUp(self):
+        fake_script(self, 'is-leader', 'echo true')
+        self.server, shutdown, self.socket_path = fake_jujuc.start_server(
+            handler=_InstantHandler)
+        self.addCleanup(shutdown)
+
+    def _run_calls(self, use_socket):
+        backend = ops.model._ModelBackend('myapp/0')
+        backend._jujuc = None
+        if use_socket:
+            backend._jujuc = ops._private.jujuc.Client(self.socket_path, 'test-context')
+        for _ in range(self.calls):
+            backend._run('is-leader', return_output=True)
+        if use_socket:
+            backend._jujuc.close()
+
+    def test_jujuc(self):
+        process = benchmark(lambda: self._run_calls(False), repeat=3)
+        report('{} hook tool calls, each in a process'.format(self.calls), process * 1e3, 'ms')
+        in_process = benchmark(lambda: self._run_calls(True), repeat=3)
+        report('{} hook tool calls, over the agent socket'.format(self.calls),
+               in_process * 1e3, 'ms')
+        self.assertLess(in_process, process)
@@ -0,0 +1,151 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import tempfile
+import test.fake_pebble as fake_pebble
+import unittest
+from test.benchmark import benchmark, report, skip_unless_benchmarks
+
+import ops.pebble as pebble
+
+
+@skip_unless_benchmarks
+@unittest.skipIf(sys.platform == 'win32', "Unix sockets don't work on Windows")
+class TestRequestLatencyBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        shutdown, self.socket_path = fake_pebble.start_server()
+        self.addCleanup(shutdown)
+
+    def _time_request(self, max_idle):
+        client = pebble.Client(socket_path=self.socket_path)
+        self.addCleanup(client.close)
+        for handler in client.opener.handlers:
+            if isinstance(handler, pebble._UnixSocketHandler):
+                handler.max_idle = max_idle
+        return benchmark(client.get_system_info, number=200) / 200
+
+    def test_request_latency(self):
+        # With no idle connections kept, every request connects anew.
+        per_connection = self._time_request(0)
+        pooled = self._time_request(4)
+        report('request latency, new connection per request', per_connection * 1e6, 'us')
+        report('request latency, pooled keep-alive connection', pooled * 1e6, 'us')
+        self.assertLess(pooled, per_connection)
+
+
+@skip_unless_benchmarks
+class TestMultipartParserBenchmark(unittest.TestCase):
+
+    marker = b'qwerty'
+    header = b'\r\n--qwerty\r\nContent-Type: application/octet-stream\r\n\r\n'
+    terminator = b'\r\n--qwerty--\r\n'
+
+    def _time_parse(self, chunks, want_size, repeat=3):
+        received = []
+
+        def parse():
+            received.clear()
+            parser = pebble._MultipartParser(
+                self.marker, lambda data: None,
+                lambda data, done=False: received.append(len(data)))
+            for chunk in chunks():
+                parser.feed(chunk)
+
+        seconds = benchmark(parse, repeat=repeat)
+        self.assertEqual(sum(received), want_size)
+        return seconds
+
+    def test_single_large_file(self):
+        size, chunk_size = 1024 * 1024 * 1024, 64 * 1024
+        body = b'x' * chunk_size
+
+        def chunks():
+            yield self.header
+            for _ in range(size // chunk_size):
+                yield body
+            yield self.terminator
+
+        seconds = self._time_parse(chunks, size, repeat=1)
+        report('multipart parse, one 1 GiB file', size / seconds / 1e6, 'MB/s')
+
+    def test_many_small_files(self):
+        files, size, chunk_size = 10000, 1024, 8 * 1024
+        data = (self.header + b'x' * size) * files + self.terminator
+
+        def chunks():
+            with memoryview(data) as view:
+                for i in range(0, len(data), chunk_size):
+                    yield view[i:i + chunk_size]
+
+        seconds = self._time_parse(chunks, files * size)
+        report('multipart parse, 10k 1 KiB files', len(data) / seconds / 1e6, 'MB/s')
+
+
+@skip_unless_benchmarks
+@unittest.skipIf(sys.platform == 'win32', "Unix sockets don't work on Windows")
+class TestChunkSizeBenchmark(unittest.TestCase):
+
+    size = 64 * 1024 * 1024
+    chunk_sizes = [4096, 8192, 65536, 256 * 1024, 1024 * 1024, None]
+
+    def setUp(self):
+        shutdown, socket_path = fake_pebble.start_server()
+        self.addCleanup(shutdown)
+        self.client = pebble.Client(socket_path=socket_path)
+        self.addCleanup(self.client.close)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.src = os.path.join(tmpdir.name, 'src')
+        self.dst = os.path.join(tmpdir.name, 'dst')
+        self.content = os.urandom(self.size)
+        with open(self.src, 'wb') as f:
+            f.write(self.content)
+
+    def _sweep(self, name, func):
+        timings = {}
+        for chunk_size in self.chunk_sizes:
+            timings[chunk_size] = benchmark(lambda: func(chunk_size), repeat=3)
+            report('{}, {} chunks'.format(name, chunk_size or 'adaptive'),
+                   self.size / timings[chunk_size] / 1e6, 'MB/s')
+        return timings
+
+    def test_pull_to(self):
+        timings = self._sweep(
+            'pull_to 64 MiB', lambda chunk_size: self.client.pull_to(
+                self.src, self.dst, chunk_size=chunk_size))
+        self.assertLess(timings[None], timings[8192])
+
+    def test_pull_stream(self):
+        def pull(chunk_size):
+            with self.client.pull(self.src, encoding=None, stream=True,
+                                  chunk_size=chunk_size) as f:
+                while f.read(1024 * 1024):
+                    pass
+        timings = self._sweep('pull stream 64 MiB', pull)
+        self.assertLess(timings[None], timings[8192])
+
+    def test_push_read_loop(self):
+        # An in-memory source has no file descriptor, so it's read in chunks. Only the
+        # encoding of the request body is timed, as the fake server parses it slowly.
+        def encode(chunk_size):
+            body, _ = self.client._encode_multipart(
+                {}, [self.dst], [io.BytesIO(self.content)], 'utf-8', chunk_size=chunk_size)
+            for _ in body:
+                pass
+        timings = self._sweep('encode push of 64 MiB from memory', encode)
+        self.assertLess(timings[None], timings[8192])
@@ -0,0 +1,120 @@
+# Copyright 2019-2020 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import marshal
+import pathlib
+import pickle
+import shutil
+import tempfile
+import unittest
+from test.benchmark import benchmark, report, skip_unless_benchmarks
+
+from ops import storage
+
+
+@skip_unless_benchmarks
+class TestSQLiteNoticeBenchmark(unittest.TestCase):
+
+    # Number of observers that deferred each event.
+    OBSERVERS = 5
+
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(self.tmpdir))
+
+    def _populate(self, name, count, wal=False, indexed=True):
+        store = storage.SQLiteStorage(self.tmpdir / name, wal=wal)
+        self.addCleanup(store.close)
+        if not indexed:
+            # What a database created by older versions of the framework looks like.
+            store._db.execute("DROP INDEX notice_path")
+        store._db.execute("BEGIN")
+        store._db.executemany('INSERT INTO notice VALUES (NULL, ?, ?, ?)', (
+            ('Charm/on/update_status[{}]'.format(i // self.OBSERVERS),
+             'Observer[{}]'.format(i % self.OBSERVERS), '_on_update_status')
+            for i in range(count)))
+        store.commit()
+        return store
+
+    def _time_lookups(self, store, count):
+        event_path = 'Charm/on/update_status[{}]'.format(count // self.OBSERVERS // 2)
+
+        def reemit_one():
+            # What Framework._reemit does for an event that is deferred again.
+            for notice in list(store.notices(event_path)):
+                store.drop_notice(*notice)
+                store.save_notice(*notice)
+            store.commit()
+
+        return benchmark(reemit_one, number=10) / 10
+
+    def test_notice_lookup(self):
+        for count in (10000, 100000, 1000000):
+            variants = [
+                ('unindexed', dict(indexed=False)),
+                ('indexed', dict()),
+                ('indexed+wal', dict(wal=True)),
+            ]
+            for label, kwargs in variants:
+                store = self._populate('{}-{}.db'.format(label, count), count, **kwargs)
+                report('reemit one event, {} notices, {}'.format(count, label),
+                       self._time_lookups(store, count))
+
+
+def _peer_bookkeeping(units=2000):
+    """Build StoredState data like a charm tracking every peer unit, a few MB in size."""
+    return {
+        'members': {
+            'app/{}'.format(i): {
+                'address': '10.1.{}.{}'.format(i // 256, i % 256),
+                'ports': [8080, 8443, 9090],
+                'joined': True,
+                'certificate': 'MIIC{:04d}'.format(i) + 'A' * 1200,
+                'labels': {'zone': 'zone-{}'.format(i % 3), 'rack': str(i % 40)},
+                'history': [(n, 'state-{}'.format(n)) for n in range(5)],
+            } for i in range(units)
+        },
+        'leader': 'app/0',
+        'seen': set('app/{}'.format(i) for i in range(units)),
+    }
+
+
+@skip_unless_benchmarks
+class TestSnapshotCodecBenchmark(unittest.TestCase):
+
+    def _report(self, name, data, encode, decode):
+        raw = encode(data)
+        self.assertEqual(decode(raw), data)
+        report('{}: encode'.format(name), benchmark(lambda: encode(data)))
+        report('{}: decode'.format(name), benchmark(lambda: decode(raw)))
+        report('{}: size'.format(name), len(raw) / 2 ** 20, 'MiB')
+
+    def test_codecs(self):
+        data = _peer_bookkeeping()
+        backend = storage._JujuStorageBackend()
+
+        def legacy_pickle(value):
+            # What Framework.save_snapshot and SQLiteStorage used to do.
+            marshal.dumps(value)
+            return pickle.dumps(value)
+
+        def legacy_yaml(value):
+            # What Framework.save_snapshot and JujuStorage used to do.
+            marshal.dumps(value)
+            return backend.encode(value)
+
+        self._report('sqlite, marshal+pickle (legacy)', data, legacy_pickle, pickle.loads)
+        self._report('juju, marshal+yaml (legacy)', data, legacy_yaml, backend.decode)
+        for codec in (storage.PickleCodec(), storage.MarshalCodec(), storage.JSONCodec()):
+            self._report('codec ' + codec.name, data, codec.encode, codec.decode)
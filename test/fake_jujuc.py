@@ -0,0 +1,122 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fake unit agent to allow testing the jujuc protocol without Juju.
+
+Like the real agent, it serves net/rpc calls to "Jujuc.Main" over a Unix socket. It runs
+each hook tool by starting the process of that name found on the PATH, so that tools
+made with test_helpers.fake_script can be run through it.
+"""
+
+import os
+import socketserver
+import subprocess
+import tempfile
+import threading
+
+from ops._private import jujuc
+
+# The types the agent sends: net/rpc's response header, jujuc's response, and the
+# empty body that net/rpc sends with an error.
+_SERVER_TYPES = {
+    65: ('struct', 'Response', [
+        ('ServiceMethod', jujuc._STRING), ('Seq', jujuc._UINT), ('Error', jujuc._STRING)]),
+    66: ('struct', 'ExecResponse', [
+        ('Code', jujuc._INT), ('Stdout', jujuc._BYTES), ('Stderr', jujuc._BYTES)]),
+    67: ('struct', 'invalidRequest', []),
+}
+_RPC_RESPONSE = 65
+_EXEC_RESPONSE = 66
+_INVALID_REQUEST = 67
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        decoder = jujuc._Codec({})
+        encoder = jujuc._Codec(_SERVER_TYPES)
+        while True:
+            header = self.receive(decoder)
+            if header is None:
+                return
+            request = self.receive(decoder)
+            if request is None:
+                return
+            self.server.requests.append(request)
+            response = {'ServiceMethod': header.get('ServiceMethod', ''),
+                        'Seq': header.get('Seq', 0)}
+            if header.get('ServiceMethod') != 'Jujuc.Main':
+                response['Error'] = "rpc: can't find service {}".format(
+                    header.get('ServiceMethod'))
+            elif request.get('ContextId') != self.server.context_id:
+                response['Error'] = 'bad request: bad context id'
+            else:
+                try:
+                    result = self.run(request)
+                except FileNotFoundError:
+                    response['Error'] = 'bad request: unknown command: "{}"'.format(
+                        request.get('CommandName'))
+            reply = encoder.encode(_RPC_RESPONSE, response)
+            if 'Error' in response:
+                reply += encoder.encode(_INVALID_REQUEST, {})
+            else:
+                reply += encoder.encode(_EXEC_RESPONSE, result)
+            self.wfile.write(reply)
+
+    def receive(self, decoder):
+        while True:
+            first = self.rfile.read(1)
+            if not first:
+                return None
+            if first[0] < 0x80:
+                size = first[0]
+            else:
+                size = jujuc._Buffer(first + self.rfile.read(256 - first[0])).read_uint()
+            message = decoder.decode(self.rfile.read(size))
+            if message is not None:
+                return message[1]
+
+    def run(self, request):
+        result = subprocess.run(
+            [request['CommandName']] + request.get('Args', []),
+            cwd=request.get('Dir'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return {'Code': result.returncode, 'Stdout': result.stdout, 'Stderr': result.stderr}
+
+
+class UnixSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_server(context_id='test-context', handler=Handler):
+    """Start a fake agent, returning (server, shutdown function, socket path).
+
+    The requests it has been sent are recorded in server.requests.
+    """
+    socket_dir = tempfile.mkdtemp(prefix='test-ops.fake_jujuc.')
+    socket_path = os.path.join(socket_dir, 'agent.socket')
+
+    server = UnixSocketServer(socket_path, handler)
+    server.context_id = context_id
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.start()
+
+    def shutdown():
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        os.remove(socket_path)
+        os.rmdir(socket_dir)
+
+    return server, shutdown, socket_path
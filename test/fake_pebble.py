@@ -14,6 +14,7 @@
 
 """Fake (partial) Pebble server to allow testing the HTTP-over-Unix-socket protocol."""
 
+import email.parser
 import http.server
 import json
 import os
@@ -25,10 +26,15 @@ import urllib.parse
 
 
 class Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive between requests, like the real Pebble server.
+    protocol_version = 'HTTP/1.1'
+
     def __init__(self, request, client_address, server):
         self.routes = [
             ('GET', re.compile(r'^/system-info$'), self.get_system_info),
             ('POST', re.compile(r'^/services$'), self.services_action),
+            ('GET', re.compile(r'^/files$'), self.read_files),
+            ('POST', re.compile(r'^/files$'), self.write_files),
         ]
         self._services = ['foo']
         super().__init__(request, ('unix-socket', 80), server)
@@ -38,11 +44,12 @@ class Handler(http.server.BaseHTTPRequestHandler):
         pass
 
     def respond(self, d, status=200):
+        d_json = json.dumps(d, indent=4, sort_keys=True).encode('utf-8')
         self.send_response(status)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(d_json)))
         self.end_headers()
-        d_json = json.dumps(d, indent=4, sort_keys=True)
-        self.wfile.write(d_json.encode('utf-8'))
+        self.wfile.write(d_json)
 
     def bad_request(self, message):
         d = {
@@ -109,7 +116,9 @@ class Handler(http.server.BaseHTTPRequestHandler):
             match = regex.match(path)
             if match:
                 if request_method == method:
-                    data = self.read_body_json()
+                    data = self.read_body()
+                    if self.headers.get_content_type() == 'application/json':
+                        data = json.loads(data.decode('utf-8')) if data else None
                     try:
                         func(match, query, data)
                     except Exception as e:
@@ -124,17 +133,21 @@ class Handler(http.server.BaseHTTPRequestHandler):
 
         self.not_found()
 
-    def read_body_json(self):
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()  # CRLF after the last chunk
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()  # CRLF after the chunk data
         try:
             content_len = int(self.headers.get('Content-Length', ''))
         except ValueError:
             content_len = 0
-        if not content_len:
-            return None
-        body = self.rfile.read(content_len)
-        if isinstance(body, bytes):
-            body = body.decode('utf-8')
-        return json.loads(body)
+        return self.rfile.read(content_len)
 
     def get_system_info(self, match, query, data):
         self.respond({
@@ -164,12 +177,77 @@ class Handler(http.server.BaseHTTPRequestHandler):
         else:
             self.bad_request('action "{}" not implemented'.format(action))
 
+    def write_files(self, match, query, data):
+        # Writes the files to the local filesystem, like Pebble does inside its container.
+        parser = email.parser.BytesFeedParser()
+        parser.feed(b'Content-Type: ' + self.headers['Content-Type'].encode('utf-8') + b'\r\n\r\n')
+        parser.feed(data)
+        result = []
+        for part in parser.close().walk():
+            if part.get_param('name', header='Content-Disposition') == 'files':
+                path = part.get_filename()
+                with open(path, 'wb') as f:
+                    f.write(part.get_payload(decode=True))
+                result.append({'path': path})
+        self.respond({
+            "result": result,
+            "status": "OK",
+            "status-code": 200,
+            "type": "sync"
+        })
+
+    def read_files(self, match, query, data):
+        # Serves files from the local filesystem, streaming their content like Pebble does.
+        paths = urllib.parse.parse_qs(self.path.partition('?')[2]).get('path', [])
+        boundary = 'fake-pebble-boundary'
+        parts, result = [], []
+        for path in paths:
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                result.append({'path': path, 'error': {
+                    'kind': 'not-found', 'message': 'stat {}: no such file'.format(path)}})
+                continue
+            header = (
+                '--{}\r\n'
+                'Content-Type: application/octet-stream\r\n'
+                'Content-Disposition: form-data; name="files"; filename="{}"\r\n'
+                '\r\n').format(boundary, path).encode('utf-8')
+            parts.append((header, path, size))
+            result.append({'path': path})
+        response = json.dumps({
+            "result": result,
+            "status": "OK",
+            "status-code": 200,
+            "type": "sync"
+        }).encode('utf-8')
+        trailer = (
+            '--{}\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Disposition: form-data; name="response"\r\n'
+            '\r\n').format(boundary).encode('utf-8') + response + (
+            '\r\n--{}--\r\n'.format(boundary).encode('utf-8'))
+
+        length = sum(len(header) + size + 2 for header, _, size in parts) + len(trailer)
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/form-data; boundary={}'.format(boundary))
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        for header, path, size in parts:
+            self.wfile.write(header)
+            with open(path, 'rb') as f:
+                self.connection.sendfile(f, 0, size)
+            self.wfile.write(b'\r\n')
+        self.wfile.write(trailer)
+
 
 def start_server():
     socket_dir = tempfile.mkdtemp(prefix='test-ops.pebble')
     socket_path = os.path.join(socket_dir, 'test.socket')
 
-    server = socketserver.UnixStreamServer(socket_path, Handler)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    # Don't wait for the connections that clients keep open on shutdown.
+    server.daemon_threads = True
     thread = threading.Thread(target=server.serve_forever)
     thread.start()
 
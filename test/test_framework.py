@@ -16,6 +16,7 @@ import datetime
 import gc
 import inspect
 import io
+import logging
 import os
 import re
 import shutil
@@ -23,8 +24,8 @@ import sys
 import tempfile
 import unittest
 from pathlib import Path
-from test.test_helpers import BaseTestCase, fake_script
-from unittest.mock import patch
+from test.test_helpers import BaseTestCase, fake_script, fake_script_calls
+from unittest.mock import call, patch
 
 import logassert
 
@@ -47,6 +48,7 @@ from ops.framework import (
     StoredStateData,
     _event_regex,
 )
+from ops.model import RelationNotFoundError
 from ops.storage import NoSnapshotError, SQLiteStorage
 
 
@@ -192,6 +194,90 @@ class TestFramework(BaseTestCase):
             "<MyEvent via MyNotifier[1]/bar[2]>",
         ])
 
+    def test_logging_flushed_after_each_event(self):
+        framework = self.create_framework()
+
+        class FlushCounter(logging.Handler):
+            flushes = 0
+
+            def emit(self, record):
+                pass
+
+            def flush(self):
+                self.flushes += 1
+
+        handler = FlushCounter()
+        logging.getLogger().addHandler(handler)
+        self.addCleanup(logging.getLogger().removeHandler, handler)
+
+        class MyEvent(EventBase):
+            pass
+
+        class MyNotifier(Object):
+            foo = EventSource(MyEvent)
+
+        class MyObserver(Object):
+            def on_foo(self, event):
+                self.flushes = handler.flushes
+
+        pub = MyNotifier(framework, "1")
+        obs = MyObserver(framework, "1")
+        framework.observe(pub.foo, obs.on_foo)
+
+        pub.foo.emit()
+        self.assertEqual(handler.flushes, obs.flushes + 1)
+
+    def test_observers_keyed_by_emitter_and_kind(self):
+        framework = self.create_framework()
+
+        class MyEvent(EventBase):
+            pass
+
+        class MyNotifier(Object):
+            foo = EventSource(MyEvent)
+            bar = EventSource(MyEvent)
+
+        class MyObserver(Object):
+            def __init__(self, parent, key):
+                super().__init__(parent, key)
+                self.seen = []
+
+            def on_first(self, event):
+                self.seen.append("first:" + str(event.handle))
+
+            def on_second(self, event):
+                self.seen.append("second:" + str(event.handle))
+
+        pub1 = MyNotifier(framework, "1")
+        pub2 = MyNotifier(framework, "2")
+        obs = MyObserver(framework, "1")
+
+        framework.observe(pub1.foo, obs.on_second)
+        framework.observe(pub2.foo, obs.on_first)
+        framework.observe(pub1.bar, obs.on_first)
+        framework.observe(pub1.foo, obs.on_first)
+
+        self.assertEqual(
+            [(s, m) for s, _, m in framework._observers_for('MyNotifier[1]', 'foo')],
+            [(0, 'on_second'), (3, 'on_first')])
+        self.assertEqual(list(framework._observers_for('MyNotifier[3]', 'foo')), [])
+
+        # Observers without an event kind are merged in registration order.
+        framework._observers[('MyNotifier[1]', None)] = [(2, 'MyObserver[1]', 'on_first')]
+        self.assertEqual(
+            [s for s, _, _ in framework._observers_for('MyNotifier[1]', 'foo')], [0, 2, 3])
+        del framework._observers[('MyNotifier[1]', None)]
+
+        pub1.foo.emit()
+        pub2.bar.emit()
+        pub1.bar.emit()
+
+        self.assertEqual(obs.seen, [
+            "second:MyNotifier[1]/foo[1]",
+            "first:MyNotifier[1]/foo[1]",
+            "first:MyNotifier[1]/bar[3]",
+        ])
+
     def test_bad_sig_observer(self):
 
         class MyEvent(EventBase):
@@ -343,6 +429,147 @@ class TestFramework(BaseTestCase):
         self.assertRaises(NoSnapshotError, framework.load_snapshot, ev_b_handle)
         self.assertRaises(NoSnapshotError, framework.load_snapshot, ev_c_handle)
 
+    def test_reemit_loads_event_once(self):
+        framework = self.create_framework()
+
+        class MyNotifier(Object):
+            foo = EventSource(EventBase)
+
+        class MyObserver(Object):
+            def __init__(self, parent, key):
+                super().__init__(parent, key)
+                self.seen = []
+
+            def on_foo(self, event):
+                self.seen.append(event)
+                event.defer()
+
+        pub = MyNotifier(framework, "1")
+        observers = [MyObserver(framework, str(i)) for i in range(3)]
+        for obs in observers:
+            framework.observe(pub.foo, obs.on_foo)
+        pub.foo.emit()
+        pub.foo.emit()
+
+        with patch.object(framework, 'load_snapshot', wraps=framework.load_snapshot) as load:
+            framework.reemit()
+        self.assertEqual(load.call_count, 2)
+        # Every observer got the same two event objects.
+        for obs in observers:
+            self.assertEqual(len(obs.seen), 4)
+            self.assertIs(obs.seen[2], observers[0].seen[2])
+            self.assertIs(obs.seen[3], observers[0].seen[3])
+        self.assertEqual(len(list(framework._storage.notices())), 6)
+
+    def test_defer_coalesce(self):
+        framework = self.create_framework()
+
+        class MyEvent(EventBase):
+            def __init__(self, handle, n=0):
+                super().__init__(handle)
+                self.n = n
+
+            def snapshot(self):
+                return {'n': self.n}
+
+            def restore(self, snapshot):
+                self.n = snapshot['n']
+
+        class CoalescingEvent(MyEvent):
+            coalesce_deferred = True
+
+        class MyNotifier(Object):
+            a = EventSource(MyEvent)
+            b = EventSource(CoalescingEvent)
+
+        class MyObserver(Object):
+            def __init__(self, parent, key, coalesce=None):
+                super().__init__(parent, key)
+                self.coalesce = coalesce
+                self.seen = []
+
+            def on_any(self, event):
+                self.seen.append('{}{}'.format(event.handle.kind, event.n))
+                event.defer(coalesce=self.coalesce)
+
+        pub = MyNotifier(framework, "1")
+        obs1 = MyObserver(framework, "1", coalesce=True)
+        obs2 = MyObserver(framework, "2")
+        obs3 = MyObserver(framework, "3", coalesce=False)
+        for obs in (obs1, obs2, obs3):
+            framework.observe(pub.a, obs.on_any)
+            framework.observe(pub.b, obs.on_any)
+
+        for _ in range(3):
+            framework.reemit()
+            pub.a.emit()
+            pub.b.emit()
+            pub.b.emit(1)
+
+        notices = [(Handle.from_path(event_path).kind, observer_path.split('/')[-1])
+                   for event_path, observer_path, _ in framework._storage.notices()]
+        # Only the newest a and b (for each snapshot) are kept for the first observer, and the
+        # newest b for the second one, which coalesces by default.
+        self.assertEqual(notices.count(('a', 'MyObserver[1]')), 1)
+        self.assertEqual(notices.count(('b', 'MyObserver[1]')), 2)
+        self.assertEqual(notices.count(('a', 'MyObserver[2]')), 3)
+        self.assertEqual(notices.count(('b', 'MyObserver[2]')), 2)
+        self.assertEqual(notices.count(('a', 'MyObserver[3]')), 3)
+        self.assertEqual(notices.count(('b', 'MyObserver[3]')), 6)
+        self.assertEqual(obs1.seen, ['a0', 'b0', 'b1'] * 3 + ['a0', 'b0', 'b1'] * 2)
+
+        # The events no one has a notice for anymore are gone.
+        event_paths = {event_path for event_path, _, _ in framework._storage.notices()}
+        self.assertEqual(len(event_paths), 9)
+        self.assertEqual(sorted(framework._storage.list_snapshots()), sorted(event_paths))
+
+    def test_defer_coalesce_scans_notices_once(self):
+        framework = self.create_framework()
+
+        class MyEvent(EventBase):
+            coalesce_deferred = True
+
+        class MyNotifier(Object):
+            foo = EventSource(MyEvent)
+            bar = EventSource(MyEvent)
+
+        class MyObserver(Object):
+            def __init__(self, parent, key):
+                super().__init__(parent, key)
+                self.defer = True
+
+            def on_any(self, event):
+                if self.defer:
+                    event.defer()
+
+        pub = MyNotifier(framework, "1")
+        obs = MyObserver(framework, "1")
+        framework.observe(pub.foo, obs.on_any)
+        framework.observe(pub.bar, obs.on_any)
+        # A notice left over from an earlier dispatch.
+        pub.foo.emit()
+        framework._deferred_index = None
+
+        notices = framework._storage.notices
+        with patch.object(framework._storage, 'notices', wraps=notices) as mock_notices:
+            for _ in range(5):
+                pub.foo.emit()
+                pub.bar.emit()
+        # Only the first coalescing deferral reads all of the notices.
+        self.assertEqual(mock_notices.call_args_list.count(call()), 1)
+
+        stored = [(Handle.from_path(event_path).kind, observer_path)
+                  for event_path, observer_path, _ in framework._storage.notices()]
+        self.assertEqual(sorted(stored), [('bar', obs.handle.path), ('foo', obs.handle.path)])
+        self.assertEqual(len(list(framework._storage.list_snapshots())), 2)
+
+        # Reemitting drops the handled notices from the index too.
+        obs.defer = False
+        framework.reemit()
+        self.assertEqual(list(framework._storage.notices()), [])
+        self.assertEqual(
+            [paths for paths in framework._deferred_index.values() if paths], [])
+
     def test_custom_event_data(self):
         framework = self.create_framework()
 
@@ -883,6 +1110,53 @@ class TestFramework(BaseTestCase):
                 'ObjectWithStorage[obj]/StoredStateData[_stored]',
                 'ObjectWithStorage[obj]/on/event[1]']))
 
+    def test_commit_flushes_relation_data(self):
+        model = self.create_model()
+        framework = self.create_framework(model=model)
+        fake_script(self, 'relation-set', 'exit 0')
+
+        class Writer(Object):
+            def on_commit(self, event):
+                model._backend.relation_set(1, 'b', '2', is_app=False)
+
+        writer = Writer(framework, 'writer')
+        framework.observe(framework.on.commit, writer.on_commit)
+        model._backend.relation_set(1, 'a', '1', is_app=False)
+        self.assertEqual(fake_script_calls(self), [])
+
+        framework.commit()
+        self.assertEqual(fake_script_calls(self), [['relation-set', '-r', '1', 'a=1', 'b=2']])
+
+    def test_commit_relation_data_error(self):
+        class Charm(Object):
+            _stored = StoredState()
+
+        model = self.create_model()
+        framework = self.create_framework(model=model, tmpdir=self.tmpdir)
+        fake_script(self, 'relation-set', '''
+            if [ "$2" = 1 ]; then
+                echo 'ERROR invalid value "1" for option -r: relation not found' >&2
+                exit 2
+            fi
+        ''')
+        charm = Charm(framework, 'charm')
+        charm._stored.foo = 'bar'
+        model._backend.relation_set(1, 'a', '1', is_app=False)
+        model._backend.relation_set(2, 'b', '2', is_app=False)
+
+        with patch.object(framework._storage, 'commit') as storage_commit:
+            with self.assertRaises(RelationNotFoundError):
+                framework.commit()
+        # The failed write aborted the commit before the storage was committed.
+        storage_commit.assert_not_called()
+        # The other bag was written, and the failed one is still pending.
+        self.assertEqual(fake_script_calls(self), [
+            ['relation-set', '-r', '1', 'a=1'],
+            ['relation-set', '-r', '2', 'b=2'],
+        ])
+        self.assertEqual(model._backend._relation_data_pending, {(1, False): {'a': '1'}})
+        framework.close()
+
 
 class TestStoredState(BaseTestCase):
 
@@ -902,6 +1176,91 @@ class TestStoredState(BaseTestCase):
         self.assertEqual(repr(StoredSet(None, set())), 'ops.framework.StoredSet()')
         self.assertEqual(repr(StoredSet(None, {1})), 'ops.framework.StoredSet({1})')
 
+    def test_data_is_loaded_on_first_access(self):
+        class SomeObject(Object):
+            _stored = StoredState()
+
+        framework = Framework(SQLiteStorage(':memory:'), self.tmpdir, None, None)
+        self.addCleanup(framework.close)
+        obj = SomeObject(framework, '1')
+        with patch.object(framework, 'load_snapshot', wraps=framework.load_snapshot) as load:
+            stored = obj._stored
+            self.assertIsInstance(stored, BoundStoredState)
+            load.assert_not_called()
+            self.assertEqual(framework._observers, {})
+
+            stored.set_default(a=1)
+            load.assert_called_once_with(Handle(obj, 'StoredStateData', '_stored'))
+            self.assertEqual(list(framework._observers), [('on', 'commit')])
+            self.assertEqual(stored.a, 1)
+            load.assert_called_once()
+
+    def test_storage_without_update_snapshot(self):
+        class SomeObject(Object):
+            _stored = StoredState()
+
+        class OldStorage:
+            """Storage with only the methods that older versions of ops used."""
+
+            def __init__(self, store):
+                self._store = store
+
+            def __getattr__(self, name):
+                if name == 'update_snapshot':
+                    raise AttributeError(name)
+                return getattr(self._store, name)
+
+        path = self.tmpdir / "framework.data"
+        framework = Framework(OldStorage(SQLiteStorage(path)), self.tmpdir, None, None)
+        obj = SomeObject(framework, '1')
+        obj._stored.a = 1
+        framework.commit()
+        obj._stored.b = 2
+        framework.commit()
+        framework.close()
+
+        framework = Framework(SQLiteStorage(path), self.tmpdir, None, None)
+        obj = SomeObject(framework, '1')
+        self.assertEqual((obj._stored.a, obj._stored.b), (1, 2))
+        framework.close()
+
+    def test_only_changed_keys_are_saved(self):
+        class SomeObject(Object):
+            _stored = StoredState()
+
+        store = SQLiteStorage(self.tmpdir / "framework.data")
+        framework = Framework(store, self.tmpdir, None, None)
+        obj = SomeObject(framework, '1')
+        obj._stored.a = {'b': [1]}
+        obj._stored.c = 2
+        with patch.object(store, 'update_snapshot', wraps=store.update_snapshot) as update:
+            # The first save is a full one.
+            framework.commit()
+            update.assert_not_called()
+
+            obj._stored.a['b'].append(3)
+            framework.commit()
+            update.assert_called_once_with(obj._stored._data.handle.path, {'a': {'b': [1, 3]}})
+            update.reset_mock()
+
+            framework.commit()
+            update.assert_not_called()
+
+            obj._stored.c = 4
+            obj._stored.d = {5}
+            framework.commit()
+            update.assert_called_once_with(
+                obj._stored._data.handle.path, {'c': 4, 'd': {5}})
+        framework.close()
+
+        framework = Framework(SQLiteStorage(self.tmpdir / "framework.data"),
+                              self.tmpdir, None, None)
+        obj = SomeObject(framework, '1')
+        self.assertEqual(obj._stored.a, {'b': [1, 3]})
+        self.assertEqual(obj._stored.c, 4)
+        self.assertEqual(obj._stored.d, {5})
+        framework.close()
+
     def test_basic_state_storage(self):
         class SomeObject(Object):
             _stored = StoredState()
@@ -1265,6 +1624,12 @@ class TestStoredState(BaseTestCase):
                     self.snapshots.append((type(value), value.snapshot()))
                 return super().save_snapshot(value)
 
+            def _update_snapshot(self, value, keys):
+                if value.handle.path == 'SomeObject[1]/StoredStateData[_stored]':
+                    snapshot = value.snapshot()
+                    self.snapshots.append((type(value), {k: snapshot[k] for k in keys}))
+                return super()._update_snapshot(value, keys)
+
         # Validate correctness of modification operations.
         for get_a, b, expected_res, op, validate_op in test_operations:
             storage = SQLiteStorage(self.tmpdir / "framework.data")
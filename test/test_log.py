@@ -17,9 +17,11 @@
 import io
 import logging
 import unittest
+import weakref
 from unittest.mock import patch
 
 import ops.log
+import ops.model
 from ops.model import MAX_LOG_LINE_LEN, _ModelBackend
 
 
@@ -47,12 +49,16 @@ class TestLogging(unittest.TestCase):
     def tearDown(self):
         logging.getLogger().handlers.clear()
 
+    def flush_logging(self):
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
     def test_default_logging(self):
         ops.log.setup_root_logging(self.backend)
 
         logger = logging.getLogger()
         self.assertEqual(logger.level, logging.DEBUG)
-        self.assertIsInstance(logger.handlers[-1], ops.log.JujuLogHandler)
+        self.assertIsInstance(logger.handlers[-1], ops.log.BufferedJujuLogHandler)
 
         test_cases = [
             (logger.critical, 'critical', ('CRITICAL', 'critical')),
@@ -65,6 +71,7 @@ class TestLogging(unittest.TestCase):
         for method, message, result in test_cases:
             with self.subTest(message):
                 method(message)
+                self.flush_logging()
                 calls = self.backend.calls(clear=True)
                 self.assertEqual(calls, [result])
 
@@ -126,6 +133,7 @@ class TestLogging(unittest.TestCase):
         logger.debug('debug')
         logger.info('info')
         logger.warning('warning')
+        self.flush_logging()
         self.assertEqual(self.backend.calls(), [('WARNING', 'warning')])
 
     def test_long_string_logging(self):
@@ -135,6 +143,7 @@ class TestLogging(unittest.TestCase):
             ops.log.setup_root_logging(self.backend, debug=True)
             logger = logging.getLogger()
             logger.debug('{}'.format('l' * MAX_LOG_LINE_LEN))
+            self.flush_logging()
 
         self.assertEqual(len(self.backend.calls()), 1)
 
@@ -142,6 +151,7 @@ class TestLogging(unittest.TestCase):
 
         with patch('sys.stderr', buffer):
             logger.debug('{}'.format('l' * (MAX_LOG_LINE_LEN + 9)))
+            self.flush_logging()
 
         calls = self.backend.calls()
         self.assertEqual(len(calls), 3)
@@ -153,5 +163,99 @@ class TestLogging(unittest.TestCase):
         self.assertTrue(len(calls[2][1]) == 9)
 
 
+class TestBufferedJujuLogHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FakeModelBackend()
+        self.logger = logging.getLogger('test_log')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+        self.addCleanup(self.logger.handlers.clear)
+
+    def add_handler(self, **kwargs):
+        handler = ops.log.BufferedJujuLogHandler(self.backend, **kwargs)
+        self.logger.addHandler(handler)
+        return handler
+
+    def test_coalesces_records(self):
+        handler = self.add_handler()
+        self.logger.debug('one')
+        self.logger.debug('two')
+        self.logger.info('three')
+        self.logger.debug('four')
+        self.assertEqual(self.backend.calls(), [])
+
+        handler.flush()
+        self.assertEqual(self.backend.calls(clear=True), [
+            ('DEBUG', 'one\ntwo'),
+            ('INFO', 'three'),
+            ('DEBUG', 'four'),
+        ])
+        handler.flush()
+        self.assertEqual(self.backend.calls(), [])
+
+    def test_coalesced_messages_fit_line(self):
+        handler = self.add_handler()
+        half = 'x' * (MAX_LOG_LINE_LEN // 2)
+        for _ in range(3):
+            self.logger.debug(half)
+        handler.flush()
+        self.assertEqual(self.backend.calls(), [
+            ('DEBUG', half + '\n' + half),
+            ('DEBUG', half),
+        ])
+
+    def test_flushes_on_error(self):
+        self.add_handler()
+        self.logger.debug('debug')
+        self.logger.warning('warning')
+        self.assertEqual(self.backend.calls(), [])
+        self.logger.error('error')
+        self.assertEqual(self.backend.calls(), [
+            ('DEBUG', 'debug'),
+            ('WARNING', 'warning'),
+            ('ERROR', 'error'),
+        ])
+
+    def test_flushes_at_capacity(self):
+        self.add_handler(capacity=3)
+        for i in range(7):
+            self.logger.debug(str(i))
+        self.assertEqual(self.backend.calls(), [('DEBUG', '0\n1\n2'), ('DEBUG', '3\n4\n5')])
+
+    def test_drops_records_below_level(self):
+        handler = self.add_handler(level=logging.INFO)
+        self.logger.debug('debug')
+        self.logger.info('info')
+        self.assertEqual(handler._buffer, [('INFO', 'info')])
+
+    def test_close_flushes(self):
+        handler = self.add_handler()
+        self.logger.info('info')
+        # This is what the logging module does at exit.
+        logging.shutdown([weakref.ref(handler)])
+        self.assertEqual(self.backend.calls(), [('INFO', 'info')])
+
+    def test_failure_writes_to_stderr(self):
+        handler = self.add_handler()
+        self.logger.info('one')
+        self.logger.debug('two')
+        self.logger.debug('three')
+        calls = []
+
+        def juju_log(level, message):
+            calls.append((level, message))
+            if level == 'DEBUG':
+                raise ops.model.ModelError('juju-log failed')
+        self.backend.juju_log = juju_log
+
+        buffer = io.StringIO()
+        with patch('sys.stderr', buffer):
+            handler.flush()
+        self.assertEqual(calls, [('INFO', 'one'), ('DEBUG', 'two\nthree')])
+        self.assertEqual(buffer.getvalue(), 'DEBUG two\nthree\n')
+
+
 if __name__ == '__main__':
     unittest.main()
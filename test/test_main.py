@@ -25,7 +25,7 @@ import tempfile
 import unittest
 import warnings
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
 import logassert
 import yaml
@@ -54,7 +54,7 @@ from ops.charm import (
 )
 from ops.framework import Framework, StoredStateData
 from ops.main import CHARM_STATE_FILE, _should_use_controller_storage, main
-from ops.storage import SQLiteStorage
+from ops.storage import JujuStorage, SQLiteStorage
 from ops.version import version
 
 from .test_helpers import fake_script, fake_script_calls
@@ -77,6 +77,11 @@ SLOW_YAML_LOGLINE = [
 logger = logging.getLogger(__name__)
 
 
+def juju_log_call(level, *lines):
+    """Return the juju-log call for consecutive records at level, which are sent together."""
+    return ['juju-log', '--log-level', level, '--', '\n'.join(lines)]
+
+
 class SymlinkTargetError(Exception):
     pass
 
@@ -197,6 +202,23 @@ class CharmInitTestCase(unittest.TestCase):
             with self.assertRaisesRegex(FileNotFoundError, 'state-get'):
                 self._check(CharmBase, use_juju_for_storage=True)
 
+    def test_storage_sqlite_wal(self):
+        for kwargs, wal in (({}, False), ({'sqlite_wal': True}, True)):
+            with self.subTest(kwargs=kwargs):
+                with patch('ops.storage.SQLiteStorage',
+                           wraps=SQLiteStorage) as sqlite_storage:
+                    self._check(CharmBase, use_juju_for_storage=False, **kwargs)
+                sqlite_storage.assert_called_once_with(ANY, wal=wal)
+
+    def test_storage_juju_prefetch(self):
+        for kwargs, prefetch in (({}, False), ({'juju_storage_prefetch': True}, True)):
+            with self.subTest(kwargs=kwargs):
+                with patch('ops.storage.juju_backend_available', return_value=True), \
+                        patch('ops.storage.JujuStorage', wraps=JujuStorage) as juju_storage:
+                    with self.assertRaisesRegex(FileNotFoundError, 'state-get'):
+                        self._check(CharmBase, use_juju_for_storage=True, **kwargs)
+                juju_storage.assert_called_once_with(prefetch=prefetch)
+
 
 @patch('sys.argv', new=("hooks/config-changed",))
 @patch('ops.main.setup_root_logging', new=lambda *a, **kw: None)
@@ -602,23 +624,22 @@ class _TestMain(abc.ABC):
         fake_script_calls(self, clear=True)
         self._simulate_event(EventSpec(CollectMetricsEvent, 'collect_metrics'))
 
-        expected = [
-            VERSION_LOGLINE,
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Using local storage: {} already exists'.format(self.CHARM_STATE_FILE)],
-            ['juju-log', '--log-level', 'DEBUG', '--', 'Emitting Juju event collect_metrics.'],
-            ['add-metric', '--labels', 'bar=4.2', 'foo=42'],
+        log_lines = [
+            VERSION_LOGLINE[-1],
+            'Using local storage: {} already exists'.format(self.CHARM_STATE_FILE),
+            'Emitting Juju event collect_metrics.',
         ]
         if not yaml.__with_libyaml__:
-            expected.insert(1, SLOW_YAML_LOGLINE)
+            log_lines.insert(1, SLOW_YAML_LOGLINE[-1])
         calls = fake_script_calls(self)
 
         if self.has_dispatch:
-            expected.insert(1, [
-                'juju-log', '--log-level', 'DEBUG', '--',
-                'Legacy {} does not exist.'.format(Path('hooks/collect-metrics'))])
+            log_lines.insert(1, 'Legacy {} does not exist.'.format(Path('hooks/collect-metrics')))
 
-        self.assertEqual(calls, expected)
+        self.assertEqual(calls, [
+            juju_log_call('DEBUG', *log_lines),
+            ['add-metric', '--labels', 'bar=4.2', 'foo=42'],
+        ])
 
     def test_logger(self):
         fake_script(self, 'action-get', "echo '{}'")
@@ -653,20 +674,22 @@ class _TestMain(abc.ABC):
             self._simulate_event(EventSpec(InstallEvent, 'install',
                                            set_in_env={'TRY_EXCEPTHOOK': '1'}))
 
-        calls = [' '.join(i) for i in fake_script_calls(self)]
+        calls = fake_script_calls(self)
 
-        self.assertEqual(calls.pop(0), ' '.join(VERSION_LOGLINE))
+        # The buffered debug logging is sent before the error.
+        log_lines = calls.pop(0)[4].split('\n')
+        self.assertEqual(log_lines.pop(0), VERSION_LOGLINE[-1])
 
         if self.has_dispatch:
             self.assertEqual(
-                calls.pop(0),
-                'juju-log --log-level DEBUG -- Legacy {} does not exist.'.format(
-                    Path("hooks/install")))
+                log_lines.pop(0), 'Legacy {} does not exist.'.format(Path("hooks/install")))
 
         if not yaml.__with_libyaml__:
-            self.assertEqual(calls.pop(0), ' '.join(SLOW_YAML_LOGLINE))
+            self.assertEqual(log_lines.pop(0), SLOW_YAML_LOGLINE[-1])
+
+        self.assertEqual(log_lines, ['Using local storage: not a kubernetes charm'])
 
-        self.assertRegex(calls.pop(0), 'Using local storage: not a kubernetes charm')
+        calls = [' '.join(i) for i in calls]
 
         self.maxDiff = None
         self.assertRegex(
@@ -877,20 +900,18 @@ class _TestMainWithDispatch(_TestMain):
 
         self.fake_script_path = old_path
         hook = Path('hooks/install')
-        expected = [
-            VERSION_LOGLINE,
-            ['juju-log', '--log-level', 'INFO', '--',
-             'Running legacy {}.'.format(hook)],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Legacy {} exited with status 0.'.format(hook)],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Using local storage: not a kubernetes charm'],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Emitting Juju event install.'],
+        debug_lines = [
+            'Legacy {} exited with status 0.'.format(hook),
+            'Using local storage: not a kubernetes charm',
+            'Emitting Juju event install.',
         ]
         if not yaml.__with_libyaml__:
-            expected.insert(3, SLOW_YAML_LOGLINE)
-        self.assertEqual(fake_script_calls(self), expected)
+            debug_lines.insert(1, SLOW_YAML_LOGLINE[-1])
+        self.assertEqual(fake_script_calls(self), [
+            VERSION_LOGLINE,
+            juju_log_call('INFO', 'Running legacy {}.'.format(hook)),
+            juju_log_call('DEBUG', *debug_lines),
+        ])
 
     @unittest.skipIf(is_windows, "this is UNIXish; TODO: write equivalent windows test")
     def test_non_executable_hook_and_dispatch(self):
@@ -899,18 +920,17 @@ class _TestMainWithDispatch(_TestMain):
 
         self.assertEqual(list(state.observed_event_types), ['InstallEvent'])
 
-        expected = [
-            VERSION_LOGLINE,
-            ['juju-log', '--log-level', 'WARNING', '--',
-             'Legacy hooks/install exists but is not executable.'],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Using local storage: not a kubernetes charm'],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Emitting Juju event install.'],
+        debug_lines = [
+            'Using local storage: not a kubernetes charm',
+            'Emitting Juju event install.',
         ]
         if not yaml.__with_libyaml__:
-            expected.insert(2, SLOW_YAML_LOGLINE)
-        self.assertEqual(fake_script_calls(self), expected)
+            debug_lines.insert(0, SLOW_YAML_LOGLINE[-1])
+        self.assertEqual(fake_script_calls(self), [
+            VERSION_LOGLINE,
+            juju_log_call('WARNING', 'Legacy hooks/install exists but is not executable.'),
+            juju_log_call('DEBUG', *debug_lines),
+        ])
 
     def test_hook_and_dispatch_with_failing_hook(self):
         self.stdout = self.stderr = tempfile.TemporaryFile()
@@ -981,23 +1001,21 @@ class _TestMainWithDispatch(_TestMain):
         self.assertEqual(list(state.observed_event_types), ['InstallEvent'])
         self.assertEqual(list(state.on_install), ['InstallEvent'])
         hook = Path('hooks/install')
-        expected = [
-            VERSION_LOGLINE,
-            ['juju-log', '--log-level', 'INFO', '--',
-             'Running legacy {}.'.format(hook)],
-            VERSION_LOGLINE,    # because it called itself
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Charm called itself via {}.'.format(hook)],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Legacy {} exited with status 0.'.format(hook)],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Using local storage: not a kubernetes charm'],
-            ['juju-log', '--log-level', 'DEBUG', '--',
-             'Emitting Juju event install.'],
+        debug_lines = [
+            'Legacy {} exited with status 0.'.format(hook),
+            'Using local storage: not a kubernetes charm',
+            'Emitting Juju event install.',
         ]
         if not yaml.__with_libyaml__:
-            expected.insert(5, SLOW_YAML_LOGLINE)
-        self.assertEqual(fake_script_calls(self), expected)
+            debug_lines.insert(1, SLOW_YAML_LOGLINE[-1])
+        self.assertEqual(fake_script_calls(self), [
+            VERSION_LOGLINE,
+            juju_log_call('INFO', 'Running legacy {}.'.format(hook)),
+            # because it called itself
+            juju_log_call(
+                'DEBUG', VERSION_LOGLINE[-1], 'Charm called itself via {}.'.format(hook)),
+            juju_log_call('DEBUG', *debug_lines),
+        ])
 
 
 # NOTE
@@ -16,17 +16,24 @@
 import datetime
 import ipaddress
 import json
+import logging
 import os
 import pathlib
+import socket
 import tempfile
+import time
 import unittest
+import unittest.mock
 from collections import OrderedDict
+from test import fake_jujuc
 from test.test_helpers import fake_script, fake_script_calls
 from textwrap import dedent
 
 import pytest
 
+import ops._private.jujuc
 import ops.charm
+import ops.log
 import ops.model
 import ops.testing
 from ops._private import yaml
@@ -758,6 +765,61 @@ class TestModel(unittest.TestCase):
         with self.assertRaises(AttributeError):
             self.model.storages = {}
 
+    def test_relation_prefetch(self):
+        relation_id = self.harness.add_relation('db2', 'myapp')
+        for i in range(1, 6):
+            unit_name = 'myapp/{}'.format(i)
+            self.harness.add_relation_unit(relation_id, unit_name)
+            self.harness.update_relation_data(relation_id, unit_name, {'i': str(i)})
+        self.harness.update_relation_data(relation_id, 'myapp', {'app': 'data'})
+        relation = self.model.get_relation('db2')
+        self.assertEqual(relation.data[self.model.unit], {})
+        relation.data[self.model.unit]['host'] = 'here'
+        self.resetBackendCalls()
+
+        relation.prefetch(max_workers=3)
+        calls = self.harness._get_backend_calls(reset=True)
+        # Our unit's data was already loaded.
+        self.assertCountEqual(calls, [
+            ('relation_get', relation_id, 'myapp/{}'.format(i), False) for i in range(1, 6)
+        ] + [('relation_get', relation_id, 'myapp', True)])
+
+        # Reading the data needs no more calls.
+        for i in range(1, 6):
+            unit = self.model.get_unit('myapp/{}'.format(i))
+            self.assertEqual(relation.data[unit], {'i': str(i)})
+        self.assertEqual(relation.data[self.model.app], {'app': 'data'})
+        self.assertEqual(relation.data[self.model.unit], {'host': 'here'})
+        self.assertBackendCalls([])
+
+        relation.prefetch()
+        self.assertBackendCalls([])
+
+    def test_prefetch_relations(self):
+        self.harness.add_relation_unit(self.relation_id_db0, 'db/0')
+        db1_id = self.harness.add_relation('db1', 'remoteapp')
+        self.harness.add_relation_unit(db1_id, 'remoteapp/0')
+        self.harness.add_relation('db2', 'myapp')
+        relation_db0 = self.model.get_relation('db0')
+        relation_db1 = self.model.get_relation('db1')
+        self.resetBackendCalls()
+
+        self.model.prefetch_relations('db0')
+        self.assertCountEqual(self.harness._get_backend_calls(reset=True), [
+            ('relation_get', self.relation_id_db0, 'myapp/0', False),
+            ('relation_get', self.relation_id_db0, 'myapp', True),
+            ('relation_get', self.relation_id_db0, 'db/0', False),
+            ('relation_get', self.relation_id_db0, 'db', True),
+        ])
+        self.assertIsNotNone(relation_db0.data[self.model.unit]._lazy_data)
+        self.assertIsNone(relation_db1.data[self.model.unit]._lazy_data)
+
+        self.model.prefetch_relations()
+        calls = self.harness._get_backend_calls(reset=True)
+        self.assertIn(('relation_get', db1_id, 'remoteapp/0', False), calls)
+        self.assertNotIn(('relation_get', self.relation_id_db0, 'db/0', False), calls)
+        self.assertIsNotNone(relation_db1.data[self.model.unit]._lazy_data)
+
     def resetBackendCalls(self):  # noqa: N802
         self.harness._get_backend_calls(reset=True)
 
@@ -1003,6 +1065,205 @@ def test_recursive_push_and_pull(case):
         assert c.exists(fpath), 'pull_path failed: file {} missing at destination'.format(fpath)
 
 
+@unittest.skipIf(os.name == 'nt', "sync_path is not supported on windows")
+class TestContainerSyncPath(unittest.TestCase):
+
+    def setUp(self):
+        harness = ops.testing.Harness(ops.charm.CharmBase, meta='''
+            name: test-app
+            containers:
+              foo:
+                resource: foo-image
+            ''')
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        self.container = harness.model.unit.containers['foo']
+        self.src = tempfile.TemporaryDirectory()
+        self.addCleanup(self.src.cleanup)
+        self.write('a', 'aaa')
+        self.write('sub/b', 'bbb')
+
+        self.pushed = []
+        push_many = self.container._pebble.push_many
+
+        def record_push_many(files, **kwargs):
+            files = list(files)
+            self.pushed.extend(file['path'] for file in files)
+            return push_many(files, **kwargs)
+        patcher = unittest.mock.patch.object(
+            self.container._pebble, 'push_many', side_effect=record_push_many)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, content, mtime=None):
+        path = os.path.join(self.src.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def sync(self, **kwargs):
+        self.pushed = []
+        self.container.sync_path(os.path.join(self.src.name, '*'), '/dst', **kwargs)
+        return sorted(self.pushed)
+
+    def test_pushes_new_and_changed_files(self):
+        self.assertEqual(self.sync(), ['/dst/a', '/dst/sub/b'])
+        self.assertEqual(self.sync(), [])
+
+        self.write('a', 'changed')
+        self.write('c', 'ccc')
+        self.assertEqual(self.sync(), ['/dst/a', '/dst/c'])
+        self.assertEqual(self.container.pull('/dst/a').read(), 'changed')
+
+    def test_modified_since_push(self):
+        self.sync()
+        future = datetime.datetime.now().timestamp() + 60
+        self.write('a', 'aaa', mtime=future)
+        self.write('sub/b', 'xxx', mtime=future)
+        # Files regenerated with the same content aren't pushed again.
+        self.assertEqual(self.sync(), ['/dst/sub/b'])
+        self.assertEqual(self.container.pull('/dst/sub/b').read(), 'xxx')
+
+        self.write('a', 'aaa', mtime=future + 60)
+        self.write('sub/b', 'yyy', mtime=future + 60)
+        self.assertEqual(self.sync(checksum=False), ['/dst/a', '/dst/sub/b'])
+        self.assertEqual(self.container.pull('/dst/sub/b').read(), 'yyy')
+
+    def test_checksum_error(self):
+        self.sync()
+        future = datetime.datetime.now().timestamp() + 60
+        self.write('a', 'aaa', mtime=future)
+        self.write('sub/b', 'yyy', mtime=future)
+        hash_file = ops.model.Container._hash_file
+        error = PermissionError('denied')
+
+        def fail_for_a(path):
+            if path.endswith('/a'):
+                raise error
+            return hash_file(path)
+
+        with unittest.mock.patch.object(
+                ops.model.Container, '_hash_file', staticmethod(fail_for_a)):
+            with self.assertRaises(ops.model.MultiPushPullError) as cm:
+                self.sync()
+        self.assertEqual(cm.exception.errors, [(os.path.join(self.src.name, '*'), error)])
+        # The file that could be compared is still pushed.
+        self.assertEqual(sorted(self.pushed), ['/dst/sub/b'])
+
+    def test_delete(self):
+        self.sync()
+        self.container.push('/dst/extra', 'extra')
+        self.assertEqual(self.sync(), [])
+        self.assertTrue(self.container.exists('/dst/extra'))
+
+        self.assertEqual(self.sync(delete=True), [])
+        self.assertFalse(self.container.exists('/dst/extra'))
+        self.assertTrue(self.container.exists('/dst/a'))
+
+    def test_missing_source_deletes_nothing(self):
+        self.container.push('/dst/missing/a', 'a', make_dirs=True)
+        missing = os.path.join(self.src.name, 'missing')
+        with self.assertRaises(ops.model.MultiPushPullError) as cm:
+            self.container.sync_path(missing, '/dst', delete=True)
+        self.assertEqual([source for source, _ in cm.exception.errors], [missing])
+        self.assertTrue(self.container.exists('/dst/missing/a'))
+
+
+@unittest.skipIf(os.name == 'nt', "push_path and pull_path are not supported on windows")
+class TestContainerConcurrentTransfers(unittest.TestCase):
+
+    def setUp(self):
+        harness = ops.testing.Harness(ops.charm.CharmBase, meta='''
+            name: test-app
+            containers:
+              foo:
+                resource: foo-image
+            ''')
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        self.container = harness.model.unit.containers['foo']
+        self.container._batch_files = 2
+        self.names = ['a', 'b/c', 'b/d', 'b/e/f', 'g/h', 'g/i']
+
+    def test_push_path(self):
+        src = tempfile.TemporaryDirectory()
+        self.addCleanup(src.cleanup)
+        for name in self.names:
+            path = os.path.join(src.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(name)
+
+        self.container.push_path(os.path.join(src.name, '*'), '/dst', max_workers=3)
+        for name in self.names:
+            self.assertEqual(self.container.pull('/dst/' + name).read(), name)
+
+    def test_push_path_binary(self):
+        src = tempfile.TemporaryDirectory()
+        self.addCleanup(src.cleanup)
+        content = bytes(range(256)) * 4
+        with open(os.path.join(src.name, 'bin'), 'wb') as f:
+            f.write(content)
+        self.container.push_path(os.path.join(src.name, 'bin'), '/dst')
+        self.assertEqual(self.container.pull('/dst/bin', encoding=None).read(), content)
+
+    def test_pull_path(self):
+        for name in self.names:
+            self.container.push('/src/' + name, name, make_dirs=True)
+        dst = tempfile.TemporaryDirectory()
+        self.addCleanup(dst.cleanup)
+
+        self.container.pull_path('/src/*', dst.name, max_workers=3)
+        for name in self.names:
+            with open(os.path.join(dst.name, name)) as f:
+                self.assertEqual(f.read(), name)
+
+    def test_concurrent_listing_order(self):
+        for name in self.names:
+            self.container.push('/src/' + name, name, make_dirs=True)
+        path = pathlib.Path('/src')
+        want = [info.path for info in ops.model.Container._list_recursive(
+            self.container.list_files, path)]
+        with ops.model._ThreadPool(3) as executor:
+            got = [info.path for info in ops.model.Container._list_recursive(
+                self.container.list_files, path, executor)]
+        self.assertEqual(got, want)
+        self.assertEqual(sorted(got), ['/src/' + name for name in self.names])
+
+    def test_error_order(self):
+        for name in self.names:
+            self.container.push('/src/' + name, name, make_dirs=True)
+        dst = tempfile.TemporaryDirectory()
+        self.addCleanup(dst.cleanup)
+
+        pull_many = self.container._pebble.pull_many
+        first_batch = True
+
+        def slow_first_batch(paths, open_file):
+            nonlocal first_batch
+            if first_batch:
+                first_batch = False
+                time.sleep(0.1)
+            errors = pull_many(paths, open_file)
+            errors.update((path, ops.pebble.PathError('generic-file-error', path))
+                          for path in paths)
+            return errors
+
+        errors = {}
+        with unittest.mock.patch.object(
+                self.container._pebble, 'pull_many', side_effect=slow_first_batch):
+            for max_workers in (1, 3):
+                first_batch = True
+                with self.assertRaises(ops.model.MultiPushPullError) as cm:
+                    self.container.pull_path('/src', dst.name, max_workers=max_workers)
+                errors[max_workers] = [err.message for _, err in cm.exception.errors]
+        # The first batch finishes last, but its errors are still reported first.
+        self.assertEqual(errors[3], errors[1])
+        self.assertEqual(sorted(errors[3]), ['/src/' + name for name in self.names])
+
+
 class TestApplication(unittest.TestCase):
 
     def setUp(self):
@@ -1286,6 +1547,73 @@ containers:
         with self.assertRaises(TypeError):
             self.container.add_layer('x', {}, True)
 
+    def test_add_layer_skip_if_unchanged(self):
+        plan_yaml = """
+services:
+  foo:
+    override: replace
+    command: bar
+    environment:
+      A: '1'
+checks:
+  chk:
+    override: replace
+    level: alive
+    http:
+      url: http://localhost/
+"""
+        self.pebble.responses.append(ops.pebble.Plan(plan_yaml))
+        unchanged = {
+            'services': {'foo': {'override': 'merge', 'environment': {'A': '1'}}},
+            'checks': {'chk': {'override': 'replace', 'level': 'alive',
+                               'http': {'url': 'http://localhost/'}}},
+        }
+        self.assertFalse(self.container.add_layer('a', unchanged, skip_if_unchanged=True))
+        self.assertFalse(self.container.add_layer('b', unchanged, skip_if_unchanged=True))
+        self.container.replan()
+        # The plan is fetched once, and neither the layers nor the replan are sent.
+        self.assertEqual(self.pebble.requests, [('get_plan',)])
+
+        self.pebble.requests = []
+        changed = {'checks': {'chk': {'override': 'merge', 'period': '5s'}}}
+        self.assertTrue(self.container.add_layer('c', changed, skip_if_unchanged=True))
+        self.container.replan()
+        self.assertEqual(self.pebble.requests, [
+            ('add_layer', 'c', 'checks:\n  chk:\n    override: merge\n    period: 5s\n', False),
+            ('replan',),
+        ])
+
+        # Adding a layer invalidates the cached plan.
+        self.pebble.requests = []
+        self.pebble.responses.append(ops.pebble.Plan(plan_yaml))
+        self.assertFalse(self.container.add_layer('d', unchanged, skip_if_unchanged=True))
+        self.assertEqual(self.pebble.requests, [('get_plan',)])
+
+    def test_add_layer_skip_if_unchanged_new_items(self):
+        plan_yaml = 'services:\n foo:\n  override: replace\n  command: bar'
+        for layer in [
+            {'services': {'baz': {'override': 'replace', 'command': 'bar'}}},
+            {'services': {'foo': {'override': 'replace', 'command': 'bar', 'startup': 'enabled'}}},
+            {'services': {'foo': {'override': 'merge', 'after': ['baz']}}},
+            {'checks': {'chk': {'override': 'replace', 'tcp': {'port': 80}}}},
+        ]:
+            self.pebble.requests = []
+            self.pebble.responses.append(ops.pebble.Plan(plan_yaml))
+            self.assertTrue(self.container.add_layer('a', layer, skip_if_unchanged=True))
+            self.assertEqual(self.pebble.requests[0], ('get_plan',))
+            self.assertEqual(self.pebble.requests[1][0], 'add_layer')
+
+    def test_replan_after_skipped_and_added_layers(self):
+        self.pebble.responses.append(ops.pebble.Plan(''))
+        self.container.add_layer('a', {'summary': 'x'})
+        self.assertFalse(self.container.add_layer('b', {}, skip_if_unchanged=True))
+        self.container.replan()
+        self.assertEqual(self.pebble.requests, [
+            ('add_layer', 'a', 'summary: x\n', False),
+            ('get_plan',),
+            ('replan',),
+        ])
+
     def test_get_plan(self):
         plan_yaml = 'services:\n foo:\n  override: replace\n  command: bar'
         self.pebble.responses.append(ops.pebble.Plan(plan_yaml))
@@ -1447,15 +1775,21 @@ containers:
         got = self.container.pull('/path/1')
         self.assertEqual(got, 'dummy1')
         self.assertEqual(self.pebble.requests, [
-            ('pull', '/path/1', 'utf-8'),
+            ('pull', '/path/1', 'utf-8', False),
         ])
         self.pebble.requests = []
 
         self.pebble.responses.append(b'dummy2')
-        got = self.container.pull('/path/2', encoding=None)
+        got = self.container.pull('/path/2', encoding=None, stream=True)
         self.assertEqual(got, b'dummy2')
         self.assertEqual(self.pebble.requests, [
-            ('pull', '/path/2', None),
+            ('pull', '/path/2', None, True),
+        ])
+
+    def test_pull_to(self):
+        self.container.pull_to('/path/1', pathlib.Path('/local/1'))
+        self.assertEqual(self.pebble.requests, [
+            ('pull_to', '/path/1', '/local/1'),
         ])
 
     def test_push(self):
@@ -1472,6 +1806,112 @@ containers:
             ('push', '/path/2', b'content2', None, True, 0o600, 12, 'bob', 34, 'staff'),
         ])
 
+    @unittest.skipIf(os.name == 'nt', "push_path is not supported on windows")
+    def test_push_path_batches(self):
+        src = tempfile.TemporaryDirectory()
+        self.addCleanup(src.cleanup)
+        for name in 'abcde':
+            with open(os.path.join(src.name, name), 'w') as f:
+                f.write(name * 10)
+        error = ops.pebble.PathError('permission-denied', 'denied')
+
+        # Batches are limited by count, then by size.
+        for max_files, max_bytes in [(2, 1000), (5, 25)]:
+            self.container._batch_files = max_files
+            self.container._batch_bytes = max_bytes
+            self.pebble.requests = []
+            self.pebble.responses = [{'/dst/c': error}] * 3
+            with self.assertRaises(ops.model.MultiPushPullError) as cm:
+                self.container.push_path(os.path.join(src.name, '*'), '/dst')
+            self.assertEqual(cm.exception.errors, [(os.path.join(src.name, '*'), error)])
+
+            self.assertEqual([len(request[1]) for request in self.pebble.requests], [2, 2, 1])
+            pushed = sorted(file for request in self.pebble.requests for file in request[1])
+            self.assertEqual(pushed, [('/dst/' + name, name.encode() * 10) for name in 'abcde'])
+
+    @unittest.skipIf(os.name == 'nt', "push_path is not supported on windows")
+    def test_push_path_unreadable_file(self):
+        src = tempfile.TemporaryDirectory()
+        self.addCleanup(src.cleanup)
+        with open(os.path.join(src.name, 'a'), 'w') as f:
+            f.write('x')
+        dangling = os.path.join(src.name, 'b')
+        os.symlink(os.path.join(src.name, 'missing'), dangling)
+        self.pebble.responses = [{}]
+        with self.assertRaises(ops.model.MultiPushPullError) as cm:
+            self.container.push_path([os.path.join(src.name, 'a'), dangling], '/dst')
+        [(path, error)] = cm.exception.errors
+        self.assertEqual(path, dangling)
+        self.assertIsInstance(error, FileNotFoundError)
+        # The readable file is still pushed.
+        self.assertEqual(self.pebble.requests, [('push_many', [('/dst/a', b'x')])])
+
+    @unittest.skipIf(os.name == 'nt', "push_path is not supported on windows")
+    def test_push_path_request_error(self):
+        src = tempfile.TemporaryDirectory()
+        self.addCleanup(src.cleanup)
+        paths = [os.path.join(src.name, name) for name in ('a', 'b')]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write('x')
+        error = ops.pebble.ConnectionError('cannot connect')
+        with unittest.mock.patch.object(self.pebble, 'push_many', side_effect=error):
+            with self.assertRaises(ops.model.MultiPushPullError) as cm:
+                self.container.push_path(paths, '/dst')
+        self.assertEqual(cm.exception.errors, [(path, error) for path in sorted(paths)])
+
+    @unittest.skipIf(os.name == 'nt', "pull_path is not supported on windows")
+    def test_pull_path_unexpected_name(self):
+        dst = tempfile.TemporaryDirectory()
+        self.addCleanup(dst.cleanup)
+
+        def pull_many(paths, open_file):
+            open_file('/src/other')
+
+        self.pebble.responses = [[FileInfo(
+            path='/src/a', name='a', type=FileType.FILE, size=1, permissions=0o644,
+            last_modified=None, user_id=None, user=None, group_id=None, group=None)]]
+        with unittest.mock.patch.object(self.pebble, 'pull_many', side_effect=pull_many):
+            with self.assertRaises(ops.model.MultiPushPullError) as cm:
+                self.container.pull_path('/src/a', dst.name)
+        [(path, error)] = cm.exception.errors
+        self.assertEqual(path, '/src/a')
+        self.assertIsInstance(error, ops.pebble.ProtocolError)
+        self.assertEqual(os.listdir(dst.name), [])
+
+    @unittest.skipIf(os.name == 'nt', "pull_path is not supported on windows")
+    def test_pull_path_batches(self):
+        dst = tempfile.TemporaryDirectory()
+        self.addCleanup(dst.cleanup)
+        self.container._batch_files = 2
+
+        def file_info(path):
+            return FileInfo(path=path, name=os.path.basename(path), type=FileType.FILE,
+                            size=10, permissions=0o644, last_modified=None,
+                            user_id=None, user=None, group_id=None, group=None)
+
+        def dir_info(path):
+            return FileInfo(path=path, name=os.path.basename(path), type=FileType.DIRECTORY,
+                            size=None, permissions=0o755, last_modified=None,
+                            user_id=None, user=None, group_id=None, group=None)
+
+        error = ops.pebble.PathError('permission-denied', 'denied')
+        self.pebble.responses = [
+            [dir_info('/src/a'), file_info('/src/b')],  # list /src
+            [file_info('/src/a/c'), file_info('/src/a/d')],  # list /src/a
+            {},
+            {'/src/b': error},
+        ]
+        with self.assertRaises(ops.model.MultiPushPullError) as cm:
+            self.container.pull_path('/src', dst.name)
+        self.assertEqual(cm.exception.errors, [('/src', error)])
+        self.assertEqual(self.pebble.requests[2:], [
+            ('pull_many', ['/src/a/c', '/src/a/d']),
+            ('pull_many', ['/src/b']),
+        ])
+        with open(os.path.join(dst.name, 'src', 'a', 'd')) as f:
+            self.assertEqual(f.read(), '/src/a/d')
+
     def test_list_files(self):
         self.pebble.responses.append('dummy1')
         ret = self.container.list_files('/path/1')
@@ -1617,8 +2057,18 @@ class MockPebbleClient:
         self.requests.append(('get_checks', level, names))
         return self.responses.pop(0)
 
-    def pull(self, path, *, encoding='utf-8'):
-        self.requests.append(('pull', path, encoding))
+    def pull(self, path, *, encoding='utf-8', stream=False):
+        self.requests.append(('pull', path, encoding, stream))
+        return self.responses.pop(0)
+
+    def pull_to(self, path, dest):
+        self.requests.append(('pull_to', path, dest))
+
+    def pull_many(self, paths, open_file):
+        self.requests.append(('pull_many', paths))
+        for path in paths:
+            with open_file(path) as f:
+                f.write(path.encode())
         return self.responses.pop(0)
 
     def push(self, path, source, *, encoding='utf-8', make_dirs=False, permissions=None,
@@ -1626,6 +2076,11 @@ class MockPebbleClient:
         self.requests.append(('push', path, source, encoding, make_dirs, permissions,
                               user_id, user, group_id, group))
 
+    def push_many(self, files, *, encoding='utf-8'):
+        # Read the sources like the real client does, so that lazily opened files are closed.
+        self.requests.append(('push_many', [(f['path'], f['source'].read()) for f in files]))
+        return self.responses.pop(0)
+
     def list_files(self, path, *, pattern=None, itself=False):
         self.requests.append(('list_files', path, pattern, itself))
         return self.responses.pop(0)
@@ -1933,6 +2388,35 @@ class TestModelBackend(unittest.TestCase):
         self.backend._leader_check_time = None
         self.assertTrue(model.unit.is_leader())
 
+    def test_logging_sent_before_other_tools(self):
+        fake_script(self, 'juju-log', 'exit 0')
+        fake_script(self, 'config-get', "echo '{}'")
+        fake_script(self, 'status-set', 'exit 0')
+        handler = ops.log.BufferedJujuLogHandler(self.backend)
+        logging.getLogger().addHandler(handler)
+        self.addCleanup(logging.getLogger().removeHandler, handler)
+        logger = logging.getLogger('test_model')
+        logger.setLevel(logging.INFO)
+        self.addCleanup(logger.setLevel, logging.NOTSET)
+
+        logger.info('before')
+        # Reading doesn't change anything, so the logging can wait.
+        self.backend.config_get()
+        self.assertEqual(fake_script_calls(self, clear=True), [['config-get', '--format=json']])
+        self.backend.status_set('active')
+        self.assertEqual(fake_script_calls(self, clear=True), [
+            ['juju-log', '--log-level', 'INFO', '--', 'before'],
+            ['status-set', '--application=False', 'active', ''],
+        ])
+
+    def _relation_set_and_flush(self, *args, **kwargs):
+        self.backend.relation_set(*args, **kwargs)
+        try:
+            self.backend.relation_set_flush()
+        finally:
+            # A failed write is kept to be retried; drop it so that it's not in the next call.
+            self.backend._relation_data_pending.clear()
+
     def test_relation_tool_errors(self):
         self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
         os.environ['JUJU_VERSION'] = '2.8.0'
@@ -1950,17 +2434,17 @@ class TestModelBackend(unittest.TestCase):
             [['relation-list', '-r', '3', '--format=json']],
         ), (
             lambda: fake_script(self, 'relation-set', 'echo fooerror >&2 ; exit 1'),
-            lambda: self.backend.relation_set(3, 'foo', 'bar', is_app=False),
+            lambda: self._relation_set_and_flush(3, 'foo', 'bar', is_app=False),
             ops.model.ModelError,
             [['relation-set', '-r', '3', 'foo=bar']],
         ), (
             lambda: fake_script(self, 'relation-set', 'echo {} >&2 ; exit 2'.format(err_msg)),
-            lambda: self.backend.relation_set(3, 'foo', 'bar', is_app=False),
+            lambda: self._relation_set_and_flush(3, 'foo', 'bar', is_app=False),
             ops.model.RelationNotFoundError,
             [['relation-set', '-r', '3', 'foo=bar']],
         ), (
             lambda: None,
-            lambda: self.backend.relation_set(3, 'foo', 'bar', is_app=True),
+            lambda: self._relation_set_and_flush(3, 'foo', 'bar', is_app=True),
             ops.model.RelationNotFoundError,
             [['relation-set', '-r', '3', 'foo=bar', '--app']],
         ), (
@@ -1987,6 +2471,96 @@ class TestModelBackend(unittest.TestCase):
                     run()
                 self.assertEqual(fake_script_calls(self, clear=True), calls)
 
+    def test_tool_cache(self):
+        fake_script(self, 'config-get', """echo '{"foo": "bar"}'""")
+        fake_script(self, 'relation-list', """echo '["remote/0"]'""")
+
+        config = self.backend.config_get()
+        self.assertEqual(config, {'foo': 'bar'})
+        # Each call gets its own copy of the result.
+        config['foo'] = 'baz'
+        self.assertEqual(self.backend.config_get(), {'foo': 'bar'})
+        self.assertEqual(self.backend.relation_list(1), ['remote/0'])
+        self.assertEqual(self.backend.relation_list(2), ['remote/0'])
+        self.assertEqual(self.backend.relation_list(1), ['remote/0'])
+
+        self.assertEqual(fake_script_calls(self, clear=True), [
+            ['config-get', '--format=json'],
+            ['relation-list', '-r', '1', '--format=json'],
+            ['relation-list', '-r', '2', '--format=json'],
+        ])
+        self.assertEqual(self.backend.tool_cache_stats(), {'hits': 2, 'misses': 3})
+        model = ops.model.Model(ops.charm.CharmMeta(), self.backend)
+        self.assertEqual(model.tool_cache_stats, {'hits': 2, 'misses': 3})
+
+        self.backend._tool_cache.clear()
+        self.backend.config_get()
+        self.assertEqual(fake_script_calls(self), [['config-get', '--format=json']])
+
+    def test_tool_cache_skips_goal_state(self):
+        fake_script(self, 'goal-state', """echo '{"units": {}}'""")
+        self.assertEqual(self.backend.planned_units(), 0)
+        self.assertEqual(self.backend.planned_units(), 0)
+        # Units can come and go during a hook, so goal-state is run each time.
+        self.assertEqual(fake_script_calls(self), [
+            ['goal-state', '--format=json'],
+            ['goal-state', '--format=json'],
+        ])
+
+    def test_tool_cache_errors_not_cached(self):
+        fake_script(self, 'relation-list', 'echo fooerror >&2 ; exit 1')
+        for _ in range(2):
+            with self.assertRaises(ops.model.ModelError):
+                self.backend.relation_list(1)
+        self.assertEqual(len(fake_script_calls(self)), 2)
+
+    def test_tool_cache_relation_set_invalidates(self):
+        self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
+        os.environ['JUJU_VERSION'] = '2.8.0'
+        fake_script(self, 'relation-get', """echo '{"foo": "bar"}'""")
+        fake_script(self, 'relation-set', 'exit 0')
+
+        def relation_get_calls():
+            calls = fake_script_calls(self, clear=True)
+            return [c for c in calls if c[0] == 'relation-get']
+
+        for member, is_app in [('myapp/0', False), ('myapp', True), ('remote/0', False)]:
+            self.backend.relation_get(1, member, is_app)
+            self.backend.relation_get(2, member, is_app)
+        self.assertEqual(len(relation_get_calls()), 6)
+
+        # Only this unit's bag in relation 1 is read again.
+        self._relation_set_and_flush(1, 'foo', 'baz', is_app=False)
+        for member, is_app in [('myapp/0', False), ('myapp', True), ('remote/0', False)]:
+            self.backend.relation_get(1, member, is_app)
+            self.backend.relation_get(2, member, is_app)
+        self.assertEqual(relation_get_calls(), [
+            ['relation-get', '-r', '1', '-', 'myapp/0', '--format=json'],
+        ])
+
+        # And only the app's bag for app data.
+        self._relation_set_and_flush(2, 'foo', 'baz', is_app=True)
+        for member, is_app in [('myapp/0', False), ('myapp', True)]:
+            self.backend.relation_get(2, member, is_app)
+        self.assertEqual(relation_get_calls(), [
+            ['relation-get', '-r', '2', '-', 'myapp', '--app', '--format=json'],
+        ])
+
+    def test_tool_cache_storage_add_invalidates(self):
+        fake_script(self, 'storage-list', """echo '["disks/0"]'""")
+        fake_script(self, 'storage-add', 'exit 0')
+        self.backend.storage_list('disks')
+        self.backend.storage_list('other')
+        self.backend.storage_add('disks', 1)
+        self.backend.storage_list('disks')
+        self.backend.storage_list('other')
+        self.assertEqual(fake_script_calls(self), [
+            ['storage-list', 'disks', '--format=json'],
+            ['storage-list', 'other', '--format=json'],
+            ['storage-add', 'disks=1'],
+            ['storage-list', 'disks', '--format=json'],
+        ])
+
     def test_relation_get_juju_version_quirks(self):
         self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
 
@@ -1996,6 +2570,8 @@ class TestModelBackend(unittest.TestCase):
         for v in ['2.8.0', '2.7.0']:
             with self.subTest(v):
                 os.environ['JUJU_VERSION'] = v
+                # Each version is a separate dispatch.
+                self.backend._tool_cache.clear()
                 rel_data = self.backend.relation_get(1, 'foo/0', is_app=True)
                 self.assertEqual(rel_data, {"foo": "bar"})
                 calls = [' '.join(i) for i in fake_script_calls(self, clear=True)]
@@ -2007,6 +2583,107 @@ class TestModelBackend(unittest.TestCase):
             self.backend.relation_get(1, 'foo/0', is_app=True)
         self.assertEqual(fake_script_calls(self), [])
 
+    def test_relation_prefetch_errors(self):
+        self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
+        os.environ['JUJU_VERSION'] = '2.8.0'
+        meta = ops.charm.CharmMeta.from_yaml('''
+            name: myapp
+            peers:
+              cluster:
+                interface: cluster
+        ''')
+        fake_script(self, 'relation-ids', """echo '["cluster:1"]'""")
+        fake_script(self, 'relation-list', """echo '["myapp/1", "myapp/2"]'""")
+        # Reading our app's data fails, as a non-leader would.
+        fake_script(self, 'relation-get', """
+            if [ "$4" = myapp ]; then echo 'ERROR permission denied' >&2; exit 2; fi
+            echo '{"unit": "'$4'"}'
+        """)
+        model = ops.model.Model(meta, self.backend)
+        relation = model.get_relation('cluster')
+        relation.prefetch()
+
+        unit = model.get_unit('myapp/2')
+        self.assertEqual(relation.data[unit]._lazy_data, {'unit': 'myapp/2'})
+        self.assertIsNone(relation.data[model.app]._lazy_data)
+        # The error is raised when the data is read.
+        with self.assertRaisesRegex(ops.model.ModelError, 'permission denied'):
+            relation.data[model.app]['foo']
+
+    def test_relation_set_batched(self):
+        self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
+        os.environ['JUJU_VERSION'] = '2.8.0'
+        fake_script(self, 'relation-set', 'exit 0')
+
+        for relation_id in [1, 2]:
+            for i in range(3):
+                self.backend.relation_set(relation_id, 'key{}'.format(i), 'v', is_app=False)
+        self.backend.relation_set(1, 'key0', 'new', is_app=False)
+        self.backend.relation_set(1, 'key1', '', is_app=False)
+        self.backend.relation_set(1, 'k', 'v', is_app=True)
+        self.assertEqual(fake_script_calls(self), [])
+
+        self.backend.relation_set_flush()
+        self.assertEqual(fake_script_calls(self, clear=True), [
+            ['relation-set', '-r', '1', 'key0=new', 'key1=', 'key2=v'],
+            ['relation-set', '-r', '2', 'key0=v', 'key1=v', 'key2=v'],
+            ['relation-set', '-r', '1', 'k=v', '--app'],
+        ])
+
+        # Nothing is left to write.
+        self.backend.relation_set_flush()
+        self.assertEqual(fake_script_calls(self), [])
+
+    def test_relation_set_read_your_writes(self):
+        self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
+        os.environ['JUJU_VERSION'] = '2.8.0'
+        fake_script(self, 'relation-get', """echo '{"a": "1", "b": "2"}'""")
+        fake_script(self, 'relation-set', 'exit 0')
+
+        self.backend.relation_set(1, 'a', '', is_app=False)
+        self.backend.relation_set(1, 'c', '3', is_app=False)
+        self.assertEqual(self.backend.relation_get(1, 'myapp/0', False), {'b': '2', 'c': '3'})
+        # Other bags aren't affected.
+        self.assertEqual(self.backend.relation_get(1, 'myapp', True), {'a': '1', 'b': '2'})
+        self.assertEqual(self.backend.relation_get(2, 'myapp/0', False), {'a': '1', 'b': '2'})
+        self.assertEqual(self.backend.relation_get(1, 'remote/0', False), {'a': '1', 'b': '2'})
+
+        # A Model reading the bag afresh sees the changes too.
+        meta = ops.charm.CharmMeta.from_yaml('''
+            name: myapp
+            requires:
+              db:
+                interface: db
+        ''')
+        fake_script(self, 'relation-ids', """echo '["db:1"]'""")
+        fake_script(self, 'relation-list', """
+            if [ "$3" = --app ]; then echo '"remote"'; else echo '[]'; fi
+        """)
+        model = ops.model.Model(meta, self.backend)
+        relation = model.get_relation('db')
+        self.assertEqual(relation.data[model.unit], {'b': '2', 'c': '3'})
+
+        model.flush()
+        self.assertIn(['relation-set', '-r', '1', 'a=', 'c=3'], fake_script_calls(self))
+
+    def test_relation_set_flush_large(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        tmpdir = tmpdir.name
+        fake_script(self, 'relation-set', 'cat "$4" > {}/settings.yaml'.format(tmpdir))
+        value = 'x' * (ops.model._ModelBackend._RELATION_SET_MAX_ARGS_LEN + 1)
+        self.backend.relation_set(1, 'big', value, is_app=False)
+        self.backend.relation_set(1, 'gone', '', is_app=False)
+        self.backend.relation_set_flush()
+
+        calls = fake_script_calls(self)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][:4], ['relation-set', '-r', '1', '--file'])
+        with open(os.path.join(tmpdir, 'settings.yaml')) as f:
+            self.assertEqual(yaml.safe_load(f), {'big': value, 'gone': ''})
+        # The settings file is cleaned up.
+        self.assertFalse(os.path.exists(calls[0][4]))
+
     def test_relation_set_juju_version_quirks(self):
         self.addCleanup(os.environ.pop, 'JUJU_VERSION', None)
 
@@ -2016,7 +2693,7 @@ class TestModelBackend(unittest.TestCase):
         for v in ['2.8.0', '2.7.0']:
             with self.subTest(v):
                 os.environ['JUJU_VERSION'] = v
-                self.backend.relation_set(1, 'foo', 'bar', is_app=True)
+                self._relation_set_and_flush(1, 'foo', 'bar', is_app=True)
                 calls = [' '.join(i) for i in fake_script_calls(self, clear=True)]
                 self.assertEqual(calls, ['relation-set -r 1 foo=bar --app'])
 
@@ -2432,6 +3109,137 @@ exit 2
         ])
 
 
+class _HangUpHandler(fake_jujuc.Handler):
+    """Reads a call, then closes the connection without replying."""
+
+    def handle(self):
+        decoder = ops._private.jujuc._Codec({})
+        if self.receive(decoder) is not None:
+            self.server.requests.append(self.receive(decoder))
+
+
+@unittest.skipIf(not hasattr(socket, 'AF_UNIX'), 'the agent socket is a Unix socket')
+class TestModelBackendJujuc(unittest.TestCase):
+
+    def setUp(self):
+        self.server, shutdown, self.socket_path = fake_jujuc.start_server()
+        self.addCleanup(shutdown)
+        for name, value in [('JUJU_AGENT_SOCKET_ADDRESS', self.socket_path),
+                            ('JUJU_CONTEXT_ID', 'test-context')]:
+            self.addCleanup(os.environ.pop, name, None)
+            os.environ[name] = value
+
+    def make_backend(self):
+        backend = ops.model._ModelBackend('myapp/0')
+        self.addCleanup(lambda: backend._jujuc and backend._jujuc.close())
+        return backend
+
+    def test_from_environ(self):
+        self.assertIsNotNone(self.make_backend()._jujuc)
+        os.environ['JUJU_AGENT_SOCKET_NETWORK'] = 'tcp'
+        self.addCleanup(os.environ.pop, 'JUJU_AGENT_SOCKET_NETWORK', None)
+        self.assertIsNone(self.make_backend()._jujuc)
+        del os.environ['JUJU_AGENT_SOCKET_NETWORK']
+        del os.environ['JUJU_CONTEXT_ID']
+        self.assertIsNone(self.make_backend()._jujuc)
+
+    def test_abstract_address(self):
+        client = ops._private.jujuc.Client('@jujud-myapp-0', 'test-context')
+        self.assertEqual(client._address, '\0jujud-myapp-0')
+
+    def test_runs_tools_through_agent(self):
+        fake_script(self, 'config-get', """echo '{"foo": "bar"}'""")
+        fake_script(self, 'is-leader', 'echo true')
+        backend = self.make_backend()
+        self.assertEqual(backend.config_get(), {'foo': 'bar'})
+        self.assertTrue(backend.is_leader())
+        self.assertEqual([(r['ContextId'], r['CommandName'], r['Args'], r['Dir'])
+                          for r in self.server.requests], [
+            ('test-context', 'config-get', ['--format=json'], os.getcwd()),
+            ('test-context', 'is-leader', ['--format=json'], os.getcwd()),
+        ])
+        self.assertEqual(fake_script_calls(self), [
+            ['config-get', '--format=json'],
+            ['is-leader', '--format=json'],
+        ])
+        # The connection is reused.
+        self.assertEqual(len(backend._jujuc._idle), 1)
+
+    def test_tool_error(self):
+        fake_script(self, 'relation-get', """
+            echo 'ERROR invalid value "1" for option -r: relation not found' >&2
+            exit 2
+        """)
+        backend = self.make_backend()
+        with self.assertRaises(ops.model.RelationNotFoundError):
+            backend.relation_get(1, 'myapp/0', is_app=False)
+        with self.assertRaises(ops.model.ModelError) as cm:
+            backend._run('relation-get', '-r', '1')
+        self.assertEqual(cm.exception.args[0],
+                         b'ERROR invalid value "1" for option -r: relation not found\n')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIsNotNone(backend._jujuc)
+
+    def test_call_error_falls_back_to_process(self):
+        fake_script(self, 'is-leader', 'echo true')
+        self.server.context_id = 'other-context'
+        backend = self.make_backend()
+        self.assertTrue(backend.is_leader())
+        # The agent refused the request, so the tool was run as a process instead.
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(fake_script_calls(self), [['is-leader', '--format=json']])
+        self.assertIsNotNone(backend._jujuc)
+
+    def test_connect_error_falls_back_to_process(self):
+        fake_script(self, 'is-leader', 'echo true')
+        os.environ['JUJU_AGENT_SOCKET_ADDRESS'] = self.socket_path + '.missing'
+        backend = self.make_backend()
+        self.assertTrue(backend.is_leader())
+        self.assertEqual(fake_script_calls(self), [['is-leader', '--format=json']])
+        # The client is not tried again.
+        self.assertIsNone(backend._jujuc)
+        self.assertEqual(self.server.requests, [])
+
+    def test_connection_lost_after_call_sent(self):
+        fake_script(self, 'add-metric', 'exit 0')
+        server, shutdown, socket_path = fake_jujuc.start_server(handler=_HangUpHandler)
+        self.addCleanup(shutdown)
+        os.environ['JUJU_AGENT_SOCKET_ADDRESS'] = socket_path
+        backend = self.make_backend()
+        # The agent may have run the tool, so it's not run again as a process.
+        with self.assertRaises(ops.model.ModelError):
+            backend.add_metrics({'foo': 42})
+        self.assertEqual([r['CommandName'] for r in server.requests], ['add-metric'])
+        self.assertEqual(fake_script_calls(self), [])
+
+    def test_stale_connection_replaced(self):
+        fake_script(self, 'is-leader', 'echo true')
+        backend = self.make_backend()
+        self.assertTrue(backend.is_leader())
+        # The agent closes the idle connection.
+        idle = backend._jujuc._idle[0]
+        idle._sock.shutdown(socket.SHUT_RDWR)
+        backend._leader_check_time = None
+        self.assertTrue(backend.is_leader())
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIsNotNone(backend._jujuc)
+        self.assertEqual(len(backend._jujuc._idle), 1)
+        self.assertIsNot(backend._jujuc._idle[0], idle)
+
+    def test_failed_send_on_idle_connection_retried(self):
+        fake_script(self, 'is-leader', 'echo true')
+        backend = self.make_backend()
+        self.assertTrue(backend.is_leader())
+        idle = backend._jujuc._idle[0]
+        idle._sock.shutdown(socket.SHUT_WR)
+        # The agent hasn't noticed yet, so the connection looks usable until it's used.
+        with unittest.mock.patch.object(idle, 'is_dropped', return_value=False):
+            backend._leader_check_time = None
+            self.assertTrue(backend.is_leader())
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(fake_script_calls(self), [['is-leader', '--format=json']] * 2)
+
+
 class TestLazyMapping(unittest.TestCase):
 
     def test_invalidate(self):
@@ -16,10 +16,13 @@
 import cgi
 import datetime
 import email.parser
+import http.client
 import io
+import itertools
 import json
 import os
 import signal
+import socket
 import sys
 import tempfile
 import test.fake_pebble as fake_pebble
@@ -34,6 +37,7 @@ import uuid
 
 import pytest
 
+import ops.model
 import ops.pebble as pebble
 from ops._private import yaml
 from ops._vendor import websocket
@@ -885,6 +889,34 @@ class TestCheck(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.assertEqual(one, 5)
 
+    def test_merge(self):
+        check = pebble.Check('chk', {
+            'override': 'replace',
+            'level': 'alive',
+            'period': '10s',
+            'http': {'url': 'https://example.com/', 'headers': {'A': 'a'}},
+        })
+        other = {
+            'override': 'merge',
+            'timeout': '3s',
+            'http': {'url': 'https://example.org/'},
+        }
+        check._merge(pebble.Check('other', other))
+        self.assertEqual(check.to_dict(), {
+            'override': 'merge',
+            'level': 'alive',
+            'period': '10s',
+            'timeout': '3s',
+            'http': {'url': 'https://example.org/', 'headers': {'A': 'a'}},
+        })
+        self.assertEqual(check.name, 'chk')
+
+        # Ensure the merge has made copies of mutable objects
+        other = pebble.Check('other', {'tcp': {'port': 80}})
+        check._merge(other)
+        check.tcp['port'] = 81
+        self.assertEqual(other.tcp, {'port': 80})
+
 
 class TestServiceInfo(unittest.TestCase):
     def test_service_startup(self):
@@ -1047,6 +1079,7 @@ class MockHTTPResponse:
         self.headers = headers
         reader = io.BytesIO(body)
         self.read = reader.read
+        self.close = reader.close
 
 
 class MockTime:
@@ -1192,6 +1225,13 @@ class TestMultipartParser(unittest.TestCase):
                 [b'foo bar', b'foo baz'],
                 want_bodies_done=[True, True],
             ),
+            TestMultipartParser._Case(
+                'body containing boundary lookalike',
+                b'\r\n--qwerty\r\nheader foo\r\n\r\nfoo\r\n--qwertyz bar\r\n--qwerty--\r\n',
+                [b'header foo\r\n\r\n'],
+                [b'foo\r\n--qwertyz bar'],
+                want_bodies_done=[True],
+            ),
             TestMultipartParser._Case(
                 'ignore after terminal boundary',
                 b'\r\n--qwerty \t \r\nheader foo\r\n\r\nfoo bar\r\n--qwerty--\r\nheader bar\r\n\r\nfoo baz\r\n--qwerty--\r\n',  # noqa
@@ -1246,6 +1286,18 @@ class TestMultipartParser(unittest.TestCase):
                     self.assertEqual(test.want_bodies, bodies, msg)
                     self.assertEqual(test.want_bodies_done, bodies_done, msg)
 
+    def test_buffer_is_compacted(self):
+        received = []
+        parser = pebble._MultipartParser(
+            b'qwerty', lambda data: None, lambda data, done=False: received.append(len(data)))
+        parser.feed(b'\r\n--qwerty\r\nheader foo\r\n\r\n')
+        for _ in range(1000):
+            parser.feed(b'x' * 1000)
+            # Body data consumed by the handler doesn't accumulate in the buffer.
+            self.assertLess(len(parser._buf), 3000)
+        parser.feed(b'\r\n--qwerty--\r\n')
+        self.assertEqual(sum(received), 1000 * 1000)
+
 
 class TestClient(unittest.TestCase):
     maxDiff = None
@@ -1257,6 +1309,20 @@ class TestClient(unittest.TestCase):
         time_patcher.start()
         self.addCleanup(time_patcher.stop)
 
+    def test_chunk_sizes(self):
+        sizes = list(itertools.islice(self.client._chunk_sizes(), 10))
+        self.assertEqual(sizes[:3], [8192, 16384, 32768])
+        self.assertEqual(sizes[5:], [256 * 1024] * 5)
+        self.assertEqual(list(itertools.islice(self.client._chunk_sizes(100), 3)), [100] * 3)
+
+        client = pebble.Client(socket_path='/nonexistent', chunk_size=4096)
+        self.assertEqual(list(itertools.islice(client._chunk_sizes(), 3)), [4096] * 3)
+        self.assertEqual(list(itertools.islice(client._chunk_sizes(100), 3)), [100] * 3)
+        with self.assertRaises(ValueError):
+            pebble.Client(socket_path='/nonexistent', chunk_size=0)
+        with self.assertRaises(ValueError):
+            client._chunk_sizes(-1)
+
     def test_client_init(self):
         pebble.Client(socket_path='foo')  # test that constructor runs
         with self.assertRaises(ValueError):
@@ -1893,6 +1959,113 @@ Content-Disposition: form-data; name="response"\r
                 {'Accept': 'multipart/form-data'}, None),
         ])
 
+    def test_pull_many(self):
+        self.client.responses.append((
+            {'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'},
+            b"""\
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="files"; filename="/etc/hosts"\r
+\r
+127.0.0.1 localhost\r
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="files"; filename="/etc/empty"\r
+\r
+\r
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="response"\r
+\r
+{
+    "result": [
+        {"path": "/etc/hosts"},
+        {"path": "/etc/empty"},
+        {"path": "/etc/missing", "error": {"kind": "not-found", "message": "not found"}}
+    ],
+    "status": "OK",
+    "status-code": 200,
+    "type": "sync"
+}\r
+--01234567890123456789012345678901--\r
+""",
+        ))
+
+        files = {}
+
+        def open_file(path):
+            files[path] = io.BytesIO()
+            files[path].close = lambda: None
+            return files[path]
+
+        errors = self.client.pull_many(['/etc/hosts', '/etc/empty', '/etc/missing'], open_file)
+        self.assertEqual(list(errors), ['/etc/missing'])
+        self.assertEqual(errors['/etc/missing'].kind, 'not-found')
+        self.assertEqual({path: f.getvalue() for path, f in files.items()}, {
+            '/etc/hosts': b'127.0.0.1 localhost',
+            '/etc/empty': b'',
+        })
+
+        self.assertEqual(self.client.requests, [
+            ('GET', '/v1/files', {'action': 'read', 'path': ['/etc/hosts', '/etc/empty',
+                                                             '/etc/missing']},
+                {'Accept': 'multipart/form-data'}, None),
+        ])
+
+    def test_pull_many_unexpected_path(self):
+        self.client.responses.append((
+            {'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'},
+            b"""\
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="files"; filename="/etc/other"\r
+\r
+foo\r
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="response"\r
+\r
+{"result": [{"path": "/etc/hosts"}], "status": "OK", "status-code": 200, "type": "sync"}\r
+--01234567890123456789012345678901--\r
+""",
+        ))
+        opened = []
+        with self.assertRaises(pebble.ProtocolError) as cm:
+            self.client.pull_many(['/etc/hosts'], opened.append)
+        self.assertEqual(str(cm.exception), "path not expected: '/etc/other'")
+        # Nothing is opened for the unexpected path.
+        self.assertEqual(opened, [])
+
+    def test_pull_many_closes_files_on_error(self):
+        headers = {
+            'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'}
+        chunks = [b"""\
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="files"; filename="/etc/hosts"\r
+\r
+127.0.0.1 localhost""", ConnectionResetError()]
+
+        def read(size):
+            chunk = chunks.pop(0)
+            if isinstance(chunk, Exception):
+                raise chunk
+            return chunk
+
+        response = MockHTTPResponse(headers, b'')
+        response.read = read
+        response.close = unittest.mock.Mock()
+        opened = []
+
+        def open_file(path):
+            opened.append(io.BytesIO())
+            return opened[-1]
+
+        with unittest.mock.patch.object(self.client, '_request_raw', return_value=response):
+            with self.assertRaises(ConnectionResetError):
+                self.client.pull_many(['/etc/hosts'], open_file)
+        self.assertEqual(len(opened), 1)
+        self.assertTrue(opened[0].closed)
+        response.close.assert_called_once_with()
+
+    def test_pull_many_nothing(self):
+        self.assertEqual(self.client.pull_many([], None), {})
+        self.assertEqual(self.client.requests, [])
+
     def test_pull_binary(self):
         self.client.responses.append((
             {'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'},
@@ -1923,6 +2096,95 @@ Content-Disposition: form-data; name="response"\r
                 {'Accept': 'multipart/form-data'}, None),
         ])
 
+    _pull_hosts_response = (
+        {'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'},
+        b"""\
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="files"; filename="/etc/hosts"\r
+\r
+127.0.0.1 localhost  # \xf0\x9f\x98\x80\nfoo\r\nbar\r
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="response"\r
+\r
+{
+    "result": [{"path": "/etc/hosts"}],
+    "status": "OK",
+    "status-code": 200,
+    "type": "sync"
+}\r
+--01234567890123456789012345678901--\r
+""",
+    )
+
+    def test_pull_stream_text(self):
+        self.client._chunk_size = 13
+        self.client.responses.append(self._pull_hosts_response)
+        with self.client.pull('/etc/hosts', stream=True) as infile:
+            self.assertEqual(infile.read(), '127.0.0.1 localhost  # 😀\nfoo\r\nbar')
+
+    def test_pull_stream_binary(self):
+        self.client._chunk_size = 13
+        self.client.responses.append(self._pull_hosts_response)
+        with self.client.pull('/etc/hosts', encoding=None, stream=True) as infile:
+            self.assertEqual(infile.read(4), b'127.')
+            self.assertEqual(infile.read(), b'0.0.1 localhost  # \xf0\x9f\x98\x80\nfoo\r\nbar')
+            self.assertEqual(infile.read(), b'')
+
+    def test_pull_stream_path_error(self):
+        self.client.responses.append((
+            {'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'},
+            b"""\
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="response"\r
+\r
+{
+    "result": [
+        {"path": "/etc/hosts", "error": {"kind": "not-found", "message": "not found"}}
+    ],
+    "status": "OK",
+    "status-code": 200,
+    "type": "sync"
+}\r
+--01234567890123456789012345678901--\r
+""",
+        ))
+        # The error is raised by pull itself, not when reading.
+        with self.assertRaises(pebble.PathError) as cm:
+            self.client.pull('/etc/hosts', stream=True)
+        self.assertEqual(cm.exception.kind, 'not-found')
+
+    def test_pull_to(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        dest = os.path.join(tmpdir.name, 'hosts')
+        self.client.responses.append(self._pull_hosts_response)
+        self.client.pull_to('/etc/hosts', dest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'127.0.0.1 localhost  # \xf0\x9f\x98\x80\nfoo\r\nbar')
+        self.assertEqual(self.client.requests, [
+            ('GET', '/v1/files', {'action': 'read', 'path': ['/etc/hosts']},
+                {'Accept': 'multipart/form-data'}, None),
+        ])
+
+    def test_pull_to_path_error(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        dest = os.path.join(tmpdir.name, 'hosts')
+        self.client.responses.append((
+            {'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'},
+            b"""\
+--01234567890123456789012345678901\r
+Content-Disposition: form-data; name="response"\r
+\r
+{"result": [{"path": "/etc/hosts", "error": {"kind": "not-found", "message": "not found"}}],
+ "status": "OK", "status-code": 200, "type": "sync"}\r
+--01234567890123456789012345678901--\r
+""",
+        ))
+        with self.assertRaises(pebble.PathError):
+            self.client.pull_to('/etc/hosts', dest)
+        self.assertFalse(os.path.exists(dest))
+
     def test_pull_path_error(self):
         self.client.responses.append((
             {'Content-Type': 'multipart/form-data; boundary=01234567890123456789012345678901'},
@@ -2187,7 +2449,61 @@ bad path\r
             'files': [{'path': '/foo/bar'}],
         })
 
+    def test_push_many(self):
+        self.client.responses.append((
+            {'Content-Type': 'application/json'},
+            b"""
+{
+    "result": [
+        {"path": "/foo/bar"},
+        {"path": "/foo/baz", "error": {"kind": "permission-denied", "message": "denied"}},
+        {"path": "/qux"}
+    ],
+    "status": "OK",
+    "status-code": 200,
+    "type": "sync"
+}
+""",
+        ))
+
+        errors = self.client.push_many([
+            {'path': '/foo/bar', 'source': 'content 😀', 'make_dirs': True},
+            {'path': '/foo/baz', 'source': io.BytesIO(b'\x00\x01'), 'permissions': 0o600},
+            {'path': '/qux', 'source': io.StringIO(''), 'user': 'bob'},
+        ])
+        self.assertEqual(list(errors), ['/foo/baz'])
+        self.assertEqual(errors['/foo/baz'].kind, 'permission-denied')
+        self.assertEqual(errors['/foo/baz'].message, 'denied')
+
+        self.assertEqual(len(self.client.requests), 1)
+        request = self.client.requests[0]
+        self.assertEqual(request[:3], ('POST', '/v1/files', None))
+        headers, body = request[3:]
+        req, files = self._parse_write_multipart_files(headers['Content-Type'], body)
+        self.assertEqual(req, {
+            'action': 'write',
+            'files': [
+                {'path': '/foo/bar', 'make-dirs': True},
+                {'path': '/foo/baz', 'permissions': '600'},
+                {'path': '/qux', 'user': 'bob'},
+            ],
+        })
+        self.assertEqual(files, [
+            ('/foo/bar', 'content 😀'.encode('utf-8')),
+            ('/foo/baz', b'\x00\x01'),
+            ('/qux', b''),
+        ])
+
+    def test_push_many_nothing(self):
+        self.assertEqual(self.client.push_many([]), {})
+        self.assertEqual(self.client.requests, [])
+
     def _parse_write_multipart(self, content_type, body):
+        req, files = self._parse_write_multipart_files(content_type, body)
+        filename, content = files[-1] if files else (None, None)
+        return (req, filename, content)
+
+    def _parse_write_multipart_files(self, content_type, body):
         ctype, options = cgi.parse_header(content_type)
         self.assertEqual(ctype, 'multipart/form-data')
         boundary = options['boundary']
@@ -2203,17 +2519,15 @@ bad path\r
         message = parser.close()
 
         req = None
-        filename = None
-        content = None
+        files = []
         for part in message.walk():
             name = part.get_param('name', header='Content-Disposition')
             if name == 'request':
                 req = json.loads(part.get_payload())
             elif name == 'files':
                 # decode=True, ironically, avoids decoding bytes to str
-                content = part.get_payload(decode=True)
-                filename = part.get_filename()
-        return (req, filename, content)
+                files.append((part.get_filename(), part.get_payload(decode=True)))
+        return (req, files)
 
     def test_list_files_path(self):
         self.client.responses.append({
@@ -2537,6 +2851,215 @@ class TestSocketClient(unittest.TestCase):
         finally:
             shutdown()
 
+    def start_client(self):
+        shutdown, socket_path = fake_pebble.start_server()
+        self.addCleanup(shutdown)
+        client = pebble.Client(socket_path=socket_path)
+        self.addCleanup(client.close)
+        handler = next(h for h in client.opener.handlers
+                       if isinstance(h, pebble._UnixSocketHandler))
+        return client, handler
+
+    def test_connection_reused(self):
+        client, handler = self.start_client()
+        with unittest.mock.patch.object(
+                pebble._UnixSocketConnection, 'connect', autospec=True,
+                side_effect=pebble._UnixSocketConnection.connect) as connect:
+            for _ in range(3):
+                self.assertEqual(client.get_system_info().version, '3.14.159')
+            # Error responses leave the connection usable too.
+            with self.assertRaises(pebble.APIError):
+                client.start_services(['bar'], timeout=0)
+            self.assertEqual(client.get_system_info().version, '3.14.159')
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(handler._idle), 1)
+
+        client.close()
+        self.assertEqual(handler._idle, [])
+        self.assertEqual(client.get_system_info().version, '3.14.159')
+
+    def test_unread_response_not_reused(self):
+        client, handler = self.start_client()
+        response = client._request_raw('GET', '/v1/system-info')
+        response.close()
+        self.assertEqual(handler._idle, [])
+        self.assertEqual(client.get_system_info().version, '3.14.159')
+        self.assertEqual(len(handler._idle), 1)
+
+    def test_stale_connection_retried(self):
+        client, handler = self.start_client()
+        client.get_system_info()
+        conn = handler._idle[0]
+        # Make it look like the server closed the connection after the readiness check.
+        conn.sock.shutdown(socket.SHUT_RDWR)
+        with unittest.mock.patch('select.select', return_value=([], [], [])):
+            self.assertEqual(client.get_system_info().version, '3.14.159')
+        self.assertEqual(len(handler._idle), 1)
+
+    def test_stale_connection_retried_before_sending(self):
+        client, handler = self.start_client()
+        client.get_system_info()
+        handler._idle[0].sock.shutdown(socket.SHUT_RDWR)
+        with unittest.mock.patch('select.select', return_value=([], [], [])):
+            # Nothing of the request was sent, so even a POST is sent again.
+            self.assertEqual(client.start_services(['foo'], timeout=0), '1234')
+
+    def test_connection_lost_after_sending(self):
+        client, handler = self.start_client()
+        client.get_system_info()
+        getresponse = pebble._UnixSocketConnection.getresponse
+        lost = []
+
+        def lose_first_response(conn):
+            if not lost:
+                lost.append(conn)
+                raise http.client.RemoteDisconnected('closed')
+            return getresponse(conn)
+
+        with unittest.mock.patch.object(
+                pebble._UnixSocketConnection, 'getresponse', lose_first_response):
+            # The server may have started the service, so the request isn't sent again.
+            with self.assertRaises(pebble.ConnectionError):
+                client.start_services(['foo'], timeout=0)
+
+            # Leave an idle connection again, then lose the response to a GET on it.
+            client.get_system_info()
+            lost.clear()
+            # Reading is safe to do twice, so the request is sent again.
+            self.assertEqual(client.get_system_info().version, '3.14.159')
+            self.assertEqual(len(lost), 1)
+
+    def test_concurrent_requests(self):
+        client, handler = self.start_client()
+        errors = []
+
+        def run():
+            try:
+                for _ in range(20):
+                    self.assertEqual(client.get_system_info().version, '3.14.159')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(handler._idle), handler.max_idle)
+
+    @unittest.skipIf(sys.version_info[:2] < (3, 6), "generator bodies are joined on 3.5")
+    def test_push_sendfile(self):
+        client, _ = self.start_client()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        src, dst = os.path.join(tmpdir.name, 'src'), os.path.join(tmpdir.name, 'dst')
+        content = os.urandom(100000) + b'\r\n--not-a-boundary\r\n'
+        with open(src, 'wb') as f:
+            f.write(content)
+
+        sendfile = socket.socket.sendfile
+        with unittest.mock.patch.object(
+                socket.socket, 'sendfile', autospec=True, side_effect=sendfile) as mock:
+            with open(src, 'rb') as f:
+                f.read(10)
+                client.push(dst, f)
+                # The file is left at the end, as if it had been read.
+                self.assertEqual(f.tell(), len(content))
+        self.assertEqual(mock.call_count, 1)
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), content[10:])
+
+        # Text files and in-memory sources are read in chunks, in the same request.
+        with unittest.mock.patch.object(
+                socket.socket, 'sendfile', autospec=True, side_effect=sendfile) as mock:
+            with open(src, 'rb') as binary, open(__file__) as text:
+                errors = client.push_many([
+                    {'path': dst + '1', 'source': binary},
+                    {'path': dst + '2', 'source': text},
+                    {'path': dst + '3', 'source': io.BytesIO(b'bytes')},
+                    {'path': dst + '4', 'source': 'str'},
+                ])
+        self.assertEqual(errors, {})
+        self.assertEqual(mock.call_count, 1)
+        with open(dst + '1', 'rb') as f:
+            self.assertEqual(f.read(), content)
+        with open(dst + '2') as f, open(__file__) as text:
+            self.assertEqual(f.read(), text.read())
+        with open(dst + '3', 'rb') as f:
+            self.assertEqual(f.read(), b'bytes')
+        with open(dst + '4') as f:
+            self.assertEqual(f.read(), 'str')
+
+    @unittest.skipIf(sys.version_info[:2] < (3, 6), "generator bodies are joined on 3.5")
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc to count open files")
+    def test_push_sendfile_closes_lazy_sources(self):
+        client, _ = self.start_client()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        srcs = []
+        for i in range(200):
+            srcs.append(os.path.join(tmpdir.name, 'src{}'.format(i)))
+            with open(srcs[-1], 'wb') as f:
+                f.write(str(i).encode('ascii') * 100)
+
+        open_fds = []
+        sendfile = socket.socket.sendfile
+
+        def count_fds(sock, file, offset=0, count=None):
+            open_fds.append(len(os.listdir('/proc/self/fd')))
+            return sendfile(sock, file, offset, count)
+
+        sources = [ops.model._LazyFile(src) for src in srcs]
+        before = len(os.listdir('/proc/self/fd'))
+        with unittest.mock.patch.object(socket.socket, 'sendfile', count_fds):
+            errors = client.push_many([
+                {'path': src + '.dst', 'source': source} for src, source in zip(srcs, sources)])
+        self.assertEqual(errors, {})
+        self.assertEqual(len(open_fds), len(srcs))
+        # Each source is closed once sent, rather than all of them staying open until the
+        # end of the request.
+        self.assertLess(max(open_fds), before + 10)
+        for i, src in enumerate(srcs):
+            with open(src + '.dst', 'rb') as f:
+                self.assertEqual(f.read(), str(i).encode('ascii') * 100)
+
+    def test_pull_chunk_sizes(self):
+        client, _ = self.start_client()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        src, dst = os.path.join(tmpdir.name, 'src'), os.path.join(tmpdir.name, 'dst')
+        content = os.urandom(3 * 1024 * 1024)
+        with open(src, 'wb') as f:
+            f.write(content)
+
+        for chunk_size in (None, 1000, 65536):
+            with client.pull(src, encoding=None, chunk_size=chunk_size) as f:
+                self.assertEqual(f.read(), content)
+            with client.pull(src, encoding=None, stream=True, chunk_size=chunk_size) as f:
+                self.assertEqual(f.read(), content)
+            client.pull_to(src, dst, chunk_size=chunk_size)
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+        errors = client.pull_many([src, dst + 'x'], lambda path: open(dst, 'wb'))
+        self.assertEqual(list(errors), [dst + 'x'])
+        self.assertEqual(errors[dst + 'x'].kind, 'not-found')
+
+    def test_sendfile_truncated(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        conn = pebble._UnixSocketConnection('localhost', socket_path='unused')
+        conn.sock = ours
+        with tempfile.TemporaryFile() as f:
+            f.write(b'12345')
+            f.flush()
+            conn.send(pebble._FileRegion(f, 1, 3))
+            self.assertEqual(theirs.recv(10), b'234')
+            with self.assertRaises(OSError):
+                conn.send(pebble._FileRegion(f, 0, 10))
+
 
 class TestExecError(unittest.TestCase):
     def test_init(self):
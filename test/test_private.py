@@ -17,7 +17,7 @@ import unittest
 
 import yaml as base_yaml
 
-from ops._private import yaml
+from ops._private import jujuc, yaml
 
 
 class YAMLTest:
@@ -46,3 +46,69 @@ class TestYAML(unittest.TestCase):
         # Should error -- it's not safe to dump an instance of a user-defined class
         with self.assertRaises(base_yaml.YAMLError):
             yaml.safe_dump(YAMLTest())
+
+
+# What Go's encoding/gob sends for, in turn: rpc.Response{"Jujuc.Main", 1},
+# ExecResponse{-2, "out", "ERROR no\n"}, rpc.Response{"Jujuc.Main", 300, "bad request"},
+# and struct{}{}.
+_GO_GOB_STREAM = bytes.fromhex(
+    '397f03010108526573706f6e736501ff80000103010d536572766963654d6574686f64010c0001'
+    '0353657101060001054572726f72010c00000011ff80010a4a756a75632e4d61696e01010039ff'
+    '810301010c45786563526573706f6e736501ff820001030104436f646501040001065374646f75'
+    '74010a000106537464657272010a00000015ff82010301036f757401094552524f52206e6f0a00'
+    '20ff80010a4a756a75632e4d61696e01fe012c010b6261642072657175657374000aff83030102'
+    'ff8400000003ff8400')
+
+
+def _split_messages(data):
+    buf = jujuc._Buffer(data)
+    while not buf.done():
+        yield buf.read_bytes()
+
+
+class TestJujucCodec(unittest.TestCase):
+    def test_integers(self):
+        for n, encoded in [(0, b'\x00'), (7, b'\x07'), (256, b'\xfe\x01\x00')]:
+            self.assertEqual(jujuc._encode_uint(n), encoded)
+            self.assertEqual(jujuc._Buffer(encoded).read_uint(), n)
+        for i, encoded in [(-1, b'\x01'), (1, b'\x02'), (-129, b'\xfe\x01\x01')]:
+            self.assertEqual(jujuc._encode_int(i), encoded)
+            self.assertEqual(jujuc._Buffer(encoded).read_int(), i)
+
+    def test_decode_go_stream(self):
+        decoder = jujuc._Codec({})
+        messages = [decoder.decode(data) for data in _split_messages(_GO_GOB_STREAM)]
+        values = [message[1] for message in messages if message is not None]
+        self.assertEqual(values, [
+            {'ServiceMethod': 'Jujuc.Main', 'Seq': 1},
+            {'Code': -2, 'Stdout': b'out', 'Stderr': b'ERROR no\n'},
+            {'ServiceMethod': 'Jujuc.Main', 'Seq': 300, 'Error': 'bad request'},
+            {},
+        ])
+
+    def test_round_trip(self):
+        encoder = jujuc._Codec(jujuc._CLIENT_TYPES)
+        decoder = jujuc._Codec({})
+        request = {
+            'ContextId': 'ctx',
+            'Dir': '/var/lib/juju',
+            'CommandName': 'relation-get',
+            'Args': ['-r', '1', '-', 'myapp/0', '--format=json'],
+        }
+        data = encoder.encode(jujuc._JUJUC_REQUEST, request)
+        data += encoder.encode(jujuc._JUJUC_REQUEST, {'CommandName': 'is-leader'})
+        messages = [decoder.decode(message) for message in _split_messages(data)]
+        # The two types are defined before the first value, and not sent again.
+        self.assertEqual(messages, [
+            None,
+            None,
+            (jujuc._JUJUC_REQUEST, request),
+            (jujuc._JUJUC_REQUEST, {'CommandName': 'is-leader'}),
+        ])
+
+    def test_decode_errors(self):
+        decoder = jujuc._Codec({})
+        with self.assertRaises(jujuc.ProtocolError):
+            decoder.decode(b'\xff\x82\x00')  # A value of a type that was never defined.
+        with self.assertRaises(jujuc.ProtocolError):
+            decoder.decode(b'\x0c\x00\x05')  # A truncated string.
@@ -15,8 +15,12 @@
 import abc
 import gc
 import io
+import marshal
 import os
 import pathlib
+import pickle
+import shutil
+import sqlite3
 import sys
 import tempfile
 from test.test_helpers import BaseTestCase, fake_script, fake_script_calls
@@ -124,6 +128,33 @@ class StoragePermutations(abc.ABC):
         with self.assertRaises(storage.NoSnapshotError):
             store.load_snapshot('foo')
 
+    def test_update_snapshot(self):
+        store = self.create_storage()
+        # Updating a missing snapshot creates it.
+        store.update_snapshot('foo', {'a': 1})
+        self.assertEqual({'a': 1}, store.load_snapshot('foo'))
+        store.save_snapshot('bar', {'a': 1, 'b': [2]})
+        store.update_snapshot('bar', {'b': [3]})
+        self.assertEqual({'a': 1, 'b': [3]}, store.load_snapshot('bar'))
+        store.update_snapshot('bar', {'c': {'d': 4}})
+        self.assertEqual({'a': 1, 'b': [3], 'c': {'d': 4}}, store.load_snapshot('bar'))
+        # A full save replaces all the keys.
+        store.save_snapshot('bar', {'e': 5})
+        self.assertEqual({'e': 5}, store.load_snapshot('bar'))
+        store.update_snapshot('bar', {'a': 6})
+        store.drop_snapshot('bar')
+        with self.assertRaises(storage.NoSnapshotError):
+            store.load_snapshot('bar')
+        store.update_snapshot('bar', {'f': 7})
+        self.assertEqual({'f': 7}, store.load_snapshot('bar'))
+
+    def test_update_snapshot_refuses_complex_types(self):
+        store = self.create_storage()
+        store.save_snapshot('foo', {'a': 1})
+        with self.assertRaises(ValueError):
+            store.update_snapshot('foo', {'a': 2, 'b': object()})
+        self.assertEqual({'a': 1}, store.load_snapshot('foo'))
+
     def test_save_snapshot_empty_string(self):
         store = self.create_storage()
         with self.assertRaises(storage.NoSnapshotError):
@@ -205,6 +236,81 @@ class TestSQLiteStorage(StoragePermutations, BaseTestCase):
     def create_storage(self):
         return storage.SQLiteStorage(':memory:')
 
+    def _legacy_db(self, filename):
+        # The schema as created before notices were indexed.
+        db = sqlite3.connect(str(filename))
+        db.execute("CREATE TABLE snapshot (handle TEXT PRIMARY KEY, data BLOB)")
+        db.execute('''
+            CREATE TABLE notice (
+              sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+              event_path TEXT,
+              observer_path TEXT,
+              method_name TEXT)
+            ''')
+        db.execute("INSERT INTO notice VALUES (NULL, 'a', 'b', 'c')")
+        db.commit()
+        db.close()
+
+    def _indexes(self, store):
+        c = store._db.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?",
+                              ('notice_path',))
+        return [row[0] for row in c.fetchall()]
+
+    def test_new_db_is_indexed(self):
+        store = self.create_storage()
+        self.assertEqual(self._indexes(store), ['notice_path'])
+        user_version = store._db.execute("PRAGMA user_version").fetchone()[0]
+        self.assertEqual(user_version, storage.SQLiteStorage.SCHEMA_VERSION)
+        plan = store._db.execute(
+            "EXPLAIN QUERY PLAN DELETE FROM notice"
+            " WHERE event_path=? AND observer_path=? AND method_name=?",
+            ('a', 'b', 'c')).fetchall()
+        self.assertIn('notice_path', str(plan))
+
+    def test_migrate_legacy_db(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = pathlib.Path(tmpdir) / '.unit-state.db'
+            self._legacy_db(filename)
+
+            store = storage.SQLiteStorage(filename)
+            self.assertEqual(self._indexes(store), ['notice_path'])
+            self.assertEqual(list(store.notices()), [('a', 'b', 'c')])
+            store.close()
+
+            # Reopening an up to date database leaves it alone.
+            store = storage.SQLiteStorage(filename)
+            user_version = store._db.execute("PRAGMA user_version").fetchone()[0]
+            self.assertEqual(user_version, storage.SQLiteStorage.SCHEMA_VERSION)
+            self.assertEqual(list(store.notices()), [('a', 'b', 'c')])
+            store.close()
+
+    def test_wal_mode(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = pathlib.Path(tmpdir) / '.unit-state.db'
+            self._legacy_db(filename)
+
+            store = storage.SQLiteStorage(filename, wal=True)
+            self.assertEqual(store._db.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+            # 1 is NORMAL
+            self.assertEqual(store._db.execute("PRAGMA synchronous").fetchone()[0], 1)
+            store.save_notice('d', 'e', 'f')
+            store.commit()
+            store.close()
+
+            store = storage.SQLiteStorage(filename)
+            self.assertEqual(list(store.notices()), [('a', 'b', 'c'), ('d', 'e', 'f')])
+            store.close()
+
+
+class TestSQLiteStorageWAL(StoragePermutations, BaseTestCase):
+
+    def create_storage(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        store = storage.SQLiteStorage(pathlib.Path(tmpdir) / '.unit-state.db', wal=True)
+        self.addCleanup(store.close)
+        return store
+
 
 def setup_juju_backend(test_case, state_file):
     """Create fake scripts for pretending to be state-set and state-get."""
@@ -236,19 +342,22 @@ def setup_juju_backend(test_case, state_file):
         ''').format(**template_args))
 
     fake_script(test_case, 'state-get', dedent('''\
-        {executable} -Sc '
+        {executable} -c '
         import sys
         if "{pthpth}" not in sys.path:
             sys.path.append("{pthpth}")
-        import sys, pathlib, pickle
-        assert len(sys.argv) == 2
+        import sys, yaml, pathlib, pickle
+        assert len(sys.argv) <= 2
         state_file = pathlib.Path("{state_file}")
         if state_file.exists() and state_file.stat().st_size > 0:
             with state_file.open("rb") as f:
                 state = pickle.load(f)
         else:
             state = {{}}
-        result = state.get(sys.argv[1], "\\n")
+        if len(sys.argv) == 1:
+            result = yaml.safe_dump({{k: v for k, v in state.items() if v}})
+        else:
+            result = state.get(sys.argv[1], "\\n")
         sys.stdout.write(result)
         ' "$@"
         ''').format(**template_args))
@@ -283,6 +392,304 @@ class TestJujuStorage(StoragePermutations, BaseTestCase):
         setup_juju_backend(self, state_file)
         return storage.JujuStorage()
 
+    def test_writes_are_flushed_on_commit(self):
+        store = self.create_storage()
+        store.save_snapshot('foo', {1: 2})
+        store.save_snapshot('bar', 'baz')
+        store.save_notice('event', 'observer', 'method')
+        store.drop_snapshot('bar')
+        # Reads are served from the buffered changes.
+        self.assertEqual(store.load_snapshot('foo'), {1: 2})
+        with self.assertRaises(storage.NoSnapshotError):
+            store.load_snapshot('bar')
+        self.assertEqual(list(store.notices()), [('event', 'observer', 'method')])
+        # Only the initial reads of the snapshots replaced (in case their keys are stored
+        # separately) and of the notices (and of the legacy notice list, to migrate it) have
+        # gone to Juju.
+        self.assertEqual(fake_script_calls(self, clear=True), [
+            ['state-get', 'foo'],
+            ['state-get', 'bar'],
+            ['state-get', '#notices-index#'],
+            ['state-get', '#notices#'],
+        ])
+
+        store.commit()
+        self.assertEqual(fake_script_calls(self, clear=True), [
+            ['state-set', '--file', '-'],
+        ])
+        store.commit()
+        self.assertEqual(fake_script_calls(self, clear=True), [])
+
+        # A new storage sees the committed state.
+        store = storage.JujuStorage()
+        self.assertEqual(store.load_snapshot('foo'), {1: 2})
+        with self.assertRaises(storage.NoSnapshotError):
+            store.load_snapshot('bar')
+        self.assertEqual(list(store.notices()), [('event', 'observer', 'method')])
+
+    def test_update_snapshot_sends_changed_keys(self):
+        store = self.create_storage()
+        store.save_snapshot('foo', {'a': 1, 'b': 2})
+        store.commit()
+        store.update_snapshot('foo', {'a': 3})
+        store.commit()
+        fake_script_calls(self, clear=True)
+
+        store = storage.JujuStorage()
+        self.assertEqual({'a': 3, 'b': 2}, store.load_snapshot('foo'))
+        store.update_snapshot('foo', {'b': 4})
+        self.assertEqual(store._pending, {'foo#b': store._encode(4)})
+        store.commit()
+        # The whole state is read at once, and only the changed key is written.
+        self.assertEqual(fake_script_calls(self, clear=True), [
+            ['state-get', 'foo'],
+            ['state-get', ''],
+            ['state-set', '--file', '-'],
+        ])
+        self.assertEqual({'a': 3, 'b': 4}, storage.JujuStorage().load_snapshot('foo'))
+
+    def test_load_keyed_snapshot_leaves_prefetch_off(self):
+        store = self.create_storage()
+        store.update_snapshot('foo', {'a': 1, 'b': 2})
+        store.save_snapshot('bar', 'baz')
+        store.commit()
+        fake_script_calls(self, clear=True)
+
+        store = storage.JujuStorage()
+        self.assertEqual(store.load_snapshot('foo'), {'a': 1, 'b': 2})
+        self.assertEqual(store.load_snapshot('bar'), 'baz')
+        self.assertFalse(store._prefetch)
+        # The keys are read at once, along with everything else.
+        self.assertEqual(fake_script_calls(self, clear=True), [
+            ['state-get', 'foo'],
+            ['state-get', ''],
+        ])
+
+    def test_load_keyed_snapshots_fetch_state_once(self):
+        store = self.create_storage()
+        for i in range(5):
+            store.update_snapshot('foo{}'.format(i), {'a': i, 'b': str(i)})
+        store.commit()
+        fake_script_calls(self, clear=True)
+
+        store = storage.JujuStorage()
+        for i in range(5):
+            self.assertEqual(store.load_snapshot('foo{}'.format(i)), {'a': i, 'b': str(i)})
+        store.update_snapshot('foo0', {'a': 10})
+        store.commit()
+        self.assertEqual(store.load_snapshot('foo0'), {'a': 10, 'b': '0'})
+        with self.assertRaises(storage.NoSnapshotError):
+            store.load_snapshot('bar')
+        # Only the first snapshot index is fetched on its own; the rest is fetched once.
+        self.assertEqual([call[:2] for call in fake_script_calls(self, clear=True)], [
+            ['state-get', 'foo0'],
+            ['state-get', ''],
+            ['state-set', '--file'],
+        ])
+
+    def test_save_snapshot_deletes_unloaded_keys(self):
+        store = self.create_storage()
+        store.update_snapshot('foo', {'a': 1, 'b': 2})
+        store.commit()
+
+        store = storage.JujuStorage()
+        store.save_snapshot('foo', 'new')
+        store.commit()
+        self.assertEqual(list(storage._JujuStorageBackend().get_all()), ['foo'])
+        self.assertEqual(storage.JujuStorage().load_snapshot('foo'), 'new')
+
+    def test_drop_snapshot_deletes_unloaded_keys(self):
+        store = self.create_storage()
+        store.update_snapshot('foo', {'a': 1, 'b': 2})
+        store.save_snapshot('bar', 'baz')
+        store.commit()
+
+        store = storage.JujuStorage()
+        store.drop_snapshot('foo')
+        store.commit()
+        self.assertEqual(list(storage._JujuStorageBackend().get_all()), ['bar'])
+
+    def test_snapshot_is_copied_when_saved(self):
+        store = self.create_storage()
+        data = {'a': [1]}
+        store.save_snapshot('foo', data)
+        data['a'].append(2)
+        self.assertEqual(store.load_snapshot('foo'), {'a': [1]})
+        store.commit()
+        self.assertEqual(storage.JujuStorage().load_snapshot('foo'), {'a': [1]})
+
+    def test_prefetch(self):
+        store = self.create_storage()
+        store.save_snapshot('foo', {'a': (1, 2)})
+        store.save_snapshot('bar', 'baz')
+        store.save_notice('event', 'observer', 'method')
+        store.commit()
+        fake_script_calls(self, clear=True)
+
+        store = storage.JujuStorage(prefetch=True)
+        self.assertEqual(store.load_snapshot('foo'), {'a': (1, 2)})
+        self.assertEqual(store.load_snapshot('bar'), 'baz')
+        with self.assertRaises(storage.NoSnapshotError):
+            store.load_snapshot('qux')
+        self.assertEqual(list(store.notices()), [('event', 'observer', 'method')])
+        self.assertEqual(fake_script_calls(self, clear=True), [['state-get', '']])
+
+        # Committed changes are reflected in the prefetched state.
+        store.drop_snapshot('bar')
+        store.save_snapshot('qux', 1)
+        store.commit()
+        with self.assertRaises(storage.NoSnapshotError):
+            store.load_snapshot('bar')
+        self.assertEqual(store.load_snapshot('qux'), 1)
+        self.assertEqual(fake_script_calls(self, clear=True), [['state-set', '--file', '-']])
+
+    def test_prefetch_empty_state(self):
+        self.create_storage()
+        store = storage.JujuStorage(prefetch=True)
+        with self.assertRaises(storage.NoSnapshotError):
+            store.load_snapshot('foo')
+        self.assertEqual(list(store.notices()), [])
+        self.assertEqual(fake_script_calls(self, clear=True), [['state-get', '']])
+
+    def test_notices_are_chunked(self):
+        store = self.create_storage()
+        store.NOTICE_CHUNK_SIZE = 2
+        notices = [('e{}'.format(i), 'o', 'm') for i in range(5)]
+        for notice in notices:
+            store.save_notice(*notice)
+        store.commit()
+
+        reader = storage.JujuStorage()
+        self.assertEqual(reader._get('#notices-index#'), [0, 1, 2])
+        self.assertEqual(reader._get('#notices#0'), [('e0', 'o', 'm'), ('e1', 'o', 'm')])
+        self.assertEqual(reader._get('#notices#2'), [('e4', 'o', 'm')])
+
+        store = storage.JujuStorage()
+        store.NOTICE_CHUNK_SIZE = 2
+        self.assertEqual(list(store.notices()), notices)
+        store.drop_notice('e2', 'o', 'm')
+        store.drop_notice('e3', 'o', 'm')
+        store.save_notice('e5', 'o', 'm')
+        store.save_notice('e2', 'o', 'm')
+        store.commit()
+        fake_script_calls(self, clear=True)
+
+        # Empty chunks are removed, and new notices still go at the end.
+        reader = storage.JujuStorage()
+        self.assertEqual(reader._get('#notices-index#'), [0, 2, 3])
+        with self.assertRaises(KeyError):
+            reader._get('#notices#1')
+        self.assertEqual(list(storage.JujuStorage().notices()), [
+            ('e0', 'o', 'm'), ('e1', 'o', 'm'), ('e4', 'o', 'm'), ('e5', 'o', 'm'),
+            ('e2', 'o', 'm'),
+        ])
+        with self.assertRaises(ValueError):
+            store.drop_notice('e3', 'o', 'm')
+
+    def test_migrate_notice_list(self):
+        self.create_storage()
+        notices = [('e{}'.format(i), 'o', 'm') for i in range(150)]
+        backend = storage._JujuStorageBackend()
+        backend.set('#notices#', notices)
+
+        store = storage.JujuStorage()
+        self.assertEqual(list(store.notices()), notices)
+        store.drop_notice('e0', 'o', 'm')
+        store.commit()
+
+        with self.assertRaises(KeyError):
+            backend.get('#notices#')
+        self.assertEqual(backend.get('#notices-index#'), [0, 1])
+        self.assertEqual(list(storage.JujuStorage().notices()), notices[1:])
+
+    def test_close_discards_uncommitted_changes(self):
+        store = self.create_storage()
+        store.save_snapshot('foo', 1)
+        store.commit()
+        store.save_snapshot('foo', 2)
+        store.close()
+        self.assertEqual(storage.JujuStorage().load_snapshot('foo'), 1)
+
+
+class TestCodecs(BaseTestCase):
+
+    value = {
+        'str': 'string',
+        'bytes': b'\x00bytes',
+        'int': 1,
+        'float': 3.0,
+        'bool': True,
+        'none': None,
+        'dict': {'a': 'b', 1: (2, 3), (4, 5): {6}},
+        'set': {'a', ('b', 1)},
+        'list': [1, [2, 3], (4,)],
+        'tuple': ('a', ('b',)),
+        'tag': {'__set__': [1, 2]},
+    }
+
+    def test_roundtrip(self):
+        for codec in (storage.PickleCodec(), storage.MarshalCodec(), storage.JSONCodec()):
+            with self.subTest(codec=codec.name):
+                self.assertEqual(codec.decode(codec.encode(self.value)), self.value)
+                self.assertEqual(codec.decode(codec.encode(None)), None)
+
+    def test_sqlite_default_is_pickle(self):
+        store = storage.SQLiteStorage(':memory:')
+        store.save_snapshot('foo', self.value)
+        raw = store._db.execute("SELECT data FROM snapshot WHERE handle='foo'").fetchone()[0]
+        # A documented pickle protocol, which later versions of Python can still read.
+        self.assertTrue(raw.startswith(b'#pickle\n\x80\x04'))
+        self.assertEqual(pickle.loads(raw[len(b'#pickle\n'):]), self.value)
+        self.assertEqual(store.load_snapshot('foo'), self.value)
+
+    def test_json_is_text(self):
+        raw = storage.JSONCodec().encode({'a': ('b', 'ü')})
+        self.assertEqual(raw, b'{"a":{"__tuple__":["b","\\u00fc"]}}')
+
+    def test_refuses_complex_types(self):
+        class Foo:
+            pass
+
+        for codec in (storage.PickleCodec(), storage.MarshalCodec(), storage.JSONCodec()):
+            for value in (Foo(), {'a': Foo()}, [Foo()]):
+                with self.subTest(codec=codec.name, value=value):
+                    with self.assertRaises(ValueError):
+                        codec.encode(value)
+
+    def test_sqlite_loads_other_codecs(self):
+        store = storage.SQLiteStorage(':memory:', codec=storage.JSONCodec())
+        store.save_snapshot('json', self.value)
+        store._db.execute("REPLACE INTO snapshot VALUES (?, ?)",
+                          ('legacy', pickle.dumps(self.value)))
+        store._db.execute("REPLACE INTO snapshot VALUES (?, ?)",
+                          ('marshal', b'#marshal\n' + marshal.dumps(self.value)))
+        self.assertEqual(store.load_snapshot('json'), self.value)
+        self.assertEqual(store.load_snapshot('legacy'), self.value)
+        self.assertEqual(store.load_snapshot('marshal'), self.value)
+
+        store._db.execute("REPLACE INTO snapshot VALUES (?, ?)", ('bad', b'#foo\n{}'))
+        with self.assertRaises(ValueError):
+            store.load_snapshot('bad')
+
+    def test_juju_loads_other_codecs(self):
+        state_file = pathlib.Path(tempfile.mkdtemp()) / 'state'
+        self.addCleanup(shutil.rmtree, str(state_file.parent))
+        setup_juju_backend(self, state_file)
+        value = {'a': (1, 2), 'b': {'c'}}
+
+        store = storage.JujuStorage(codec=storage.MarshalCodec())
+        store.save_snapshot('marshal', value)
+        store.commit()
+        storage._JujuStorageBackend().set('legacy', value)
+
+        store = storage.JujuStorage()
+        self.assertEqual(store.load_snapshot('marshal'), value)
+        self.assertEqual(store.load_snapshot('legacy'), value)
+        store.save_snapshot('json', value)
+        store.commit()
+        self.assertEqual(storage.JujuStorage().load_snapshot('json'), value)
+        self.assertTrue(storage._JujuStorageBackend().get_encoded('json').startswith('#json\n'))
+
 
 class TestSimpleLoader(BaseTestCase):
 
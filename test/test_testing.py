@@ -3539,6 +3539,67 @@ class _PebbleStorageAPIsTestMixin:
 
         client.push(self.prefix + '/nonexistent_dir/test', data, make_dirs=True)
 
+    def test_push_many(self):
+        client = self.client
+        errors = client.push_many([
+            {'path': self.prefix + '/many/text', 'source': 'text', 'make_dirs': True},
+            {'path': self.prefix + '/missing/bytes', 'source': b'bytes'},
+            {'path': self.prefix + '/many/file', 'source': io.BytesIO(b'file'),
+             'permissions': 0o600},
+        ])
+        self.assertEqual(list(errors), [self.prefix + '/missing/bytes'])
+        self.assertEqual(errors[self.prefix + '/missing/bytes'].kind, 'not-found')
+
+        with client.pull(self.prefix + '/many/text') as infile:
+            self.assertEqual(infile.read(), 'text')
+        with client.pull(self.prefix + '/many/file', encoding=None) as infile:
+            self.assertEqual(infile.read(), b'file')
+        info, = client.list_files(self.prefix + '/many/file')
+        self.assertEqual(info.permissions, 0o600)
+
+    def test_pull_many(self):
+        client = self.client
+        client.push(self.prefix + '/many/text', 'text 😀', make_dirs=True)
+        client.push(self.prefix + '/many/bytes', b'\x00\x01')
+        files = {}
+
+        def open_file(path):
+            files[path] = io.BytesIO()
+            files[path].close = lambda: None
+            return files[path]
+
+        errors = client.pull_many(
+            [self.prefix + '/many/text', self.prefix + '/missing', self.prefix + '/many/bytes'],
+            open_file)
+        self.assertEqual(list(errors), [self.prefix + '/missing'])
+        self.assertEqual(errors[self.prefix + '/missing'].kind, 'not-found')
+        self.assertEqual({path: f.getvalue() for path, f in files.items()}, {
+            self.prefix + '/many/text': 'text 😀'.encode('utf-8'),
+            self.prefix + '/many/bytes': b'\x00\x01',
+        })
+
+    def test_pull_to(self):
+        client = self.client
+        client.push(self.prefix + '/pull_to', b'\x00\x01')
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        dest = os.path.join(tmpdir.name, 'dest')
+
+        client.pull_to(self.prefix + '/pull_to', dest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'\x00\x01')
+
+        with self.assertRaises(pebble.PathError) as cm:
+            client.pull_to(self.prefix + '/missing', dest + '2')
+        self.assertEqual(cm.exception.kind, 'not-found')
+        self.assertFalse(os.path.exists(dest + '2'))
+
+    def test_pull_stream(self):
+        client = self.client
+        client.push(self.prefix + '/stream', 'text 😀\r\n')
+        with client.pull(self.prefix + '/stream', stream=True) as infile:
+            self.assertEqual(infile.read(), 'text 😀\r\n')
+
     def test_push_as_child_of_file_raises_error(self):
         data = 'data'
         client = self.client